@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+End-to-end throughput and latency of the GATT stack on the fake BlueZ
+backend, no radio needed:
+
+    central write -> WriteValue -> frame_data_class -> recv()
+    -> send() -> notify_cb -> PropertiesChanged -> central
+
+Every message is echoed by an application thread. With --flow the central
+uses credit based flow control (communication/flow_control.py) instead of
+relying on refused writes. Results are printed and can be saved as JSON; with --baseline the run fails when a scenario is
+slower than the baseline by more than --tolerance.
+
+    python3 benchmark/bluetooth_benchmark.py --size 20 200 2000 --burst 1 8 \\
+        --inflight 1 8 --output bench.json --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import resource
+import struct
+import sys
+import threading
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dbus.exceptions
+from communication.bluetooth import bluetooth
+from communication.bluetooth.fake_bluez import fake_bluez_class
+from communication import frame_codec
+from communication.flow_control import flow_control_class
+from utils import log
+
+MESSAGE_ID = struct.Struct('<I')
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class echo_app_class():
+    def __init__(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            for message in bluetooth.recv_many(64, timeout=0.1):
+                bluetooth.send(message)
+
+class central_class():
+    def __init__(self, fake, mtu, flow_window=None):
+        self.fake = fake
+        self.mtu = mtu
+        self.encoder = frame_codec.frame_encoder_class()
+        self.decoder = frame_codec.frame_decoder_class()
+        self.lock = threading.Lock()
+        self.flow = None
+        self.reset(0, 1)
+        fake.notify_callback = self.notify_cb
+        if flow_window:
+            self.flow = flow_control_class(flow_window, self.write_link)
+            self.flow.start()
+
+    def reset(self, expected, inflight):
+        self.sent = {}
+        self.latencies = []
+        self.received = 0
+        self.expected = expected
+        self.window = threading.Semaphore(inflight)
+        self.done = threading.Event()
+
+    def notify_cb(self, value):
+        # GLib thread
+        now = time.perf_counter()
+        for channel, message in self.decoder.feed_channels(value):
+            if channel == frame_codec.CHANNEL_LINK:
+                if self.flow is not None:
+                    self.flow.handle(message)
+                continue
+            if self.flow is not None:
+                self.flow.rx_received()
+                self.flow.rx_consumed(1)
+            message_id = MESSAGE_ID.unpack_from(message)[0]
+            with self.lock:
+                start = self.sent.pop(message_id, None)
+                if start is None:
+                    continue
+                self.latencies.append(now - start)
+                self.received += 1
+                if self.received >= self.expected:
+                    self.done.set()
+            self.window.release()
+
+    def write(self, message_id, payload):
+        if self.flow is not None and not self.flow.tx_acquire(5.0):
+            raise dbus.exceptions.DBusException('no credit')
+        with self.lock:
+            self.sent[message_id] = time.perf_counter()
+        self.fake.run_in_loop(self.write_fragments, payload, 0)
+
+    def write_link(self, message):
+        self.fake.run_in_loop(self.write_fragments, message, frame_codec.CHANNEL_LINK)
+
+    def write_fragments(self, payload, channel):
+        # on the GLib thread, so link and data fragments keep their seq order
+        fragment_size = frame_codec.mtu_to_fragment_size(self.mtu)
+        for fragment in self.encoder.fragments(payload, fragment_size, channel):
+            self.fake.write(fragment, mtu=self.mtu)
+
+def run_scenario(central, size, burst, inflight, count, interval, timeout):
+    central.reset(count, inflight)
+    stats_before = bluetooth.get_queue_stats()
+    decoder_errors_before = (bluetooth.ble_frame_decoder.crc_errors +
+                             bluetooth.ble_frame_decoder.seq_errors +
+                             bluetooth.ble_frame_decoder.format_errors)
+    padding = os.urandom(max(0, size - MESSAGE_ID.size))
+    rejected = 0
+
+    cpu_start = cpu_time()
+    start = time.perf_counter()
+    message_id = 0
+    while message_id < count:
+        for i in range(min(burst, count - message_id)):
+            central.window.acquire()
+            payload = MESSAGE_ID.pack(message_id) + padding
+            try:
+                central.write(message_id, payload)
+            except dbus.exceptions.DBusException:
+                rejected += 1
+                with central.lock:
+                    central.sent.pop(message_id, None)
+                    central.expected -= 1
+                central.window.release()
+            message_id += 1
+        if interval:
+            time.sleep(interval)
+    central.done.wait(timeout)
+    elapsed = time.perf_counter() - start
+    cpu = cpu_time() - cpu_start
+
+    stats_after = bluetooth.get_queue_stats()
+    decoder_errors = (bluetooth.ble_frame_decoder.crc_errors +
+                      bluetooth.ble_frame_decoder.seq_errors +
+                      bluetooth.ble_frame_decoder.format_errors) - decoder_errors_before
+    dropped = (stats_after['rx']['dropped'] - stats_before['rx']['dropped'] +
+               stats_after['tx']['dropped'] - stats_before['tx']['dropped'])
+    latencies = sorted(central.latencies)
+    received = len(latencies)
+    return {
+            'name': 'size%d_burst%d_inflight%d' % (size, burst, inflight),
+            'size': size,
+            'burst': burst,
+            'inflight': inflight,
+            'mtu': central.mtu,
+            'messages': count,
+            'received': received,
+            'lost': count - rejected - received,
+            'rejected_writes': rejected,
+            'dropped_frames': dropped,
+            'decoder_errors': decoder_errors,
+            'seconds': elapsed,
+            'messages_per_s': received / elapsed if elapsed > 0 else 0.0,
+            'bytes_per_s': received * size / elapsed if elapsed > 0 else 0.0,
+            'latency_p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+            'latency_p95_ms': percentile(latencies, 0.95) * 1000 if latencies else None,
+            'latency_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+            'cpu_percent': 100.0 * cpu / elapsed if elapsed > 0 else 0.0,
+    }
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    previous = dict((result['name'], result) for result in baseline.get('results', []))
+    for result in results:
+        old = previous.get(result['name'])
+        if old is None:
+            continue
+        if result['messages_per_s'] < old['messages_per_s'] * (1.0 - tolerance):
+            regressions.append('%s: %.0f msg/s, baseline %.0f' % (
+                    result['name'], result['messages_per_s'], old['messages_per_s']))
+        if (result['latency_p95_ms'] is not None and old.get('latency_p95_ms') is not None and
+                result['latency_p95_ms'] > old['latency_p95_ms'] * (1.0 + tolerance)):
+            regressions.append('%s: p95 %.2f ms, baseline %.2f ms' % (
+                    result['name'], result['latency_p95_ms'], old['latency_p95_ms']))
+    return regressions
+
+def print_result(result):
+    print('%-28s %8.0f msg/s %10.0f B/s  p50 %7.3f  p95 %7.3f  p99 %7.3f ms  cpu %5.1f%%  lost %d  dropped %d' % (
+            result['name'], result['messages_per_s'], result['bytes_per_s'],
+            result['latency_p50_ms'] or 0, result['latency_p95_ms'] or 0,
+            result['latency_p99_ms'] or 0, result['cpu_percent'],
+            result['lost'], result['dropped_frames']))
+
+def main():
+    parser = argparse.ArgumentParser(description='bluetooth stack benchmark on the fake BlueZ backend')
+    parser.add_argument('--size', type=int, nargs='+', default=[20, 200, 2000])
+    parser.add_argument('--burst', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--inflight', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help='pause in ms between bursts')
+    parser.add_argument('--mtu', type=int, default=185)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--flow', type=int, default=0, metavar='WINDOW',
+                        help='use credit flow control with this receive window')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    log.print_level = log.PRINT_LEVEL_WARN
+    fake = fake_bluez_class()
+    bluetooth.setup(backend=fake)
+    fake.connect()
+    fake.start_notify()
+    app = echo_app_class()
+    central = central_class(fake, args.mtu, args.flow)
+
+    results = []
+    for size in args.size:
+        for burst in args.burst:
+            for inflight in args.inflight:
+                result = run_scenario(central, max(size, MESSAGE_ID.size), burst, inflight,
+                                      args.count, args.interval / 1000.0, args.timeout)
+                print_result(result)
+                results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+What payload compression (communication/compression.py) buys on a link of
+a given rate, measured on sample traffic of the kinds this service carries:
+shell commands, their output and JSON status messages.
+
+For every codec, with and without the preset dictionary, it reports the
+compression ratio, the CPU time per message on each side, the notifications
+needed at --mtu and the resulting throughput over a link that delivers
+--link-rate notifications per second, against sending uncompressed. No
+BlueZ or dbus needed.
+
+    python3 benchmark/compression_benchmark.py --mtu 185 --link-rate 200 \\
+        --output compression.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from communication import compression
+from communication import frame_codec
+
+COMMANDS = [
+    b'ifconfig wlan0',
+    b'vcgencmd measure_temp && vcgencmd get_throttled',
+    b'df -h /home/pi/GeekProject/',
+    b'ps aux | grep python3 main.py',
+    b'sudo systemctl restart bluetooth && systemctl status bluetooth',
+    b'ls -la /home/pi/GeekProject/communication/',
+    b'cat /var/log/syslog | grep -i error | tail -n 20',
+    b'wget -q -O /tmp/update.tar.gz https://example.com/update.tar.gz',
+]
+
+OUTPUTS = [
+    b'temp=48.3\'C\nthrottled=0x0\n',
+    b'Filesystem      Size  Used Avail Use% Mounted on\n'
+    b'/dev/root        29G  4.1G   24G  15% /\n',
+    b'total 64\n'
+    b'drwxr-xr-x 3 pi pi  4096 Mar  3 10:12 .\n'
+    b'drwxr-xr-x 9 pi pi  4096 Mar  3 10:10 ..\n'
+    b'-rw-r--r-- 1 pi pi  8123 Mar  3 10:12 frame_codec.py\n'
+    b'-rw-r--r-- 1 pi pi  5630 Mar  3 10:12 frame_data.py\n'
+    b'-rw-r--r-- 1 pi pi  4302 Mar  3 10:12 flow_control.py\n'
+    b'-rw-r--r-- 1 pi pi  3987 Mar  3 10:12 tx_scheduler.py\n',
+    b'wlan0: flags=4163<UP,BROADCAST,RUNNING,MULTICAST>  mtu 1500\n'
+    b'        inet 192.168.1.23  netmask 255.255.255.0  broadcast 192.168.1.255\n'
+    b'        RX packets 182733  bytes 201288844 (191.9 MiB)\n'
+    b'        TX packets 91021  bytes 11839211 (11.2 MiB)\n',
+    b'pi         612  2.1  3.4  41236 32104 ?        Sl   10:10   0:42 python3 main.py\n',
+    b'bash: foo: command not found\n',
+    b'cat: /tmp/missing: No such file or directory\n',
+]
+
+STATUS = [
+    b'{"status": "ok", "battery": {"voltage": 7.42, "temperature": 31.5}, "connected": true}',
+    b'{"name": "motor", "value": 128, "error": null}',
+    b'{"version": "1.4.2", "status": "ok", "result": {"uptime": 93211, "free": 412}}',
+    b'{"status": "error", "error": {"message": "Permission denied", "code": 13}}',
+]
+
+def samples():
+    return [('command', COMMANDS), ('output', OUTPUTS), ('status', STATUS)]
+
+def notifications(payload, fragment_size):
+    return len(list(frame_codec.frame_encoder_class().fragments(payload, fragment_size)))
+
+def codecs():
+    names = [('none', None), ('zlib', compression.CODEC_ZLIB)]
+    if compression.lz4 is not None:
+        names.append(('lz4', compression.CODEC_LZ4))
+    return names
+
+def run_case(name, codec, dictionary, messages, fragment_size, link_rate, repeat):
+    sender = compression.compression_class(threshold=1, dictionary=dictionary)
+    receiver = compression.compression_class(threshold=1, dictionary=dictionary)
+    sender.codec = codec
+    raw_bytes = 0
+    wire_bytes = 0
+    raw_notifications = 0
+    wire_notifications = 0
+    compress_time = 0.0
+    decompress_time = 0.0
+    for message in messages:
+        start = time.perf_counter()
+        for i in range(repeat):
+            compressed, data = sender.compress(message)
+        compress_time += time.perf_counter() - start
+        if compressed:
+            start = time.perf_counter()
+            for i in range(repeat):
+                decoded = receiver.decompress(data)
+            decompress_time += time.perf_counter() - start
+            assert decoded == message
+        raw_bytes += len(message)
+        wire_bytes += len(data)
+        raw_notifications += notifications(message, fragment_size)
+        wire_notifications += notifications(data, fragment_size)
+    count = len(messages) * repeat
+    # per message: time on the air plus CPU on both ends
+    raw_seconds = raw_notifications / link_rate
+    wire_seconds = wire_notifications / link_rate + (compress_time + decompress_time) / repeat
+    return {
+        'name': name,
+        'messages': len(messages),
+        'raw_bytes': raw_bytes,
+        'wire_bytes': wire_bytes,
+        'ratio': raw_bytes / wire_bytes,
+        'compress_us': compress_time / count * 1e6,
+        'decompress_us': decompress_time / count * 1e6,
+        'raw_notifications': raw_notifications,
+        'wire_notifications': wire_notifications,
+        'throughput_gain': raw_seconds / wire_seconds,
+    }
+
+def print_result(result):
+    print('%-24s ratio %5.2f  %5d -> %5d B  compress %6.1f us  decompress %6.1f us  '
+          'notifications %4d -> %4d  throughput x%.2f' % (
+            result['name'], result['ratio'], result['raw_bytes'], result['wire_bytes'],
+            result['compress_us'], result['decompress_us'],
+            result['raw_notifications'], result['wire_notifications'],
+            result['throughput_gain']))
+
+def main():
+    parser = argparse.ArgumentParser(description='payload compression benchmark')
+    parser.add_argument('--mtu', type=int, default=185)
+    parser.add_argument('--link-rate', type=float, default=200.0,
+                        help='notifications per second the link delivers')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='timing repetitions per message')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    fragment_size = frame_codec.mtu_to_fragment_size(args.mtu)
+    if compression.lz4 is None:
+        print('lz4 module not installed, zlib only')
+    results = []
+    for kind, messages in samples() + [('all', COMMANDS + OUTPUTS + STATUS)]:
+        for codec_name, codec in codecs():
+            for dictionary in ((None,) if codec is None else (None, compression.PRESET_DICTIONARY)):
+                name = '%s/%s%s' % (kind, codec_name, '+dict' if dictionary else '')
+                result = run_case(name, codec, dictionary, messages, fragment_size,
+                                  args.link_rate, args.repeat)
+                print_result(result)
+                results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'mtu': args.mtu, 'link_rate': args.link_rate, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -2,23 +2,27 @@
 
 import dbus
 import dbus.exceptions
-import dbus.mainloop.glib
 import dbus.service
 
 import array
-try:
-  from gi.repository import GObject
-except ImportError:
-  import gobject as GObject
-
 import sys
 import os
 from random import randint
 import threading
 import time
 from utils import log
-from communication.frame_data import frame_data_class
-
+from communication.ring_buffer import RingBufferFullException
+from communication import frame_codec
+from communication import metrics
+from communication import compression
+from communication.session import session_class
+from communication.startup_timeline import timeline
+
+timeline.mark('import')
+
+# GObject and the dbus GLib main loop are imported by setup(), see
+# load_gobject(), so importing this module stays cheap
+GObject = None
 mainloop = None
 
 
@@ -28,11 +32,44 @@ advertisement_status = False
 bus = None
 ble_server_start = False
 ble_register = False
-monitor_thread = None
-
-ble_frame_data = frame_data_class(16, 16)
+connected_devices = set()
+connect_status_callbacks = []
+message_handlers = []
+mainloop_thread_ident = None
+ble_backend = None
+startup_reported = False
+
+# notifications per main loop iteration, so incoming writes (and the
+# replies they trigger) get in between the fragments of a long message
+NOTIFY_BUDGET = 32
+ble_framing = True
+# centrals served at once, advertising stops when this many are connected
+ble_max_connections = 1
+# one session per connected central, see session.py; slot 0 exists from
+# the start, send() and recv() without a session use it
+ble_sessions = [session_class(0)]
+# the session whose message the on_message() handlers are processing
+current_session = None
+current_message = None
+# limits set with set_notify_batching(), also applied to later sessions
+notify_batching = {}
+# slot 0 under the names it had before there were sessions
+ble_session = ble_sessions[0]
+ble_frame_data = ble_session.frame_data
+ble_frame_decoder = ble_session.decoder
+ble_frame_encoder = ble_session.encoder
+ble_flow_control = ble_session.flow_control
+ble_compression = ble_session.compression
+ble_tx_scheduler = ble_session.tx_scheduler
+ble_notify_batcher = ble_session.notify_batcher
+
+ble_connects = metrics.registry.counter('ble_connects_total', 'central connections')
+ble_disconnects = metrics.registry.counter('ble_disconnects_total', 'central disconnections')
+metrics.registry.gauge('ble_connected_centrals', 'centrals connected right now',
+        lambda: len(connected_devices))
 
 BLUEZ_SERVICE_NAME = 'org.bluez'
+BLUEZ_ADAPTER_IFACE = 'org.bluez.Adapter1'
 BLUEZ_DEVICE_IFACE = 'org.bluez.Device1'
 GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
 DBUS_OM_IFACE =      'org.freedesktop.DBus.ObjectManager'
@@ -45,6 +82,11 @@ GATT_DESC_IFACE =    'org.bluez.GattDescriptor1'
 
 LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
 
+# advertising interval in ms, the 48/80 x 0.625 ms that used to be written to
+# debugfs adv_min_interval/adv_max_interval
+ADV_MIN_INTERVAL = 30
+ADV_MAX_INTERVAL = 50
+
 class InvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.freedesktop.DBus.Error.InvalidArgs'
 
@@ -77,9 +119,22 @@ class Advertisement(dbus.service.Object):
         self.discoverable = None
         self.discoverable_timeout = None
         self.include_tx_power = None
+        self.min_interval = None
+        self.max_interval = None
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
+    def invalidate(self):
+        # call after changing an attribute directly instead of via add_*()
+        self.properties = None
+
     def get_properties(self):
+        # built once and shared by every GetAll, callers must not modify it
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def build_properties(self):
         properties = dict()
         properties['Type'] = self.ad_type
         if self.service_uuids is not None:
@@ -106,56 +161,78 @@ class Advertisement(dbus.service.Object):
             properties['DiscoverableTimeout'] = dbus.Uint16(self.discoverable_timeout)
         if self.include_tx_power is not None:
             properties['IncludesTxpower'] = dbus.Boolean(self.include_tx_power)
+        if self.min_interval is not None:
+            properties['MinInterval'] = dbus.UInt32(self.min_interval)
+        if self.max_interval is not None:
+            properties['MaxInterval'] = dbus.UInt32(self.max_interval)
         return {LE_ADVERTISEMENT_IFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service_uuid(self, uuid):
+        self.invalidate()
         if not self.service_uuids:
             self.service_uuids = []
         self.service_uuids.append(uuid)
 
     def add_solicit_uuid(self, uuid):
+        self.invalidate()
         if not self.solicit_uuids:
             self.solicit_uuids = []
         self.solicit_uuids.append(uuid)
 
     def add_manufacturer_data(self, manuf_code, data):
+        self.invalidate()
         if not self.manufacturer_data:
             self.manufacturer_data = dbus.Dictionary({}, signature='qv')
         self.manufacturer_data[manuf_code] = dbus.Array(data, signature='y')
 
     def add_service_data(self, uuid, data):
+        self.invalidate()
         if not self.service_data:
             self.service_data = dbus.Dictionary({}, signature='sv')
         self.service_data[uuid] = dbus.Array(data, signature='y')
 
     def add_local_name(self, name):
+        self.invalidate()
         if not self.local_name:
             self.local_name = ""
         self.local_name = dbus.String(name)
 
     def add_duration(self, time):
+        self.invalidate()
         if not self.duration:
             self.duration = dbus.UInt16(2)
         self.duration = dbus.UInt16(time)
 
     def add_timeout(self, time):
+        self.invalidate()
         if not self.timeout:
             self.timeout = dbus.UInt16(1)
         self.timeout = dbus.UInt16(time)
 
     def add_discoverable(self, val):
+        self.invalidate()
         if not self.discoverable:
             self.discoverable = True
         self.discoverable = val
 
     def add_discoverable_timeout(self, time):
+        self.invalidate()
         if not self.discoverable_timeout:
             self.discoverable_timeout = dbus.UInt16(0)
         self.discoverable_timeout = dbus.UInt16(time)
 
+    def add_interval(self, min_interval, max_interval):
+        # milliseconds, BlueZ applies them when the advertisement is
+        # registered; MinInterval/MaxInterval are experimental properties,
+        # ignored unless bluetoothd runs with --experimental (see
+        # raspberrypi_config/readme.txt)
+        self.invalidate()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -170,20 +247,21 @@ class Advertisement(dbus.service.Object):
                          in_signature='',
                          out_signature='')
     def Release(self):
-        log.info_print('%s: Released!' % self.path)
+        log.info_print('%s: Released!', self.path)
 
 class BLEAdvertisement(Advertisement):
 
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, address):
         #peripheral broadcast
         Advertisement.__init__(self, bus, index, 'peripheral')
         #self.add_service_uuid('180D')
         #self.add_service_uuid('180F')
         self.add_manufacturer_data(0x424D, [0x30, 0x31, 0x6C, 0x00, 0xFA,0x10,0x1B,0x00])
         #self.add_service_data('9999', [0x00, 0x01, 0x02, 0x03, 0x04])
-        local_name = 'GeekPlay_' + get_ble_mac(bus)
+        local_name = 'GeekPlay_' + address.replace(':', '')
         self.add_local_name(local_name)
         self.add_discoverable(True)
+        self.add_interval(ADV_MIN_INTERVAL, ADV_MAX_INTERVAL)
         self.include_tx_power = True
 
 class BLEApplication(dbus.service.Object):
@@ -193,6 +271,7 @@ class BLEApplication(dbus.service.Object):
     def __init__(self, bus):
         self.path = '/'
         self.services = []
+        self.managed_objects = None
         dbus.service.Object.__init__(self, bus, self.path)
         self.add_service(TestService(bus, 0))
         
@@ -201,13 +280,24 @@ class BLEApplication(dbus.service.Object):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
+        service.application = self
         self.services.append(service)
+        self.invalidate()
+
+    def invalidate(self):
+        self.managed_objects = None
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
-        response = {}
         log.info_print('GetManagedObjects')
+        # BlueZ asks again on every registration, the tree only changes
+        # when a service, characteristic or descriptor is added
+        if self.managed_objects is None:
+            self.managed_objects = self.build_managed_objects()
+        return self.managed_objects
 
+    def build_managed_objects(self):
+        response = {}
         for service in self.services:
             response[service.get_path()] = service.get_properties()
             chrcs = service.get_characteristics()
@@ -232,9 +322,21 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.application = None
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
+    def invalidate(self):
+        self.properties = None
+        if self.application is not None:
+            self.application.invalidate()
+
     def get_properties(self):
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def build_properties(self):
         return {
                 GATT_SERVICE_IFACE: {
                         'UUID': self.uuid,
@@ -250,6 +352,7 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate()
 
     def get_characteristic_paths(self):
         result = []
@@ -281,9 +384,19 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
+    def invalidate(self):
+        self.properties = None
+        self.service.invalidate()
+
     def get_properties(self):
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def build_properties(self):
         return {
                 GATT_CHRC_IFACE: {
                         'Service': self.service.get_path(),
@@ -300,6 +413,7 @@ class Characteristic(dbus.service.Object):
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate()
 
     def get_descriptor_paths(self):
         result = []
@@ -326,8 +440,11 @@ class Characteristic(dbus.service.Object):
         log.error_print('Default ReadValue called, returning error')
         raise NotSupportedException()
 
-    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}',
+                        byte_arrays=True)
     def WriteValue(self, value, options):
+        # byte_arrays=True: value arrives as dbus.ByteArray (bytes), not as
+        # an array of dbus.Byte
         log.error_print('Default WriteValue called, returning error')
         raise NotSupportedException()
 
@@ -357,9 +474,19 @@ class Descriptor(dbus.service.Object):
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
+    def invalidate(self):
+        self.properties = None
+        self.chrc.invalidate()
+
     def get_properties(self):
+        if self.properties is None:
+            self.properties = self.build_properties()
+        return self.properties
+
+    def build_properties(self):
         return {
                 GATT_DESC_IFACE: {
                         'Characteristic': self.chrc.get_path(),
@@ -403,7 +530,11 @@ class TestService(Service):
     def __init__(self, bus, index):
         Service.__init__(self, bus, index, self.TEST_SVC_UUID, True)
         self.add_characteristic(CharacteristicFFE3(bus, 0, self))
-        self.add_characteristic(CharacteristicFFE2(bus, 1, self))
+        self.add_characteristic(CharacteristicFFE2(bus, 1, self, ble_sessions[0]))
+        self.add_characteristic(CharacteristicFFE4(bus, 2, self))
+        # notify characteristics of the other session slots
+        for slot_session in ble_sessions[1:]:
+            self.add_characteristic(CharacteristicFFE2(bus, 2 + slot_session.slot, self, slot_session))
 
 class CharacteristicFFE3(Characteristic):
     """
@@ -422,37 +553,143 @@ class CharacteristicFFE3(Characteristic):
         self.value = []
 
     def WriteValue(self, value, options):
-        ble_frame_data.enqueue(value)
+        received = time.monotonic()
+        session = session_for(options)
+        if session is None:
+            log.warn_print('no free session for %s', options.get('device'))
+            raise FailedException('too many connections')
+        session.notify_batcher.observe_write(received)
+        session.writes.inc()
+        session.rx_bytes.inc(len(value))
+        if 'mtu' in options:
+            session.mtu = int(options['mtu'])
+        framed = session.detect_framing(value)
+        needed = session.decoder.count_messages(value) if framed else 1
+        if needed > session.rx_free():
+            # refused before the decoder consumed anything, the central can
+            # write the same value again later
+            session.refused_writes.inc()
+            log.warn_print('ble rx queue full')
+            raise FailedException('rx queue full')
+        try:
+            if not framed:
+                deliver_message(session, value, received)
+                return
+            for channel, message in session.decoder.feed_channels(value):
+                if channel == frame_codec.CHANNEL_LINK:
+                    handle_link_message(session, message)
+                    continue
+                deliver_message(session, message, received)
+        except RingBufferFullException:
+            log.warn_print('ble rx queue full')
+            raise FailedException('rx queue full')
 
 class CharacteristicFFE2(Characteristic):
     """
-    Dummy test characteristic. Allows writing arbitrary bytes to its value, and
-    contains "extended properties", as well as a test descriptor.
+    Notify characteristic of one session: FFE2 for slot 0, see
+    session.tx_uuid() for the others.
 
     """
-    TX_CHRC_UUID = '0000ffe2-0000-1000-8000-00805f9b34fb'
-
-    def __init__(self, bus, index, service):
+    def __init__(self, bus, index, service, session):
         Characteristic.__init__(
                 self, bus, index,
-                self.TX_CHRC_UUID,
+                session.tx_uuid(),
                 ['notify'],
                 service)
+        self.session = session
         self.notifying = False
+        self.notify_pending = False
+        self.hold_timer = None
+        session.tx_characteristic = self
 
     def notify_cb(self):
-        value = ble_frame_data.dequeue()
-        if value is not None:
-            valueData = []
-            for val in value:	
-                valueData.append(dbus.Byte(ord(val)))
-            self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': valueData }, [])
-        return self.notifying
+        self.notify_pending = False
+        more = True
+        try:
+            more = self.flush(NOTIFY_BUDGET)
+        except Exception as e:
+            # the value that failed is lost, the ones behind it still go out
+            log.error_print('notify failed: %s', e)
+        finally:
+            # more to send, continue on the next main loop iteration
+            self.notify_pending = more
+        return more
+
+    def flush(self, budget=None):
+        """
+        Notify up to budget values in channel schedule order, all pending
+        ones when budget is None. Returns True if values are left.
+
+        Fragments are packed into shared values by the session's
+        notify_batcher; a partly filled last value may be held back for a
+        few ms, a timer then flushes it.
+        """
+        session = self.session
+        fragment_size = frame_codec.mtu_to_fragment_size(session.mtu)
+        now = time.monotonic()
+        notified = 0
+        while self.notifying:
+            if budget is not None and notified >= budget:
+                return session.tx_scheduler.pending() or not session.notify_batcher.empty()
+            entry = session.tx_scheduler.next_fragment(fragment_size)
+            if entry is None:
+                break
+            value, sent = entry
+            if not session.notify_batcher.fits(value, fragment_size):
+                self.notify_batch(True)
+                notified += 1
+            session.notify_batcher.add(value, sent, now)
+            # without framing every value is a whole message
+            if session.notify_batcher.full(fragment_size) or not session.tx_scheduler.framing:
+                self.notify_batch()
+                notified += 1
+        if not self.notifying or session.notify_batcher.empty():
+            return False
+        hold = session.notify_batcher.hold(now)
+        if hold > 0:
+            self.hold_notify(hold)
+        else:
+            self.notify_batch()
+        return False
 
-    def update_notify_data(self):
-        if not self.notifying:
+    def notify_batch(self, more=False):
+        session = self.session
+        value, sent = session.notify_batcher.take(more)
+        self.notify_value(value)
+        now = time.monotonic()
+        for stamp in sent:
+            session.tx_messages.inc()
+            session.send_to_notify.observe(now - stamp)
+
+    def hold_notify(self, hold):
+        if self.hold_timer is not None:
+            return
+        self.hold_timer = GObject.timeout_add(max(1, int(hold * 1000)), self.hold_cb)
+
+    def hold_cb(self):
+        self.hold_timer = None
+        self.wake_notify()
+        return False
+
+    def notify_value(self, value):
+        self.session.notifications.inc()
+        self.session.tx_bytes.inc(len(value))
+        self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': dbus.ByteArray(value) }, [])
+
+    def wake_notify(self):
+        # Called from send() on any thread; idle_add is thread safe and wakes
+        # the GLib main loop, which then drains the whole TX queue at once.
+        if self.notify_pending:
             return
-        GObject.timeout_add(10, self.notify_cb)
+        self.notify_pending = True
+        GObject.idle_add(self.notify_cb)
+
+    def update_notify_data(self):
+        if self.notifying:
+            self.session.frame_data.set_send_callback(self.wake_notify)
+            self.wake_notify()
+        else:
+            self.session.frame_data.set_send_callback(None)
 
     def StartNotify(self):
         if self.notifying:
@@ -469,33 +706,188 @@ class CharacteristicFFE2(Characteristic):
         self.notifying = False
         self.update_notify_data()
 
+class CharacteristicFFE4(Characteristic):
+    """
+    Flow control state for centrals that poll instead of handling the
+    LINK_CREDIT notifications: rx_free(2) rx_credit(2) tx_credit(2), little
+    endian, tx_credit 0xFFFF while flow control is off, followed by the
+    session slot(1) of the reading central, see session.py.
+    """
+    CREDIT_CHRC_UUID = '0000ffe4-0000-1000-8000-00805f9b34fb'
+
+    def __init__(self, bus, index, service):
+        Characteristic.__init__(
+                self, bus, index,
+                self.CREDIT_CHRC_UUID,
+                ['read'],
+                service)
+
+    def ReadValue(self, options):
+        session = session_for(options)
+        if session is None:
+            raise FailedException('too many connections')
+        return dbus.ByteArray(session.flow_control.state() + bytes([session.slot]))
+
+def handle_link_message(session, message):
+    if not message:
+        return
+    if message[0] in (compression.LINK_COMPRESSION_OFFER, compression.LINK_COMPRESSION_SELECT):
+        reply = session.compression.handle(message)
+        if reply is not None:
+            session.send_link(reply)
+        return
+    if session.flow_control.handle(message) and session.tx_characteristic is not None:
+        # new credit, resume a stalled TX
+        session.tx_characteristic.wake_notify()
+
+class pending_message_class():
+    """
+    A message handed to the on_message() handlers. It holds an RX slot of
+    its session, and the central the credit for it, until the handlers
+    have returned and every done() from defer_message() has been called.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.epoch = session.epoch
+        self.count = 1
+        session.rx_pending += 1
+
+    def defer(self):
+        self.count += 1
+        return lambda: run_in_mainloop(self.release)
+
+    def release(self):
+        self.count -= 1
+        if self.count > 0 or self.session.epoch != self.epoch:
+            return
+        self.session.rx_pending -= 1
+        self.session.flow_control.rx_consumed(1)
+
+def deliver_message(session, message, received=None):
+    global current_session
+    global current_message
+    session.rx_messages.inc()
+    session.flow_control.rx_received()
+    if not message_handlers:
+        session.frame_data.enqueue(message, received)
+        return
+    pending = pending_message_class(session)
+    current_session = session
+    current_message = pending
+    try:
+        for handler in list(message_handlers):
+            try:
+                handler(message)
+            except Exception as e:
+                log.error_print('message handler failed: %s', e)
+    finally:
+        current_session = None
+        current_message = None
+    pending.release()
+
+def on_message(callback):
+    """
+    Register callback(message) to be called on the GLib main loop for every
+    received message. While any handler is registered messages are handed
+    to the handlers instead of being queued for recv(). Inside the handler
+    get_current_session() tells which central sent the message.
+
+    The message is taken as consumed when the handlers return, unless one
+    of them hands it on with defer_message().
+    """
+    if callback not in message_handlers:
+        message_handlers.append(callback)
+
+def remove_message_handler(callback):
+    if callback in message_handlers:
+        message_handlers.remove(callback)
+
+def defer_message():
+    """
+    Called by an on_message() handler that passes the message on to work
+    finishing later. The message keeps its RX slot, and the central gets
+    no credit back for it, until the returned done() has been called once,
+    from any thread, when that work is finished; so unfinished work counts
+    against the RX window instead of piling up without bound.
+    """
+    if current_message is None:
+        raise RuntimeError('defer_message() called outside of an on_message() handler')
+    return current_message.defer()
+
+def call_soon(callback, *args):
+    """
+    Run callback(*args) once on the GLib main loop, from any thread.
+    """
+    def idle_cb():
+        callback(*args)
+        return False
+    GObject.idle_add(idle_cb)
+
+def run_in_mainloop(callback, *args):
+    if in_mainloop_thread():
+        callback(*args)
+    else:
+        call_soon(callback, *args)
+
+def in_mainloop_thread():
+    return threading.get_ident() == mainloop_thread_ident
+
+def load_gobject():
+    global GObject
+    if GObject is None:
+        try:
+            from gi.repository import GObject as gobject_module
+        except ImportError:
+            import gobject as gobject_module
+        GObject = gobject_module
+    return GObject
+
+def startup_stage(name):
+    global startup_reported
+    timeline.mark(name)
+    if startup_reported:
+        return
+    if timeline.elapsed('gatt_registered') is not None and timeline.elapsed('advertising') is not None:
+        startup_reported = True
+        log.info_print('%s', timeline.report())
+
+def get_startup_timeline():
+    return timeline
+
 def register_app_cb():
     log.info_print('GATT application registered')
+    startup_stage('gatt_registered')
 
 
 def register_app_error_cb(error):
-    log.error_print('Failed to register application: ' + str(error))
+    log.error_print('Failed to register application: %s', error)
     mainloop.quit()
 
 def register_ad_cb():
     global advertisement_status
     log.info_print('registered Advertisement')
     advertisement_status = True
+    startup_stage('advertising')
+    # a central may have connected while the registration was pending
+    update_advertisement()
 
 def register_ad_error_cb(error):
     global ad_manager_interface
     global ble_advertisement
-    #log.error_print('Failed to register advertisement: ' + str(error))
-    print('Failed to register advertisement: ' + str(error))
+    log.error_print('Failed to register advertisement: %s', error)
     if str(error).find('AlreadyExists'):
         log.info_print('Unregister Advertisement')
         ad_manager_interface.UnregisterAdvertisement(ble_advertisement.get_path())
     advertisement_status = False
     mainloop.quit()
 
-def get_server_manager(bus):
+def get_managed_objects(bus):
     remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'), DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
+    return remote_om.GetManagedObjects()
+
+def get_server_manager(bus, objects=None):
+    if objects is None:
+        objects = get_managed_objects(bus)
 
     for o, props in objects.items():
         if GATT_MANAGER_IFACE in props.keys():
@@ -503,9 +895,9 @@ def get_server_manager(bus):
 
     return None
 
-def get_ad_manager(bus):
-    remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, '/'), DBUS_OM_IFACE)
-    objects = remote_om.GetManagedObjects()
+def get_ad_manager(bus, objects=None):
+    if objects is None:
+        objects = get_managed_objects(bus)
 
     for o, props in objects.items():
         if LE_ADVERTISING_MANAGER_IFACE in props.keys():
@@ -513,48 +905,206 @@ def get_ad_manager(bus):
 
     return None
 
-def get_ble_mac(bus):
-    p = os.popen('hciconfig')
-    data = p.read()
-    len = data.find('Address')
-    add = data[len+9:len+9+17]
-    dbaddr = add[0:2]+add[3:5]+add[6:8]+add[9:11]+add[12:14]+add[15:17]
-    return dbaddr
+def get_adapter(bus, objects=None):
+    """
+    Return (path, org.bluez.Adapter1 properties) of the adapter that can
+    advertise, (None, None) without one.
+    """
+    if objects is None:
+        objects = get_managed_objects(bus)
+
+    for o, props in objects.items():
+        if BLUEZ_ADAPTER_IFACE in props and LE_ADVERTISING_MANAGER_IFACE in props:
+            return o, props[BLUEZ_ADAPTER_IFACE]
 
-def set_ble_adv_inetval():
-    os.popen('sudo sh -c "echo 48 >/sys/kernel/debug/bluetooth/hci0/adv_min_interval"')
-    os.popen('sudo sh -c "echo 80 >/sys/kernel/debug/bluetooth/hci0/adv_max_interval"')
+    return None, None
 
-def get_connect_status():
+class bluez_backend_class():
+    """
+    The real BlueZ daemon on the system bus. See fake_bluez.py for a stand-in
+    that needs neither BlueZ nor a radio.
+    """
+    def get_bus(self):
+        return dbus.SystemBus()
+
+def update_advertisement():
     global ad_manager_interface
     global ble_advertisement
     global advertisement_status
     global ble_register
-    global bus
-    p = os.popen('hcitool con')
-    data = p.read()
-    len = data.find('> LE')
-    if len > 0:
+    # keep advertising until the connection limit is reached
+    if len(connected_devices) >= ble_max_connections:
         if ad_manager_interface and ble_advertisement and advertisement_status == True:
-            log.info_print("StartNotify UnregisterAdvertisement")
+            log.info_print("Connected UnregisterAdvertisement")
             ad_manager_interface.UnregisterAdvertisement(ble_advertisement.get_path())
             ble_advertisement.Release()
             advertisement_status = False
             ble_register = False
-        return True
     else:
         if ad_manager_interface and ble_advertisement and advertisement_status == False and ble_register == False:
-            log.info_print("StartNotify RegisterAdvertisement")
+            log.info_print("Disconnected RegisterAdvertisement")
             ble_register = True
             ad_manager_interface.RegisterAdvertisement(ble_advertisement.get_path(), {},
                                      reply_handler=register_ad_cb,
                                      error_handler=register_ad_error_cb)
-        return False
 
-def monitor():
-    while True:
-        get_connect_status()
-        time.sleep(0.001)
+def add_connect_status_callback(callback):
+    """
+    Register callback(device_path, connected), called from the GLib main loop
+    each time a central connects or disconnects.
+    """
+    if callback not in connect_status_callbacks:
+        connect_status_callbacks.append(callback)
+
+def remove_connect_status_callback(callback):
+    if callback in connect_status_callbacks:
+        connect_status_callbacks.remove(callback)
+
+def set_device_connected(device_path, connected):
+    if connected:
+        if device_path in connected_devices:
+            return
+        connected_devices.add(device_path)
+        ble_connects.inc()
+        session = free_session()
+        if session is None:
+            log.warn_print('%s connected, but all %d sessions are in use',
+                           device_path, len(ble_sessions))
+        else:
+            session.attach(str(device_path))
+    else:
+        if device_path not in connected_devices:
+            return
+        connected_devices.discard(device_path)
+        ble_disconnects.inc()
+        session = get_session(device_path)
+        if session is not None:
+            session.detach()
+            # hand the slot to a central that connected while all were taken
+            for waiting in connected_devices:
+                if get_session(waiting) is None:
+                    session.attach(str(waiting))
+                    break
+    log.info_print('%s connected: %s', device_path, connected)
+    update_advertisement()
+    for callback in list(connect_status_callbacks):
+        callback(device_path, connected)
+
+def device_properties_changed_cb(interface, changed, invalidated, path=None):
+    if interface != BLUEZ_DEVICE_IFACE:
+        return
+    if 'Connected' in changed:
+        set_device_connected(path, bool(changed['Connected']))
+
+def interfaces_added_cb(path, interfaces):
+    if BLUEZ_DEVICE_IFACE not in interfaces:
+        return
+    if bool(interfaces[BLUEZ_DEVICE_IFACE].get('Connected', False)):
+        set_device_connected(path, True)
+
+def interfaces_removed_cb(path, interfaces):
+    if BLUEZ_DEVICE_IFACE in interfaces:
+        set_device_connected(path, False)
+
+def get_connect_status():
+    return len(connected_devices) > 0
+
+def get_connection_count():
+    return len(connected_devices)
+
+def add_sessions(count):
+    """
+    Create session slots up to count; their notify characteristics must
+    exist before the GATT application is registered.
+    """
+    while len(ble_sessions) < count:
+        session = session_class(len(ble_sessions))
+        session.set_framing(ble_framing)
+        apply_notify_batching(session)
+        ble_sessions.append(session)
+
+def get_sessions():
+    return list(ble_sessions)
+
+def get_session(device_path):
+    """
+    The session of the central at device_path, None if it has none.
+    """
+    for session in ble_sessions:
+        if session.device_path == device_path:
+            return session
+    return None
+
+def free_session():
+    for session in ble_sessions:
+        if session.device_path is None:
+            return session
+    return None
+
+def get_current_session():
+    """
+    The session of the message the on_message() handlers are processing,
+    None outside of them.
+    """
+    return current_session
+
+def resolve_session(session=None):
+    if session is not None:
+        return session
+    if current_session is not None and in_mainloop_thread():
+        return current_session
+    return ble_sessions[0]
+
+def session_for(options):
+    """
+    The session of the central that made a GATT request, from its
+    options; None when the central got no session. Raises
+    FailedException when BlueZ does not say which central it is and
+    several are connected.
+    """
+    device = options.get('device')
+    if device is not None:
+        device = str(device)
+        session = get_session(device)
+        if session is None:
+            # the write may overtake the Connected signal
+            set_device_connected(device, True)
+            session = get_session(device)
+        return session
+    # older BlueZ does not tell which central it is
+    active = [session for session in ble_sessions if session.device_path is not None]
+    if len(active) > 1:
+        log.warn_print('request without device option, %d centrals connected', len(active))
+        raise FailedException('central unknown')
+    if active:
+        return active[0]
+    return ble_sessions[0]
+
+def monitor(bus, objects=None):
+    """
+    Track org.bluez.Device1 connection state from BlueZ signals instead of
+    polling 'hcitool con'. The handlers run on the GLib main loop thread.
+    objects is a GetManagedObjects() result to take the initial state from.
+    """
+    bus.add_signal_receiver(device_properties_changed_cb,
+                            bus_name=BLUEZ_SERVICE_NAME,
+                            dbus_interface=DBUS_PROP_IFACE,
+                            signal_name='PropertiesChanged',
+                            arg0=BLUEZ_DEVICE_IFACE,
+                            path_keyword='path')
+    bus.add_signal_receiver(interfaces_added_cb,
+                            bus_name=BLUEZ_SERVICE_NAME,
+                            dbus_interface=DBUS_OM_IFACE,
+                            signal_name='InterfacesAdded')
+    bus.add_signal_receiver(interfaces_removed_cb,
+                            bus_name=BLUEZ_SERVICE_NAME,
+                            dbus_interface=DBUS_OM_IFACE,
+                            signal_name='InterfacesRemoved')
+
+    if objects is None:
+        objects = get_managed_objects(bus)
+    for path, interfaces in objects.items():
+        interfaces_added_cb(path, interfaces)
 
 def bluetooth_exit():
     global ad_manager_interface    
@@ -567,35 +1117,93 @@ def bluetooth_exit():
 
 def loop():
     global mainloop
+    global mainloop_thread_ident
+    mainloop_thread_ident = threading.get_ident()
+    timeline.mark('mainloop')
     mainloop.run()
 
-def setup():
+def run():
+    """
+    Run the GLib main loop in the calling thread until it quits. Used with
+    setup(integrated=True), where connection tracking, GATT I/O and the
+    on_message() handlers all share this one loop.
+    """
+    loop()
+
+def setup(framing=True, integrated=False, backend=None, max_connections=1):
+    """
+    Start the GATT server. framing=False keeps the legacy wire format where
+    every ATT write and notification is one raw message. With framing on a
+    central whose first write is not framed is taken for a legacy client
+    and served in that format all the same, see session.detect_framing().
+
+    Up to max_connections centrals are served at once, each in a session
+    of its own (see session.py); advertising goes on until that many are
+    connected.
+
+    By default the GLib main loop runs in a daemon thread and the
+    application polls recv(). With integrated=True no thread is started and
+    the caller runs the loop itself with run(). Either way the connection
+    and advertisement state is only touched from the main loop thread.
+
+    backend defaults to bluez_backend_class(); pass a
+    fake_bluez.fake_bluez_class() to run without BlueZ.
+    """
     global mainloop
+    global ble_framing
     global ad_manager_interface
     global ble_advertisement
     global ble_server_start
     global ble_register
-    global monitor_thread
+    global bus
+    global ble_backend
+    global ble_max_connections
     ad_manager_interface = None
     ble_advertisement = None
     ble_register = False
-    set_ble_adv_inetval()
-    monitor_thread = threading.Thread(target=monitor, args=())
-    monitor_thread.setDaemon(True)
-    monitor_thread.start()
+    ble_framing = framing
+    ble_max_connections = max(1, max_connections)
+    add_sessions(ble_max_connections)
+    for session in ble_sessions:
+        session.set_framing(framing)
+    if backend is None:
+        backend = bluez_backend_class()
+    ble_backend = backend
+    timeline.mark('setup')
+
+    import dbus.mainloop.glib
+    load_gobject()
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
-    bus = dbus.SystemBus()
+    bus = ble_backend.get_bus()
+    timeline.mark('bus')
+
+    # one GetManagedObjects round trip for the managers, the adapter and
+    # the devices that are already connected
+    objects = get_managed_objects(bus)
+    timeline.mark('managed_objects')
 
-    server_manager = get_server_manager(bus)
+    server_manager = get_server_manager(bus, objects)
     if not server_manager:
         log.error_print('server manager interface not found')
         return
 
-    add_manager = get_ad_manager(bus)
+    add_manager = get_ad_manager(bus, objects)
     if not add_manager:
         log.error_print('add manager interface not found')
         return
+    # an experimental property as well, so it tells whether the interval is
+    # honoured
+    if 'SupportedCapabilities' not in objects[add_manager][LE_ADVERTISING_MANAGER_IFACE]:
+        log.warn_print('bluetoothd runs without --experimental, advertising interval %d-%d ms '
+                       'is ignored', ADV_MIN_INTERVAL, ADV_MAX_INTERVAL)
+
+    adapter_path, adapter = get_adapter(bus, objects)
+    if adapter is None:
+        log.error_print('adapter not found')
+        return
+    log.info_print('adapter %s %s powered: %s', adapter_path,
+                   adapter.get('Address'), bool(adapter.get('Powered', False)))
 
     service_manager_interface = dbus.Interface(
             bus.get_object(BLUEZ_SERVICE_NAME, server_manager),
@@ -606,29 +1214,118 @@ def setup():
             LE_ADVERTISING_MANAGER_IFACE)
 
     ble_app = BLEApplication(bus)
+    ble_advertisement = BLEAdvertisement(bus, 0, str(adapter.get('Address', '')))
     mainloop = GObject.MainLoop()
+    monitor(bus, objects)
+    timeline.mark('objects_exported')
 
+    # Both registrations are asynchronous, BlueZ processes them while the
+    # other one is still pending; the replies arrive on the main loop.
     log.info_print('Registering GATT application...')
-
     service_manager_interface.RegisterApplication(ble_app.get_path(), {},
                                     reply_handler=register_app_cb,
                                     error_handler=register_app_error_cb)
     log.info_print("Start BLEAdvertisement")
-    ble_advertisement = BLEAdvertisement(bus, 0)
+    update_advertisement()
+    timeline.mark('registration_sent')
 
-    mainloop_thread = threading.Thread(target=loop, args=())
-    mainloop_thread.setDaemon(True)
-    mainloop_thread.start()
+    if not integrated:
+        mainloop_thread = threading.Thread(target=loop, args=())
+        mainloop_thread.setDaemon(True)
+        mainloop_thread.start()
     ble_server_start = True
 
 def is_ble_server_start():
     global ble_server_start
     return ble_server_start
 
-def send(item):
-    ble_frame_data.send(item)
+def send(item, block=True, channel=None, session=None):
+    """
+    Queue item for notification. item may be bytes, bytearray, memoryview
+    or str (sent UTF-8 encoded). With block=False a full TX queue raises
+    RingBufferFullException instead of waiting.
+
+    session defaults to the sender of the message an on_message() handler
+    is processing, else to slot 0, the only one with a single central; see
+    get_sender() for replies sent later from other threads.
+
+    channel is 'control' (the default), 'telemetry' or 'bulk', see
+    session.TX_CHANNELS. Fragments of a heavier channel overtake those of
+    lighter ones, the order of messages within a channel is kept.
+
+    On the main loop thread send() must not wait for the notify path, which
+    runs on that same thread, so a full TX queue is flushed first and
+    RingBufferFullException is raised if it is still full.
+    """
+    session = resolve_session(session)
+    if in_mainloop_thread():
+        if session.frame_data.tx_full(channel) and session.tx_characteristic is not None:
+            session.tx_characteristic.flush()
+        session.frame_data.send(item, False, channel)
+        return
+    session.frame_data.send(item, block, channel)
+
+def get_sender(session=None):
+    """
+    Return send(item, block=True, channel=None) bound to the central now
+    attached to session (resolved as in send()). Messages sent after that
+    central disconnected are dropped, so a late reply never reaches the
+    next central in the slot.
+    """
+    session = resolve_session(session)
+    device_path = session.device_path
+
+    def send_to_session(item, block=True, channel=None):
+        if session.device_path != device_path:
+            log.info_print('dropping message for disconnected %s', device_path)
+            return
+        send(item, block, channel, session)
+    return send_to_session
+
+def get_notify_payload_size(session=None):
+    """
+    Longest message that fits in a single notification at the current MTU,
+    the size to coalesce small outputs to.
+    """
+    return resolve_session(session).notify_payload_size()
+
+def set_notify_batching(max_hold=None, hold_fraction=None, max_fragments=None, interval=None):
+    """
+    Tune how small messages share notifications, see notify_batcher.py.
+    max_hold is the longest a partly filled notification waits for more
+    messages in seconds (0 never waits), hold_fraction the share of the
+    connection interval it may wait, max_fragments the fragments packed
+    into one notification (1 disables packing) and interval the connection
+    interval assumed until one has been estimated.
+    """
+    limits = {'max_hold': max_hold, 'hold_fraction': hold_fraction,
+              'max_fragments': max_fragments, 'initial_interval': interval}
+    for name, value in limits.items():
+        if value is not None:
+            notify_batching[name] = value
+    for session in ble_sessions:
+        apply_notify_batching(session)
+
+def apply_notify_batching(session):
+    batcher = session.notify_batcher
+    for name, value in notify_batching.items():
+        setattr(batcher, name, value)
+    if 'initial_interval' in notify_batching:
+        batcher.interval = batcher.initial_interval
+
+def serve_metrics(address):
+    """
+    Publish the metrics registry on a Unix socket path or (host, port).
+    """
+    return metrics.registry.serve(address)
+
+def get_queue_stats(session=None):
+    return resolve_session(session).frame_data.stats()
+
+def recv(block=False, timeout=None, session=None):
+    value = resolve_session(session).frame_data.recv(block, timeout)
+    return value
 
-def recv():
-    value = ble_frame_data.recv()
-    return value   
+def recv_many(max_items=16, timeout=None, block=True, session=None):
+    return resolve_session(session).frame_data.recv_many(max_items, block, timeout)
 
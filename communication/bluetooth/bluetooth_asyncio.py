@@ -0,0 +1,106 @@
+import asyncio
+from communication.bluetooth import bluetooth
+from communication.ring_buffer import RingBufferFullException
+
+class async_bluetooth_class():
+    """
+    asyncio front-end for the bluetooth module. The GATT server keeps running
+    on its GLib thread; received messages and connection changes are handed
+    to the asyncio loop with call_soon_threadsafe().
+
+        ble = async_bluetooth_class()
+        await ble.start()
+        async for message in ble:
+            await ble.send(message)
+    """
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.messages = None
+        self.connected = None
+        self.disconnected = None
+        self.event_queues = []
+
+    async def start(self, framing=True):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.messages = asyncio.Queue()
+        self.connected = asyncio.Event()
+        self.disconnected = asyncio.Event()
+        bluetooth.on_message(self.message_cb)
+        bluetooth.add_connect_status_callback(self.connect_status_cb)
+        # setup() makes blocking D-Bus calls, keep them off the event loop
+        await self.loop.run_in_executor(None, bluetooth.setup, framing)
+        self.update_connect_status(None, bluetooth.get_connect_status())
+
+    def close(self):
+        bluetooth.remove_message_handler(self.message_cb)
+        bluetooth.remove_connect_status_callback(self.connect_status_cb)
+
+    def message_cb(self, message):
+        # GLib thread; the message holds its RX slot until it is taken
+        done = bluetooth.defer_message()
+        self.loop.call_soon_threadsafe(self.messages.put_nowait, (message, done))
+
+    def take(self, entry):
+        message, done = entry
+        done()
+        return message
+
+    def connect_status_cb(self, device_path, connected):
+        # GLib thread
+        self.loop.call_soon_threadsafe(self.update_connect_status, device_path, connected)
+
+    def update_connect_status(self, device_path, connected):
+        if bluetooth.get_connect_status():
+            self.connected.set()
+            self.disconnected.clear()
+        else:
+            self.connected.clear()
+            self.disconnected.set()
+        if device_path is None:
+            return
+        for queue in self.event_queues:
+            queue.put_nowait((device_path, connected))
+
+    async def recv(self):
+        return self.take(await self.messages.get())
+
+    def recv_nowait(self):
+        """
+        Return a pending message or None.
+        """
+        try:
+            return self.take(self.messages.get_nowait())
+        except asyncio.QueueEmpty:
+            return None
+
+    async def send(self, item, channel=None):
+        try:
+            bluetooth.send(item, False, channel)
+        except RingBufferFullException:
+            # wait for room on a worker thread instead of the event loop
+            await self.loop.run_in_executor(None, bluetooth.send, item, True, channel)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return self.take(await self.messages.get())
+
+    async def wait_connected(self):
+        await self.connected.wait()
+
+    async def wait_disconnected(self):
+        await self.disconnected.wait()
+
+    async def connection_events(self):
+        """
+        Async iterator of (device_path, connected) tuples.
+        """
+        queue = asyncio.Queue()
+        self.event_queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.event_queues.remove(queue)
@@ -0,0 +1,345 @@
+"""
+In-process stand-in for BlueZ, for benchmarks and tests on machines without
+a Bluetooth adapter or a system bus.
+
+fake_bus_class plays the D-Bus connection: the GATT objects of bluetooth.py
+export themselves on it exactly as on the system bus, and method calls into
+them are real dbus-python messages dispatched in-process, so argument
+marshalling (byte_arrays, signatures) behaves like on the device.
+fake_bluez_class plays org.bluez: it serves GetManagedObjects, GattManager1,
+LEAdvertisingManager1 and Adapter1, and acts as the central that connects,
+writes FFE3 and collects FFE2 notifications. Several centrals are played
+by passing device= to write() and the notify characteristic of their
+session slot to start_notify(), see session.py.
+
+    fake = fake_bluez_class()
+    bluetooth.setup(backend=fake)
+    device = fake.connect()
+    fake.start_notify()
+    fake.write(b'...')
+    value = fake.notifications.get()
+"""
+import queue
+import threading
+
+import dbus
+import dbus.exceptions
+import dbus.lowlevel
+import dbus.service
+try:
+  from gi.repository import GObject
+except ImportError:
+  import gobject as GObject
+
+from utils import log
+
+BLUEZ_SERVICE_NAME = 'org.bluez'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
+GATT_MANAGER_IFACE = 'org.bluez.GattManager1'
+LE_ADVERTISING_MANAGER_IFACE = 'org.bluez.LEAdvertisingManager1'
+LE_ADVERTISEMENT_IFACE = 'org.bluez.LEAdvertisement1'
+GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
+DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+
+ADAPTER_PATH = '/org/bluez/hci0'
+ADAPTER_ADDRESS = '00:1A:7D:DA:71:13'
+
+RX_CHRC_UUID = '0000ffe3-0000-1000-8000-00805f9b34fb'
+TX_CHRC_UUID = '0000ffe2-0000-1000-8000-00805f9b34fb'
+CREDIT_CHRC_UUID = '0000ffe4-0000-1000-8000-00805f9b34fb'
+
+class FakeBluezException(dbus.exceptions.DBusException):
+    _dbus_error_name = 'org.bluez.Error.Failed'
+
+class fake_method_class():
+    def __init__(self, bluez, path, interface, member):
+        self.bluez = bluez
+        self.path = path
+        self.interface = interface
+        self.member = member
+
+    def __call__(self, *args, **kwargs):
+        reply_handler = kwargs.pop('reply_handler', None)
+        error_handler = kwargs.pop('error_handler', None)
+        if reply_handler is None:
+            return self.bluez.handle_call(self.path, self.interface, self.member, args)
+
+        def idle_cb():
+            try:
+                result = self.bluez.handle_call(self.path, self.interface, self.member, args)
+            except dbus.exceptions.DBusException as e:
+                if error_handler is not None:
+                    error_handler(e)
+                return False
+            if result is None:
+                reply_handler()
+            else:
+                reply_handler(result)
+            return False
+        # replies are asynchronous on the real bus too
+        GObject.idle_add(idle_cb)
+
+class fake_proxy_class():
+    def __init__(self, bluez, path):
+        self.bluez = bluez
+        self.object_path = path
+
+    def get_dbus_method(self, member, dbus_interface=None):
+        return fake_method_class(self.bluez, self.object_path, dbus_interface, member)
+
+class fake_bus_class():
+    """
+    Just enough of dbus.connection.Connection for dbus.service.Object,
+    dbus.Interface and add_signal_receiver().
+    """
+    def __init__(self, bluez):
+        self.bluez = bluez
+        self.objects = {}
+        self.signal_receivers = []
+
+    # dbus.service.Object export hooks
+    def _register_object_path(self, path, on_message, on_unregister=None, fallback=False):
+        self.objects[str(path)] = on_message.__self__
+
+    def _unregister_object_path(self, path):
+        self.objects.pop(str(path), None)
+
+    def send_message(self, message):
+        if isinstance(message, dbus.lowlevel.SignalMessage):
+            self.bluez.handle_app_signal(message)
+
+    def get_object(self, bus_name, path):
+        return fake_proxy_class(self.bluez, path)
+
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None,
+                            bus_name=None, path=None, arg0=None,
+                            path_keyword=None, **keywords):
+        self.signal_receivers.append((handler, signal_name, dbus_interface,
+                                      path, arg0, path_keyword))
+
+    def emit_signal(self, path, interface, member, *args):
+        for handler, signal_name, dbus_interface, match_path, arg0, path_keyword in list(self.signal_receivers):
+            if signal_name is not None and signal_name != member:
+                continue
+            if dbus_interface is not None and dbus_interface != interface:
+                continue
+            if match_path is not None and match_path != path:
+                continue
+            if arg0 is not None and (not args or args[0] != arg0):
+                continue
+            if path_keyword is not None:
+                handler(*args, **{path_keyword: dbus.ObjectPath(path)})
+            else:
+                handler(*args)
+
+    def call_method(self, path, interface, member, signature=None, *args):
+        """
+        Call a method of an object exported on this bus and return its reply
+        arguments. Arguments and return values are marshalled through real
+        D-Bus messages, the same way dbus.service.Object._message_cb does.
+        """
+        obj = self.objects.get(str(path))
+        if obj is None:
+            raise FakeBluezException('no object at %s' % path)
+        candidate_method, parent_method = dbus.service._method_lookup(obj, member, interface)
+        message = dbus.lowlevel.MethodCallMessage(BLUEZ_SERVICE_NAME, path, interface, member)
+        if signature:
+            message.append(signature=signature, *args)
+        args = message.get_args_list(**parent_method._dbus_get_args_options)
+        retval = candidate_method(obj, *args)
+        out_signature = parent_method._dbus_out_signature
+        if not out_signature:
+            return None
+        reply = dbus.lowlevel.SignalMessage(path, interface, member)
+        reply.append(retval, signature=out_signature)
+        return reply.get_args_list(byte_arrays=True)
+
+class fake_bluez_class():
+    def __init__(self, address=ADAPTER_ADDRESS):
+        self.address = address
+        self.bus = fake_bus_class(self)
+        self.devices = {}
+        self.app_path = None
+        self.rx_chrc_path = None
+        self.tx_chrc_path = None
+        # characteristic UUID -> path of every characteristic registered
+        self.chrc_paths = {}
+        # notify characteristic UUID -> callback(value), besides FFE2
+        self.notify_callbacks = {}
+        self.advertisement_path = None
+        self.advertisement_properties = None
+        self.register_count = 0
+        self.notifications = queue.Queue()
+        self.notify_callback = None
+        self.mtu = 23
+
+    # backend interface used by bluetooth.setup()
+    def get_bus(self):
+        return self.bus
+
+    def is_advertising(self):
+        return self.advertisement_path is not None
+
+    # org.bluez side
+    def get_managed_objects(self):
+        objects = {
+                dbus.ObjectPath(ADAPTER_PATH): {
+                        ADAPTER_IFACE: {
+                                'Address': dbus.String(self.address),
+                                'Name': dbus.String('fake'),
+                                'Powered': dbus.Boolean(True),
+                        },
+                        GATT_MANAGER_IFACE: {},
+                        # as bluetoothd --experimental reports it
+                        LE_ADVERTISING_MANAGER_IFACE: {
+                                'ActiveInstances': dbus.Byte(0),
+                                'SupportedInstances': dbus.Byte(5),
+                                'SupportedCapabilities': {'MaxAdvLen': dbus.Byte(31)},
+                        },
+                },
+        }
+        for path, props in self.devices.items():
+            objects[dbus.ObjectPath(path)] = {DEVICE_IFACE: dict(props)}
+        return objects
+
+    def handle_call(self, path, interface, member, args):
+        if interface == DBUS_OM_IFACE and member == 'GetManagedObjects':
+            return self.get_managed_objects()
+        if interface == DBUS_PROP_IFACE and member == 'GetAll':
+            return self.get_managed_objects().get(path, {}).get(args[0], {})
+        if interface == GATT_MANAGER_IFACE:
+            if member == 'RegisterApplication':
+                return self.register_application(args[0])
+            if member == 'UnregisterApplication':
+                self.app_path = None
+                return None
+        if interface == LE_ADVERTISING_MANAGER_IFACE:
+            if member == 'RegisterAdvertisement':
+                return self.register_advertisement(args[0])
+            if member == 'UnregisterAdvertisement':
+                if self.advertisement_path != args[0]:
+                    raise FakeBluezException('DoesNotExist')
+                self.advertisement_path = None
+                return None
+        raise FakeBluezException('%s.%s not supported on %s' % (interface, member, path))
+
+    def register_application(self, app_path):
+        objects = self.bus.call_method(app_path, DBUS_OM_IFACE, 'GetManagedObjects')[0]
+        for path, interfaces in objects.items():
+            chrc = interfaces.get(GATT_CHRC_IFACE)
+            if chrc is None:
+                continue
+            self.chrc_paths[str(chrc['UUID'])] = path
+            if chrc['UUID'] == RX_CHRC_UUID:
+                self.rx_chrc_path = path
+            elif chrc['UUID'] == TX_CHRC_UUID:
+                self.tx_chrc_path = path
+        self.app_path = app_path
+        log.info_print('fake bluez: application %s registered', app_path)
+        return None
+
+    def register_advertisement(self, path):
+        if self.advertisement_path is not None:
+            raise FakeBluezException('AlreadyExists')
+        self.advertisement_properties = self.bus.call_method(
+                path, DBUS_PROP_IFACE, 'GetAll', 's', LE_ADVERTISEMENT_IFACE)[0]
+        self.advertisement_path = path
+        self.register_count += 1
+        return None
+
+    def handle_app_signal(self, message):
+        if message.get_member() != 'PropertiesChanged':
+            return
+        path = message.get_path()
+        if path == self.tx_chrc_path:
+            callback = self.notify_callback or self.notifications.put
+        else:
+            callback = None
+            for uuid, chrc_path in self.chrc_paths.items():
+                if chrc_path == path:
+                    callback = self.notify_callbacks.get(uuid)
+            if callback is None:
+                return
+        interface, changed, invalidated = message.get_args_list(byte_arrays=True)
+        if interface != GATT_CHRC_IFACE or 'Value' not in changed:
+            return
+        callback(bytes(changed['Value']))
+
+    # central side; all of these may be called from any thread
+    def run_in_loop(self, func, *args):
+        """
+        Run func(*args) on the GLib main loop and wait for its result.
+        """
+        from communication.bluetooth import bluetooth
+        if bluetooth.mainloop_thread_ident is None or bluetooth.in_mainloop_thread():
+            return func(*args)
+        done = threading.Event()
+        result = []
+
+        def idle_cb():
+            try:
+                result.append((func(*args), None))
+            except Exception as e:
+                result.append((None, e))
+            done.set()
+            return False
+        GObject.idle_add(idle_cb)
+        done.wait()
+        value, error = result[0]
+        if error is not None:
+            raise error
+        return value
+
+    def connect(self, address='11:22:33:44:55:66'):
+        path = '%s/dev_%s' % (ADAPTER_PATH, address.replace(':', '_'))
+
+        def connect_cb():
+            props = {'Address': dbus.String(address), 'Connected': dbus.Boolean(True)}
+            self.devices[path] = props
+            self.bus.emit_signal('/', DBUS_OM_IFACE, 'InterfacesAdded',
+                                 dbus.ObjectPath(path), {DEVICE_IFACE: props})
+        self.run_in_loop(connect_cb)
+        return path
+
+    def disconnect(self, path):
+        def disconnect_cb():
+            props = self.devices.pop(path, None)
+            if props is None:
+                return
+            self.bus.emit_signal(path, DBUS_PROP_IFACE, 'PropertiesChanged',
+                                 DEVICE_IFACE, {'Connected': dbus.Boolean(False)}, [])
+            self.bus.emit_signal('/', DBUS_OM_IFACE, 'InterfacesRemoved',
+                                 dbus.ObjectPath(path), [DEVICE_IFACE])
+        self.run_in_loop(disconnect_cb)
+
+    def start_notify(self, uuid=TX_CHRC_UUID):
+        self.run_in_loop(self.bus.call_method, self.chrc_paths[uuid], GATT_CHRC_IFACE, 'StartNotify')
+
+    def stop_notify(self, uuid=TX_CHRC_UUID):
+        self.run_in_loop(self.bus.call_method, self.chrc_paths[uuid], GATT_CHRC_IFACE, 'StopNotify')
+
+    def read(self, uuid=CREDIT_CHRC_UUID, device=None):
+        """
+        ReadValue of a characteristic, returns bytes.
+        """
+        options = {}
+        if device is not None:
+            options['device'] = dbus.ObjectPath(device)
+        value = self.run_in_loop(self.bus.call_method, self.chrc_paths[uuid], GATT_CHRC_IFACE,
+                                 'ReadValue', 'a{sv}', options)
+        return bytes(value[0])
+
+    def write(self, value, device=None, mtu=None):
+        """
+        Deliver one ATT write to FFE3. Raises DBusException when the server
+        refuses the write.
+        """
+        if mtu is not None:
+            self.mtu = mtu
+        options = {'mtu': dbus.UInt16(self.mtu)}
+        if device is not None:
+            options['device'] = dbus.ObjectPath(device)
+        self.run_in_loop(self.bus.call_method, self.rx_chrc_path, GATT_CHRC_IFACE,
+                         'WriteValue', 'aya{sv}', dbus.ByteArray(value), options)
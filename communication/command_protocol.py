@@ -0,0 +1,440 @@
+"""
+Request/response messages carried over bluetooth.send()/recv().
+
+Every message starts with type(1) and request id(2, little endian). The id
+is chosen by the client and echoed in all responses, so several requests can
+be in flight and their responses may arrive in any order.
+
+    MSG_REQUEST  id  command (utf-8 shell string)
+    MSG_STDOUT   id  chunk of stdout
+    MSG_STDERR   id  chunk of stderr
+    MSG_EXIT     id  status(1) exit_code(4, signed)   last message of a request
+    MSG_CALL     id  opcode(2) arguments (struct packed, see the registry)
+    MSG_RESULT   id  status(1) result (struct packed)
+    MSG_STREAM   id  command (utf-8 shell string)
+
+MSG_STREAM is MSG_REQUEST with the output sent while the command runs:
+MSG_STDOUT/MSG_STDERR chunks as the command writes them, coalesced up to
+the size of one notification, and MSG_EXIT at the end. Nothing but the
+current chunk is held in memory.
+
+MSG_CALL runs an in-process handler looked up by opcode in an
+opcode_registry_class, without spawning anything, and is answered with a
+single MSG_RESULT. OP_SHELL is the fallback: its argument is a shell string
+and it is answered like MSG_REQUEST.
+
+Types 0x10-0x13 are the file transfer messages of file_transfer.py.
+
+Legacy clients send bare shell strings. Those start with a printable
+character, the message types are all control characters, so both can share
+the link.
+"""
+import os
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from utils import log
+
+MSG_REQUEST = 0x01
+MSG_STDOUT = 0x02
+MSG_STDERR = 0x03
+MSG_EXIT = 0x04
+MSG_CALL = 0x05
+MSG_RESULT = 0x06
+MSG_STREAM = 0x07
+
+STATUS_OK = 0
+STATUS_TIMEOUT = 1
+STATUS_ERROR = 2
+# 3 is STATUS_IO_ERROR of file_transfer.py
+STATUS_UNKNOWN_OPCODE = 4
+STATUS_BAD_ARGS = 5
+
+OP_SHELL = 0x0000
+OP_PING = 0x0001
+OP_STATUS = 0x0002
+
+HEADER = struct.Struct('<BH')
+EXIT = struct.Struct('<Bi')
+OPCODE = struct.Struct('<H')
+RESULT = struct.Struct('<B')
+
+OUTPUT_CHUNK_SIZE = 1024
+# a partial streamed chunk is sent after waiting this long for more output
+STREAM_DELAY = 0.02
+
+def is_protocol_message(data):
+    return len(data) >= HEADER.size and data[0] < 0x20
+
+def encode(msg_type, request_id, body=b''):
+    return HEADER.pack(msg_type, request_id & 0xFFFF) + body
+
+def decode(data):
+    """
+    Split a message into (type, request id, body memoryview).
+    """
+    view = memoryview(data)
+    msg_type, request_id = HEADER.unpack_from(view)
+    return msg_type, request_id, view[HEADER.size:]
+
+def encode_exit(request_id, status, exit_code):
+    return encode(MSG_EXIT, request_id, EXIT.pack(status, exit_code))
+
+def decode_exit(body):
+    return EXIT.unpack_from(body)
+
+def encode_call(request_id, opcode, arguments=b''):
+    return encode(MSG_CALL, request_id, OPCODE.pack(opcode) + arguments)
+
+def encode_result(request_id, status, result=b''):
+    return encode(MSG_RESULT, request_id, RESULT.pack(status) + result)
+
+class opcode_handler_class():
+    def __init__(self, opcode, function, arguments, result, tail, deferred):
+        self.opcode = opcode
+        self.function = function
+        self.arguments = struct.Struct(arguments)
+        self.result = struct.Struct(result) if result is not None else None
+        self.tail = tail
+        self.deferred = deferred
+
+class opcode_registry_class():
+    """
+    Opcode -> handler table. Argument and result formats are compiled to
+    struct.Struct once at registration, dispatch is a dict lookup plus one
+    unpack and one pack.
+
+        @registry.handler(OP_PING, '<I', '<I')
+        def ping(value):
+            return value
+
+    arguments is a struct format for the fixed arguments; with tail=True the
+    rest of the body is passed as a last bytes argument. result is a struct
+    format for the returned value (a tuple for several fields), or None
+    when the handler returns bytes itself. Handlers run on the bluetooth
+    main loop and must not block; a deferred handler gets a reply(status,
+    result) callable as first argument instead and answers later.
+    """
+    def __init__(self):
+        self.table = {}
+
+    def register(self, opcode, function, arguments='<', result=None, tail=False, deferred=False):
+        self.table[opcode] = opcode_handler_class(opcode, function, arguments, result, tail, deferred)
+
+    def handler(self, opcode, arguments='<', result=None, tail=False, deferred=False):
+        def decorator(function):
+            self.register(opcode, function, arguments, result, tail, deferred)
+            return function
+        return decorator
+
+    def dispatch(self, body, reply):
+        """
+        Run the handler for a MSG_CALL body, reply(status, result bytes) is
+        called once with the outcome.
+        """
+        if len(body) < OPCODE.size:
+            reply(STATUS_BAD_ARGS, b'')
+            return
+        opcode = OPCODE.unpack_from(body)[0]
+        entry = self.table.get(opcode)
+        if entry is None:
+            reply(STATUS_UNKNOWN_OPCODE, b'')
+            return
+        size = OPCODE.size + entry.arguments.size
+        if len(body) < size or (len(body) != size and not entry.tail):
+            reply(STATUS_BAD_ARGS, b'')
+            return
+        arguments = entry.arguments.unpack_from(body, OPCODE.size)
+        if entry.tail:
+            arguments += (bytes(body[size:]),)
+        if entry.deferred:
+            answered = []
+
+            def reply_once(status, result):
+                answered.append(status)
+                reply(status, result)
+            try:
+                entry.function(reply_once, *arguments)
+            except Exception as e:
+                log.error_print('opcode 0x%04x failed: %s', opcode, e)
+                if not answered:
+                    reply(STATUS_ERROR, str(e).encode('utf-8', 'replace'))
+            return
+        try:
+            value = entry.function(*arguments)
+        except Exception as e:
+            log.error_print('opcode 0x%04x failed: %s', opcode, e)
+            reply(STATUS_ERROR, str(e).encode('utf-8', 'replace'))
+            return
+        if entry.result is None:
+            reply(STATUS_OK, value or b'')
+        elif isinstance(value, tuple):
+            reply(STATUS_OK, entry.result.pack(*value))
+        else:
+            reply(STATUS_OK, entry.result.pack(value))
+
+registry = opcode_registry_class()
+started = time.monotonic()
+
+@registry.handler(OP_PING, '<I', '<I')
+def ping(value):
+    return value
+
+@registry.handler(OP_STATUS, '<', '<ddf')
+def status():
+    """
+    (system uptime s, service uptime s, 1 minute load average)
+    """
+    with open('/proc/uptime') as f:
+        uptime = float(f.read().split()[0])
+    return uptime, time.monotonic() - started, os.getloadavg()[0]
+
+class output_stream_class():
+    """
+    Sends the output of one MSG_STREAM request as it arrives. Output is
+    coalesced into messages of size() bytes (an int or a callable, e.g. the
+    payload of one notification at the current MTU), a partial message goes
+    out after delay seconds without more output; one flusher thread per
+    stream sees to that until close(). send() may block, which then holds
+    the command up instead of buffering its output.
+    """
+    def __init__(self, send, request_id, size, delay=STREAM_DELAY):
+        self.send = send
+        self.request_id = request_id
+        self.size = size
+        self.delay = delay
+        self.buffers = {MSG_STDOUT: bytearray(), MSG_STDERR: bytearray()}
+        self.condition = threading.Condition()
+        # when the oldest output still buffered arrived, None when empty
+        self.pending = None
+        self.closed = False
+        self.dropped = 0
+        self.flusher = threading.Thread(target=self.flush_loop)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def limit(self):
+        size = self.size() if callable(self.size) else self.size
+        return max(1, size - HEADER.size)
+
+    def write(self, stream, data):
+        msg_type = MSG_STDOUT if stream == 'stdout' else MSG_STDERR
+        with self.condition:
+            buffer = self.buffers[msg_type]
+            buffer += data
+            limit = self.limit()
+            while len(buffer) >= limit:
+                self.emit(msg_type, buffer[:limit])
+                del buffer[:limit]
+            if not any(self.buffers.values()):
+                self.pending = None
+            elif self.pending is None:
+                self.pending = time.monotonic()
+                self.condition.notify()
+
+    def emit(self, msg_type, data):
+        try:
+            self.send(encode(msg_type, self.request_id, bytes(data)))
+        except Exception as e:
+            self.dropped += len(data)
+            log.warn_print('stream %d: output dropped: %s', self.request_id, e)
+
+    def flush_loop(self):
+        with self.condition:
+            while not self.closed:
+                if self.pending is None:
+                    self.condition.wait()
+                    continue
+                remaining = self.pending + self.delay - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                self.flush_locked()
+
+    def flush_locked(self):
+        self.pending = None
+        for msg_type, buffer in self.buffers.items():
+            if buffer:
+                self.emit(msg_type, buffer)
+                del buffer[:]
+
+    def flush(self):
+        with self.condition:
+            self.flush_locked()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            self.flush_locked()
+
+class request_server_class():
+    """
+    Runs MSG_REQUEST commands on a command_executor_class and sends the
+    tagged output and exit status back through send(). MSG_CALL is
+    dispatched through registry, OP_SHELL there falls back to the executor.
+    MSG_STREAM output is coalesced to stream_size, see output_stream_class.
+    """
+    def __init__(self, executor, send, chunk_size=OUTPUT_CHUNK_SIZE, registry=registry,
+                 stream_size=OUTPUT_CHUNK_SIZE):
+        self.executor = executor
+        self.send = send
+        self.chunk_size = chunk_size
+        self.registry = registry
+        self.stream_size = stream_size
+
+    def handle(self, data, done=None):
+        """
+        done(), when given, is called once the request has been answered.
+        """
+        if done is None:
+            done = lambda: None
+        msg_type, request_id, body = decode(data)
+        if msg_type == MSG_CALL:
+            if len(body) >= OPCODE.size and OPCODE.unpack_from(body)[0] == OP_SHELL:
+                self.run(request_id, bytes(body[OPCODE.size:]), done)
+                return
+            def reply(status, result):
+                try:
+                    self.send(encode_result(request_id, status, result))
+                finally:
+                    done()
+            self.registry.dispatch(body, reply)
+            return
+        if msg_type == MSG_STREAM:
+            self.stream(request_id, bytes(body), done)
+            return
+        if msg_type != MSG_REQUEST:
+            log.warn_print('unexpected message type 0x%02x', msg_type)
+            done()
+            return
+        self.run(request_id, bytes(body), done)
+
+    def stream(self, request_id, command, done=None):
+        command = command.decode('utf-8', 'replace')
+        output = output_stream_class(self.send, request_id, self.stream_size)
+
+        def finished(result):
+            try:
+                output.close()
+                self.reply(request_id, result)
+            finally:
+                if done is not None:
+                    done()
+        self.executor.submit(command, finished, on_output=output.write)
+
+    def run(self, request_id, command, done=None):
+        command = command.decode('utf-8', 'replace')
+
+        def finished(result):
+            try:
+                self.reply(request_id, result)
+            finally:
+                if done is not None:
+                    done()
+        self.executor.submit(command, finished)
+
+    def send_output(self, msg_type, request_id, output):
+        view = memoryview(output)
+        for pos in range(0, len(view), self.chunk_size):
+            self.send(encode(msg_type, request_id, view[pos:pos + self.chunk_size]))
+
+    def reply(self, request_id, result):
+        self.send_output(MSG_STDOUT, request_id, result.stdout)
+        self.send_output(MSG_STDERR, request_id, result.stderr)
+        if result.timed_out:
+            self.send(encode_exit(request_id, STATUS_TIMEOUT, -1))
+        elif result.exit_code is None:
+            self.send(encode_exit(request_id, STATUS_ERROR, -1))
+        else:
+            self.send(encode_exit(request_id, STATUS_OK, result.exit_code))
+
+class response_class():
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self.status = None
+        self.exit_code = None
+        # packed MSG_RESULT value of a call()
+        self.result = None
+        # on_output(msg_type, data) of a stream(), instead of collecting
+        self.on_output = None
+
+class request_client_class():
+    """
+    Client side of the protocol: request() and call() return a Future
+    resolved with a response_class once MSG_EXIT or MSG_RESULT for its id
+    arrives. handle() must be fed every received message.
+    """
+    def __init__(self, send):
+        self.send = send
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {}
+
+    def request(self, command):
+        if isinstance(command, str):
+            command = command.encode('utf-8')
+        return self.submit(MSG_REQUEST, command)
+
+    def stream(self, command, on_output=None):
+        """
+        Like request(), with the output sent while the command runs. With
+        on_output(msg_type, data) every MSG_STDOUT/MSG_STDERR chunk is
+        passed on as it arrives (from handle()) instead of being collected
+        in the response.
+        """
+        if isinstance(command, str):
+            command = command.encode('utf-8')
+        return self.submit(MSG_STREAM, command, on_output)
+
+    def call(self, opcode, arguments=b''):
+        """
+        Send MSG_CALL; arguments are already struct packed.
+        """
+        return self.submit(MSG_CALL, OPCODE.pack(opcode) + arguments)
+
+    def submit(self, msg_type, body, on_output=None):
+        future = Future()
+        with self.lock:
+            if len(self.pending) >= 0x10000:
+                raise RuntimeError('too many requests in flight')
+            while self.next_id in self.pending:
+                self.next_id = (self.next_id + 1) & 0xFFFF
+            request_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFF
+            response = response_class(request_id)
+            response.on_output = on_output
+            self.pending[request_id] = (response, future)
+        self.send(encode(msg_type, request_id, body))
+        return future
+
+    def handle(self, data):
+        msg_type, request_id, body = decode(data)
+        with self.lock:
+            entry = self.pending.get(request_id)
+            if entry is None:
+                log.warn_print('response for unknown request %d', request_id)
+                return
+            response, future = entry
+            if msg_type in (MSG_STDOUT, MSG_STDERR) and response.on_output is not None:
+                pass
+            elif msg_type == MSG_STDOUT:
+                response.stdout += body
+            elif msg_type == MSG_STDERR:
+                response.stderr += body
+            elif msg_type == MSG_EXIT:
+                response.status, response.exit_code = decode_exit(body)
+                del self.pending[request_id]
+            elif msg_type == MSG_RESULT:
+                response.status = RESULT.unpack_from(body)[0]
+                response.result = bytes(body[RESULT.size:])
+                del self.pending[request_id]
+            else:
+                return
+        if msg_type in (MSG_STDOUT, MSG_STDERR) and response.on_output is not None:
+            response.on_output(msg_type, bytes(body))
+        elif msg_type in (MSG_EXIT, MSG_RESULT):
+            future.set_result(response)
@@ -0,0 +1,156 @@
+"""
+Per message compression, negotiated per connection over the link channel.
+
+The central offers the codecs it supports, the server picks one and
+answers with it:
+
+    LINK_COMPRESSION_OFFER   codecs(1)   bit mask of CODEC_*
+    LINK_COMPRESSION_SELECT  codec(1)    CODEC_*, 0 for none
+
+From then on either side may compress a message of at least threshold
+bytes. A compressed message has FLAG_COMPRESSED on its START fragment and
+starts with the codec id:
+
+    codec(1) compressed data
+
+zlib is raw deflate with PRESET_DICTIONARY, lz4 is an lz4 block with the
+same dictionary; it is offered only when the lz4 module is installed. A
+message is sent uncompressed when compression does not make it smaller.
+"""
+import struct
+import zlib
+from utils import log
+try:
+    import lz4.block
+    DECOMPRESS_ERRORS = (zlib.error, lz4.block.LZ4BlockError)
+except ImportError:
+    lz4 = None
+    DECOMPRESS_ERRORS = (zlib.error,)
+
+# link message types, LINK_CREDIT (flow_control.py) is 0x01
+LINK_COMPRESSION_OFFER = 0x02
+LINK_COMPRESSION_SELECT = 0x03
+
+CODEC_ZLIB = 0x01
+CODEC_LZ4 = 0x02
+
+NEGOTIATE = struct.Struct('<BB')
+
+DEFAULT_THRESHOLD = 32
+MAX_MESSAGE_SIZE = 0xFFFF
+
+# Words of our command and status traffic. deflate finds matches closest
+# to the end of the dictionary cheapest, so the most common come last.
+PRESET_DICTIONARY = (
+        b'/dev/null /etc/ /tmp/ /var/log/ /usr/bin/ /home/pi/GeekProject/ '
+        b'ifconfig iwconfig hciconfig hcitool reboot shutdown -h now '
+        b'raspi-config vcgencmd measure_temp get_throttled uptime free -m df -h '
+        b'ps aux | grep kill -9 pkill nohup & wget curl -s http:// https:// '
+        b'chmod +x chown mkdir -p rm -rf mv cp tar -xzf unzip '
+        b'pip3 install python3 main.py systemctl restart stop start status enable '
+        b'sudo ls -la cat echo '
+        b'No such file or directory Permission denied command not found '
+        b'total drwxr-xr-x -rw-r--r-- 1 pi pi root root '
+        b'"version": "name": "value": "error": "message": "result": '
+        b'"battery": "voltage": "temperature": "connected": true, false, null, '
+        b'"status": "ok", '
+)
+
+def available_codecs():
+    codecs = CODEC_ZLIB
+    if lz4 is not None:
+        codecs |= CODEC_LZ4
+    return codecs
+
+class compression_class():
+    """
+    Compression state of one connection. preference lists the codecs the
+    server picks from, best first; dictionary None compresses without one,
+    both sides must agree on it.
+    """
+    def __init__(self, threshold=DEFAULT_THRESHOLD, dictionary=PRESET_DICTIONARY,
+                 level=6, preference=(CODEC_ZLIB, CODEC_LZ4)):
+        self.threshold = threshold
+        self.dictionary = dictionary
+        self.level = level
+        self.preference = preference
+        self.codecs = available_codecs()
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.reset()
+
+    def reset(self):
+        self.codec = None
+
+    def offer(self):
+        """
+        Client side: the link message proposing our codecs.
+        """
+        return NEGOTIATE.pack(LINK_COMPRESSION_OFFER, self.codecs)
+
+    def handle(self, message):
+        """
+        Process a compression link message from the peer. Returns the
+        answer to send back, or None.
+        """
+        if len(message) < NEGOTIATE.size:
+            return None
+        kind, codecs = NEGOTIATE.unpack_from(message)
+        codecs &= self.codecs
+        if kind == LINK_COMPRESSION_SELECT:
+            self.codec = codecs or None
+            return None
+        self.codec = None
+        for codec in self.preference:
+            if codecs & codec:
+                self.codec = codec
+                break
+        log.info_print('compression codec %s', self.codec)
+        return NEGOTIATE.pack(LINK_COMPRESSION_SELECT, self.codec or 0)
+
+    def compress(self, payload):
+        """
+        Return (compressed, data): data starts with the codec id when
+        compressed is True, else it is payload unchanged.
+        """
+        if self.codec is None or len(payload) < self.threshold:
+            return False, payload
+        if self.codec == CODEC_ZLIB:
+            if self.dictionary is None:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            else:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, 9,
+                                              zlib.Z_DEFAULT_STRATEGY, self.dictionary)
+            data = compressor.compress(payload) + compressor.flush()
+        else:
+            data = lz4.block.compress(bytes(payload), store_size=False, dict=self.dictionary)
+        if len(data) + 1 >= len(payload):
+            return False, payload
+        self.uncompressed_bytes += len(payload)
+        self.compressed_bytes += len(data) + 1
+        return True, bytes([self.codec]) + data
+
+    def decompress(self, data):
+        """
+        Undo compress(); raises ValueError on corrupt data or an unknown
+        codec.
+        """
+        if not data:
+            raise ValueError('empty compressed message')
+        codec = data[0]
+        try:
+            if codec == CODEC_ZLIB:
+                if self.dictionary is None:
+                    decompressor = zlib.decompressobj(-15)
+                else:
+                    decompressor = zlib.decompressobj(-15, self.dictionary)
+                message = decompressor.decompress(data[1:], MAX_MESSAGE_SIZE)
+                if decompressor.unconsumed_tail or not decompressor.eof:
+                    raise ValueError('bad zlib message')
+                return message
+            if codec == CODEC_LZ4 and lz4 is not None:
+                return lz4.block.decompress(bytes(data[1:]), uncompressed_size=MAX_MESSAGE_SIZE,
+                                            dict=self.dictionary)
+        except DECOMPRESS_ERRORS as e:
+            raise ValueError(str(e))
+        raise ValueError('unknown codec %d' % codec)
@@ -0,0 +1,481 @@
+"""
+Chunked, resumable file upload carried over bluetooth.send()/recv(), next to
+the command protocol (same type(1) id(2) header, id = transfer id).
+
+    MSG_FILE_OPEN   id  size(8) chunk_size(2) sha256(32) path (utf-8)
+    MSG_FILE_CHUNK  id  index(4) data
+    MSG_FILE_ACK    id  status(1) window(2) base(4) bitmap
+    MSG_FILE_DONE   id  status(1)
+
+The client opens a transfer, the server answers with an ACK: base is the
+first chunk it is missing, bit n of bitmap (LSB first) is set when chunk
+base + n is already on disk. The client then keeps up to window chunks in
+flight; every window / 2 chunks the server acks again, and a chunk the
+client sent that is missing below the highest acked one was lost and is
+sent again. OPEN may be repeated at any time to ask for the current state,
+the client does that after a timeout.
+
+Chunks are written to <path>.part at their offset as they arrive, the set of
+received chunks is kept in <path>.part.state, so a transfer interrupted by a
+disconnect (or a restart) resumes where it stopped when the same file is
+opened again. The SHA-256 is computed while the contiguous prefix grows;
+when it matches the part file replaces path and DONE is sent with
+STATUS_OK, on a mismatch the partial file is discarded and DONE carries
+STATUS_ERROR. An OPEN over MAX_FILE_SIZE or MAX_CHUNKS is answered with
+DONE and STATUS_IO_ERROR.
+"""
+import hashlib
+import os
+import queue
+import struct
+import threading
+from communication import command_protocol
+from communication.command_protocol import STATUS_OK, STATUS_ERROR
+from utils import log
+
+MSG_FILE_OPEN = 0x10
+MSG_FILE_CHUNK = 0x11
+MSG_FILE_ACK = 0x12
+MSG_FILE_DONE = 0x13
+
+STATUS_IO_ERROR = 3
+
+OPEN = struct.Struct('<QH32s')
+CHUNK = struct.Struct('<I')
+ACK = struct.Struct('<BHI')
+DONE = struct.Struct('<B')
+STATE = struct.Struct('<4sQH32s')
+STATE_MAGIC = b'GPFT'
+
+DEFAULT_CHUNK_SIZE = 1024
+DEFAULT_WINDOW = 16
+# bitmap bytes in one ACK, chunks past it count as missing
+MAX_BITMAP = 256
+MAX_TRANSFERS = 4
+# larger uploads are refused, as are ones with more chunks, which would
+# need a bitmap of more than 128 KiB
+MAX_FILE_SIZE = 1 << 30
+MAX_CHUNKS = 1 << 20
+HASH_BLOCK = 64 * 1024
+
+def is_file_message(data):
+    return (command_protocol.is_protocol_message(data) and
+            MSG_FILE_OPEN <= data[0] <= MSG_FILE_DONE)
+
+def chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+def encode_open(transfer_id, path, size, chunk_size, digest):
+    return command_protocol.encode(MSG_FILE_OPEN, transfer_id,
+                                   OPEN.pack(size, chunk_size, digest) + path.encode('utf-8'))
+
+def encode_chunk(transfer_id, index, data):
+    return command_protocol.encode(MSG_FILE_CHUNK, transfer_id, CHUNK.pack(index) + data)
+
+def encode_ack(transfer_id, status, window, base, bitmap=b''):
+    return command_protocol.encode(MSG_FILE_ACK, transfer_id,
+                                   ACK.pack(status, window, base) + bitmap)
+
+def encode_done(transfer_id, status):
+    return command_protocol.encode(MSG_FILE_DONE, transfer_id, DONE.pack(status))
+
+class file_receiver_class():
+    """
+    One upload in progress on the server side.
+    """
+    def __init__(self, path, size, chunk_size, digest):
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+        self.digest = digest
+        self.count = chunk_count(size, chunk_size)
+        self.part_path = path + '.part'
+        self.state_path = path + '.part.state'
+        self.bitmap = bytearray((self.count + 7) // 8)
+        self.received = 0
+        self.since_ack = 0
+        self.fd = None
+        self.state_fd = None
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.open()
+
+    def matches(self, size, chunk_size, digest):
+        return (self.size, self.chunk_size, self.digest) == (size, chunk_size, digest)
+
+    def open(self):
+        header = STATE.pack(STATE_MAGIC, self.size, self.chunk_size, self.digest)
+        resume = False
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = f.read()
+            resume = (state[:STATE.size] == header and
+                      len(state) == STATE.size + len(self.bitmap) and
+                      os.path.exists(self.part_path))
+        except OSError:
+            pass
+        if resume:
+            self.bitmap[:] = state[STATE.size:]
+            self.received = sum(bin(byte).count('1') for byte in self.bitmap)
+            log.info_print('resuming %s, %d of %d chunks on disk',
+                           self.path, self.received, self.count)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        flags = os.O_RDWR | os.O_CREAT
+        if not resume:
+            flags |= os.O_TRUNC
+        self.fd = os.open(self.part_path, flags, 0o644)
+        self.state_fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.pwrite(self.state_fd, header + bytes(self.bitmap), 0)
+        self.advance_hash()
+
+    def close(self):
+        for fd in (self.fd, self.state_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = None
+        self.state_fd = None
+
+    def has(self, index):
+        return self.bitmap[index >> 3] & (1 << (index & 7))
+
+    def first_missing(self):
+        for byte_index, byte in enumerate(self.bitmap):
+            if byte != 0xFF:
+                index = byte_index * 8
+                while index < self.count and self.has(index):
+                    index += 1
+                return min(index, self.count)
+        return self.count
+
+    def ack_bitmap(self, base):
+        bits = bytearray(min(MAX_BITMAP, (self.count - base + 7) // 8))
+        for n in range(min(len(bits) * 8, self.count - base)):
+            if self.has(base + n):
+                bits[n >> 3] |= 1 << (n & 7)
+        return bytes(bits)
+
+    def write(self, index, data):
+        """
+        Store one chunk, returns True when it was new.
+        """
+        if index >= self.count:
+            raise ValueError('chunk %d out of range' % index)
+        expected = min(self.chunk_size, self.size - index * self.chunk_size)
+        if len(data) != expected:
+            raise ValueError('chunk %d has %d bytes, expected %d' % (index, len(data), expected))
+        if self.has(index):
+            return False
+        os.pwrite(self.fd, data, index * self.chunk_size)
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+        os.pwrite(self.state_fd, self.bitmap[index >> 3:(index >> 3) + 1], STATE.size + (index >> 3))
+        self.received += 1
+        self.since_ack += 1
+        if index == self.hashed:
+            self.hasher.update(data)
+            self.hashed += 1
+        self.advance_hash()
+        return True
+
+    def advance_hash(self):
+        # chunks that arrived ahead of the hashed prefix are read back
+        while self.hashed < self.count and self.has(self.hashed):
+            offset = self.hashed * self.chunk_size
+            length = min(self.chunk_size, self.size - offset)
+            self.hasher.update(os.pread(self.fd, length, offset))
+            self.hashed += 1
+
+    def complete(self):
+        return self.received >= self.count
+
+    def finish(self):
+        """
+        Verify and install the file, returns True when the digest matched.
+        """
+        ok = self.hasher.digest() == self.digest
+        if ok:
+            os.fsync(self.fd)
+        self.close()
+        if ok:
+            os.replace(self.part_path, self.path)
+        else:
+            log.error_print('%s: sha256 mismatch, discarding upload', self.path)
+            os.unlink(self.part_path)
+        os.unlink(self.state_path)
+        return ok
+
+class file_transfer_server_class():
+    """
+    Receives uploads; handle() or submit() must be fed every file message
+    and replies go out through send(). root, when given, is the directory
+    all paths are relative to and may not leave.
+    """
+    def __init__(self, send, root=None, window=DEFAULT_WINDOW):
+        self.send = send
+        self.root = root
+        self.window = window
+        self.transfers = {}
+        self.lock = threading.Lock()
+        # messages for the worker thread of submit(), None stops it
+        self.work = None
+
+    def resolve(self, path):
+        if self.root is None:
+            return os.path.abspath(path)
+        root = os.path.realpath(self.root)
+        resolved = os.path.realpath(os.path.join(root, path.lstrip('/')))
+        if os.path.commonpath([root, resolved]) != root:
+            raise ValueError('%s is outside %s' % (path, self.root))
+        return resolved
+
+    def submit(self, data, done=None):
+        """
+        Queue data for handle() on the worker thread of this server, so the
+        writes, hashing and fsync stay off the caller's thread (the
+        bluetooth main loop). Messages are handled in the order submitted,
+        done(), when given, is called after each one. Call it from one
+        thread only.
+        """
+        if self.work is None:
+            self.work = queue.Queue()
+            threading.Thread(target=self.run_worker, args=(self.work,),
+                             name='file transfer', daemon=True).start()
+        self.work.put((data, done))
+
+    def run_worker(self, work):
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            data, done = item
+            try:
+                self.handle(data)
+            except Exception as e:
+                log.error_print('file transfer failed: %s', e)
+            finally:
+                if done is not None:
+                    done()
+        self.abort_all()
+
+    def handle(self, data):
+        msg_type, transfer_id, body = command_protocol.decode(data)
+        with self.lock:
+            try:
+                if msg_type == MSG_FILE_OPEN:
+                    self.handle_open(transfer_id, body)
+                elif msg_type == MSG_FILE_CHUNK:
+                    self.handle_chunk(transfer_id, body)
+                else:
+                    log.warn_print('unexpected file message type 0x%02x', msg_type)
+            except (OSError, ValueError, struct.error) as e:
+                log.error_print('file transfer %d: %s', transfer_id, e)
+                self.abort(transfer_id)
+                self.send(encode_done(transfer_id, STATUS_IO_ERROR))
+
+    def handle_open(self, transfer_id, body):
+        size, chunk_size, digest = OPEN.unpack_from(body)
+        if chunk_size == 0:
+            raise ValueError('chunk size 0')
+        if size > MAX_FILE_SIZE:
+            raise ValueError('%d bytes is over the %d byte limit' % (size, MAX_FILE_SIZE))
+        if chunk_count(size, chunk_size) > MAX_CHUNKS:
+            raise ValueError('%d chunks of %d bytes is over the %d chunk limit'
+                             % (chunk_count(size, chunk_size), chunk_size, MAX_CHUNKS))
+        path = self.resolve(bytes(body[OPEN.size:]).decode('utf-8'))
+        receiver = self.transfers.get(transfer_id)
+        if receiver is None or receiver.path != path or not receiver.matches(size, chunk_size, digest):
+            self.abort(transfer_id)
+            # the same file may still be open under the id of a lost connection
+            for other_id, other in list(self.transfers.items()):
+                if other.path == path:
+                    self.abort(other_id)
+            if len(self.transfers) >= MAX_TRANSFERS:
+                self.abort(next(iter(self.transfers)))
+            receiver = file_receiver_class(path, size, chunk_size, digest)
+            self.transfers[transfer_id] = receiver
+            log.info_print('receiving %s, %d bytes', path, size)
+        if receiver.complete():
+            self.finish(transfer_id, receiver)
+        else:
+            self.ack(transfer_id, receiver)
+
+    def handle_chunk(self, transfer_id, body):
+        receiver = self.transfers.get(transfer_id)
+        if receiver is None:
+            # e.g. the server restarted: the client reopens and resumes
+            self.send(encode_ack(transfer_id, STATUS_ERROR, self.window, 0))
+            return
+        index = CHUNK.unpack_from(body)[0]
+        receiver.write(index, body[CHUNK.size:])
+        if receiver.complete():
+            self.finish(transfer_id, receiver)
+        elif receiver.since_ack >= max(1, self.window // 2):
+            self.ack(transfer_id, receiver)
+
+    def ack(self, transfer_id, receiver):
+        receiver.since_ack = 0
+        base = receiver.first_missing()
+        self.send(encode_ack(transfer_id, STATUS_OK, self.window, base, receiver.ack_bitmap(base)))
+
+    def finish(self, transfer_id, receiver):
+        del self.transfers[transfer_id]
+        ok = receiver.finish()
+        if ok:
+            log.info_print('received %s', receiver.path)
+        self.send(encode_done(transfer_id, STATUS_OK if ok else STATUS_ERROR))
+
+    def abort(self, transfer_id):
+        # the part and state files stay for a later resume
+        receiver = self.transfers.pop(transfer_id, None)
+        if receiver is not None:
+            receiver.close()
+
+    def abort_all(self):
+        with self.lock:
+            for transfer_id in list(self.transfers):
+                self.abort(transfer_id)
+
+    def close(self):
+        """
+        Abort all transfers; with a worker running, once it has handled
+        what was submitted before.
+        """
+        if self.work is not None:
+            self.work.put(None)
+            self.work = None
+            return
+        self.abort_all()
+
+class file_transfer_client_class():
+    """
+    Uploads files through send(); handle() must be fed every file message
+    received. upload() blocks, so run it off the thread that calls handle().
+    """
+    def __init__(self, send, chunk_size=DEFAULT_CHUNK_SIZE, timeout=1.0, retries=10):
+        self.send = send
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.condition = threading.Condition()
+        self.replies = {}
+        self.next_id = 0
+        self.retransmits = 0
+
+    def submit(self, data, done=None):
+        """
+        Queue data for handle() on the worker thread of this server, so the
+        writes, hashing and fsync stay off the caller's thread (the
+        bluetooth main loop). Messages are handled in the order submitted,
+        done(), when given, is called after each one. Call it from one
+        thread only.
+        """
+        if self.work is None:
+            self.work = queue.Queue()
+            threading.Thread(target=self.run_worker, args=(self.work,),
+                             name='file transfer', daemon=True).start()
+        self.work.put((data, done))
+
+    def run_worker(self, work):
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            data, done = item
+            try:
+                self.handle(data)
+            except Exception as e:
+                log.error_print('file transfer failed: %s', e)
+            finally:
+                if done is not None:
+                    done()
+        self.abort_all()
+
+    def handle(self, data):
+        msg_type, transfer_id, body = command_protocol.decode(data)
+        with self.condition:
+            self.replies.setdefault(transfer_id, []).append((msg_type, bytes(body)))
+            self.condition.notify_all()
+
+    def wait_reply(self, transfer_id, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.replies.get(transfer_id), timeout)
+            replies = self.replies.get(transfer_id)
+            if not replies:
+                return None
+            return replies.pop(0)
+
+    def upload(self, local_path, remote_path, window=None):
+        """
+        Send local_path to remote_path on the server, resuming a previous
+        partial upload of the same file. Returns the DONE status.
+        """
+        size = os.path.getsize(local_path)
+        digest = hashlib.sha256()
+        with open(local_path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b''):
+                digest.update(block)
+        digest = digest.digest()
+        count = chunk_count(size, self.chunk_size)
+        with self.condition:
+            transfer_id = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFF
+            self.replies[transfer_id] = []
+        opener = encode_open(transfer_id, remote_path, size, self.chunk_size, digest)
+        # every chunk below base is on the server, acked holds those above
+        base = 0
+        acked = set()
+        in_flight = set()
+        window_size = window
+        failures = 0
+        try:
+            with open(local_path, 'rb') as f:
+                self.send(opener)
+                while True:
+                    index = base
+                    while window_size and len(in_flight) < window_size and index < count:
+                        if index not in acked and index not in in_flight:
+                            f.seek(index * self.chunk_size)
+                            self.send(encode_chunk(transfer_id, index, f.read(self.chunk_size)))
+                            in_flight.add(index)
+                        index += 1
+                    reply = self.wait_reply(transfer_id, self.timeout)
+                    if reply is None:
+                        failures += 1
+                        if failures > self.retries:
+                            raise TimeoutError('no reply for %s' % remote_path)
+                        # ask where the server stands
+                        in_flight.clear()
+                        self.send(opener)
+                        continue
+                    failures = 0
+                    msg_type, body = reply
+                    if msg_type == MSG_FILE_DONE:
+                        return DONE.unpack_from(body)[0]
+                    if msg_type != MSG_FILE_ACK:
+                        continue
+                    status, server_window, ack_base = ACK.unpack_from(body)
+                    if status != STATUS_OK:
+                        in_flight.clear()
+                        self.send(opener)
+                        continue
+                    if window_size is None or window_size > server_window:
+                        window_size = server_window
+                    base = ack_base
+                    acked = set(index for index in acked if index >= base)
+                    highest = base - 1
+                    bitmap = body[ACK.size:]
+                    for n in range(len(bitmap) * 8):
+                        if bitmap[n >> 3] & (1 << (n & 7)):
+                            acked.add(base + n)
+                            highest = base + n
+                    for index in list(in_flight):
+                        if index < base or index in acked:
+                            in_flight.discard(index)
+                        elif index < highest:
+                            # selective retransmit of a chunk lost on the way
+                            in_flight.discard(index)
+                            self.retransmits += 1
+        finally:
+            with self.condition:
+                self.replies.pop(transfer_id, None)
@@ -0,0 +1,156 @@
+"""
+Credit based flow control, carried as link messages on frame_codec
+CHANNEL_LINK next to the application channels.
+
+Each side grants the other credits, one credit being one message it has a
+free slot for, and a sender stops when its credit is used up:
+
+    LINK_CREDIT  count(2, little endian)   the peer may send count more
+
+The client opts in by sending the first LINK_CREDIT (its own window, 0 is
+allowed). The server then enables flow control in both directions and
+answers with a grant of its free RX slots; until then it neither sends
+link messages nor limits its TX, so older clients keep working. As the
+application consumes received messages the credits are returned in
+batches of a quarter window.
+
+The same class serves the client side: start() opts in, tx_acquire()
+waits for credit before each write.
+"""
+import struct
+import threading
+from utils import log
+
+LINK_CREDIT = 0x01
+
+CREDIT = struct.Struct('<BH')
+# rx_free rx_credit tx_credit, as read from the credit characteristic
+STATE = struct.Struct('<HHH')
+
+UNLIMITED = 0xFFFF
+
+def encode_credit(count):
+    return CREDIT.pack(LINK_CREDIT, count)
+
+class flow_control_class():
+    """
+    window is the number of messages this side can hold, send_link(bytes)
+    queues a link message to the peer and rx_free() returns the free
+    receive slots right now.
+    """
+    def __init__(self, window, send_link, rx_free=None):
+        self.window = window
+        self.send_link = send_link
+        self.rx_free = rx_free
+        self.threshold = max(1, window // 4)
+        self.condition = threading.Condition()
+        self.overruns = 0
+        # tx_acquire() timeouts
+        self.tx_stalls = 0
+        self.reset()
+
+    def reset(self):
+        with self.condition:
+            self.enabled = False
+            self.tx_credit = 0
+            self.rx_credit = 0
+            self.rx_returned = 0
+            self.condition.notify_all()
+
+    def start(self):
+        """
+        Client side: opt in and grant the peer a full window.
+        """
+        with self.condition:
+            self.enabled = True
+            self.rx_credit = self.window
+        self.send_link(encode_credit(self.window))
+
+    def handle(self, message):
+        """
+        Process a link message from the peer. Returns True when TX credit
+        was added, so a stalled sender can be woken up.
+        """
+        if len(message) < CREDIT.size or message[0] != LINK_CREDIT:
+            log.warn_print('unknown link message %r', bytes(message[:1]))
+            return False
+        count = CREDIT.unpack_from(message)[1]
+        grant = 0
+        with self.condition:
+            if not self.enabled:
+                self.enabled = True
+                grant = self.window if self.rx_free is None else self.rx_free()
+                self.rx_credit = grant
+            self.tx_credit += count
+            self.condition.notify_all()
+        if grant:
+            self.send_link(encode_credit(grant))
+        return count > 0
+
+    def tx_allowed(self):
+        return not self.enabled or self.tx_credit > 0
+
+    def tx_consume(self):
+        """
+        Take one credit without waiting, False if there is none.
+        """
+        with self.condition:
+            if not self.enabled:
+                return True
+            if self.tx_credit <= 0:
+                return False
+            self.tx_credit -= 1
+            return True
+
+    def tx_acquire(self, timeout=None):
+        """
+        Wait up to timeout seconds for one credit and take it.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: not self.enabled or self.tx_credit > 0, timeout):
+                self.tx_stalls += 1
+                return False
+            if self.enabled:
+                self.tx_credit -= 1
+            return True
+
+    def rx_received(self):
+        """
+        A message from the peer arrived.
+        """
+        with self.condition:
+            if not self.enabled:
+                return
+            if self.rx_credit <= 0:
+                self.overruns += 1
+            else:
+                self.rx_credit -= 1
+
+    def rx_consumed(self, count=1):
+        """
+        The application took count received messages, return their credits
+        once enough have accumulated.
+        """
+        with self.condition:
+            if not self.enabled:
+                return
+            self.rx_returned += count
+            if self.rx_returned < self.threshold:
+                return
+            grant = self.rx_returned
+            self.rx_returned = 0
+            self.rx_credit += grant
+        try:
+            self.send_link(encode_credit(grant))
+        except Exception as e:
+            # keep the credits for the next attempt
+            log.warn_print('credit grant failed: %s', e)
+            with self.condition:
+                self.rx_credit -= grant
+                self.rx_returned += grant
+
+    def state(self):
+        with self.condition:
+            rx_free = self.window if self.rx_free is None else self.rx_free()
+            tx_credit = min(self.tx_credit, UNLIMITED - 1) if self.enabled else UNLIMITED
+            return STATE.pack(min(rx_free, UNLIMITED), min(self.rx_credit, UNLIMITED), tx_credit)
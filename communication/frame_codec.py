@@ -0,0 +1,253 @@
+"""
+Framing used on the FFE3 (write) and FFE2 (notify) characteristics.
+
+A message is carried in one or more fragments, each fragment fits in a single
+ATT value (MTU - 3 bytes):
+
+    flags(1) seq(1) [length(2)] body [crc(2)]
+
+flags   FLAG_START on the first fragment of a message, FLAG_END on the last,
+        the channel in the low bits (CHANNEL_MASK) of every fragment,
+        FLAG_COMPRESSED when the message body is compressed (see
+        compression.py).
+seq     fragment counter per direction, wraps at 256, used to detect loss.
+length  total message length, little endian, only on FLAG_START fragments.
+crc     CRC-16/CCITT (binascii.crc_hqx, init 0xFFFF) of the whole message,
+        little endian, only on FLAG_END fragments.
+
+Several fragments may be packed back to back in one ATT value, the decoder
+always knows how many body bytes it still expects.
+
+Fragments of messages on different channels may be interleaved, so a
+control reply does not have to wait for the rest of a bulk transfer. The
+seq counter still runs over all fragments of a direction, reassembly is per
+channel. A peer that only uses channel 0 sees the original format.
+"""
+import binascii
+import struct
+from utils import log
+
+FLAG_START = 0x80
+FLAG_END = 0x40
+FLAG_COMPRESSED = 0x20
+CHANNEL_MASK = 0x03
+
+CHANNEL_CONTROL = 0
+CHANNEL_TELEMETRY = 1
+CHANNEL_BULK = 2
+# link layer messages (flow control), never handed to the application
+CHANNEL_LINK = 3
+
+ATT_HEADER_SIZE = 3
+ATT_DEFAULT_MTU = 23
+
+MAX_MESSAGE_SIZE = 0xFFFF
+
+HEADER = struct.Struct('<BB')
+LENGTH = struct.Struct('<H')
+CRC = struct.Struct('<H')
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def channel_of(flags):
+    return flags & CHANNEL_MASK
+
+def mtu_to_fragment_size(mtu):
+    return max(int(mtu), ATT_DEFAULT_MTU) - ATT_HEADER_SIZE
+
+def single_fragment_capacity(fragment_size):
+    """
+    Longest message that still goes out as one fragment.
+    """
+    return fragment_size - HEADER.size - LENGTH.size - CRC.size
+
+class frame_encoder_class():
+    def __init__(self):
+        self.seq = 0
+
+    def reset(self):
+        self.seq = 0
+
+    def fragments(self, payload, fragment_size, flags=0):
+        """
+        Yield the fragments of payload, none of them longer than
+        fragment_size bytes.
+        """
+        view = memoryview(payload)
+        total = len(view)
+        if total > MAX_MESSAGE_SIZE:
+            raise ValueError('message too long: %d bytes' % total)
+        if fragment_size <= HEADER.size + LENGTH.size + CRC.size:
+            raise ValueError('fragment size too small: %d' % fragment_size)
+        crc = crc16(view)
+        pos = 0
+        first = True
+        while True:
+            fragment_flags = flags
+            room = fragment_size - HEADER.size
+            if first:
+                fragment_flags |= FLAG_START
+                room -= LENGTH.size
+            remaining = total - pos
+            if remaining + CRC.size <= room:
+                fragment_flags |= FLAG_END
+                take = remaining
+            else:
+                take = min(remaining, room)
+            fragment = bytearray(HEADER.pack(fragment_flags, self.seq))
+            self.seq = (self.seq + 1) & 0xFF
+            if first:
+                fragment += LENGTH.pack(total)
+                first = False
+            fragment += view[pos:pos + take]
+            pos += take
+            if fragment_flags & FLAG_END:
+                fragment += CRC.pack(crc)
+                yield bytes(fragment)
+                return
+            yield bytes(fragment)
+
+class reassembly_class():
+    def __init__(self):
+        self.buffer = None
+        self.remaining = 0
+        self.flags = 0
+
+    def drop(self):
+        self.buffer = None
+        self.remaining = 0
+
+class frame_decoder_class():
+    """
+    decompress(data) is applied to messages sent with FLAG_COMPRESSED, they
+    are dropped as format errors without it.
+    """
+    def __init__(self, decompress=None):
+        self.decompress = decompress
+        self.crc_errors = 0
+        self.seq_errors = 0
+        self.format_errors = 0
+        self.reset()
+
+    def reset(self):
+        self.channels = [reassembly_class() for i in range(CHANNEL_MASK + 1)]
+        self.flags = 0
+        self.expected_seq = None
+
+    def drop(self):
+        for channel in self.channels:
+            channel.drop()
+
+    def feed(self, data):
+        """
+        Consume one ATT value and return the list of messages it completed.
+        """
+        return [message for channel, message in self.feed_channels(data)]
+
+    def count_messages(self, data):
+        """
+        Number of application messages (not on CHANNEL_LINK) that feeding
+        data would complete, without consuming it, so a write can be
+        refused while the decoder state is still untouched. Only the
+        headers are walked, seq and crc are left to feed_channels().
+        """
+        remaining = [state.remaining if state.buffer is not None else None
+                     for state in self.channels]
+        view = memoryview(data)
+        size = len(view)
+        pos = 0
+        count = 0
+        while size - pos >= HEADER.size:
+            flags = view[pos]
+            pos += HEADER.size
+            channel = flags & CHANNEL_MASK
+            if flags & FLAG_START:
+                if size - pos < LENGTH.size:
+                    break
+                remaining[channel] = LENGTH.unpack_from(view, pos)[0]
+                pos += LENGTH.size
+            elif remaining[channel] is None:
+                break
+            take = min(remaining[channel], size - pos)
+            remaining[channel] -= take
+            pos += take
+            if flags & FLAG_END:
+                pos += CRC.size
+                remaining[channel] = None
+                if channel != CHANNEL_LINK:
+                    count += 1
+        return count
+
+    def feed_channels(self, data):
+        """
+        Like feed(), but return (channel, message) pairs.
+        """
+        messages = []
+        view = memoryview(data)
+        size = len(view)
+        pos = 0
+        while pos < size:
+            if size - pos < HEADER.size:
+                self.format_errors += 1
+                self.drop()
+                break
+            flags, seq = HEADER.unpack_from(view, pos)
+            pos += HEADER.size
+            if self.expected_seq is not None and seq != self.expected_seq:
+                self.seq_errors += 1
+                log.warn_print('frame seq %d, expected %d', seq, self.expected_seq)
+                if not flags & FLAG_START:
+                    # a lost fragment may belong to any channel
+                    self.drop()
+                    self.expected_seq = None
+                    break
+            self.expected_seq = (seq + 1) & 0xFF
+            state = self.channels[flags & CHANNEL_MASK]
+
+            if flags & FLAG_START:
+                if state.buffer is not None:
+                    self.format_errors += 1
+                if size - pos < LENGTH.size:
+                    self.format_errors += 1
+                    state.drop()
+                    break
+                state.remaining = LENGTH.unpack_from(view, pos)[0]
+                pos += LENGTH.size
+                state.buffer = bytearray()
+                state.flags = flags
+                self.flags = flags
+            elif state.buffer is None:
+                # continuation of a message whose start we never saw
+                self.format_errors += 1
+                break
+
+            take = min(state.remaining, size - pos)
+            state.buffer += view[pos:pos + take]
+            state.remaining -= take
+            pos += take
+
+            if flags & FLAG_END:
+                if state.remaining != 0 or size - pos < CRC.size:
+                    self.format_errors += 1
+                    state.drop()
+                    break
+                crc = CRC.unpack_from(view, pos)[0]
+                pos += CRC.size
+                message = bytes(state.buffer)
+                state.drop()
+                if crc != crc16(message):
+                    self.crc_errors += 1
+                    log.warn_print('frame crc error')
+                    continue
+                if state.flags & FLAG_COMPRESSED:
+                    try:
+                        if self.decompress is None:
+                            raise ValueError('compression not negotiated')
+                        message = self.decompress(message)
+                    except ValueError as e:
+                        self.format_errors += 1
+                        log.warn_print('frame decompression failed: %s', e)
+                        continue
+                messages.append((flags & CHANNEL_MASK, message))
+        return messages
@@ -1,39 +1,211 @@
-import sys
 import time
-if sys.version > '3':
-    import queue
-else:
-    import Queue as queue
+from communication import ring_buffer
+from communication.ring_buffer import ring_buffer_class
+
+def to_bytes(item):
+    if isinstance(item, bytes):
+        return item
+    if isinstance(item, str):
+        return item.encode('utf-8')
+    return bytes(item)
+
+class tx_channel_class():
+    def __init__(self, name, channel, weight, queue):
+        self.name = name
+        self.channel = channel
+        self.weight = weight
+        self.queue = queue
 
 class frame_data_class():
-    def __init__(self, rx_size, tx_size):
-        self.frame_rx_queue = queue.Queue(rx_size)
-        self.frame_tx_queue = queue.Queue(tx_size)
-
-    def enqueue(self, item):
-        if self.frame_rx_queue.full():
-            #print("ble rx queue full")
-            self.frame_rx_queue.queue.clear()
-        self.frame_rx_queue.put(item)
-        #print("enqueue time:", time.process_time())
-
-    def dequeue(self):
-        value = None
-        if not self.frame_tx_queue.empty():
-            value = self.frame_tx_queue.get_nowait()
-        return value
-
-    def send(self, item):
-        if self.frame_tx_queue.full():
-            self.frame_tx_queue.queue.clear()
-        self.frame_tx_queue.put(item)
-
-    def recv(self):
-        value = None
-        if not self.frame_rx_queue.empty():
-            try:
-                value = self.frame_rx_queue.get_nowait()
-            except:
-                print("Queue error")
-            #print("recv time:", time.process_time())
-        return value
\ No newline at end of file
+    """
+    RX and TX frame rings between the GLib thread and the application.
+    Frames are never discarded silently: the policy of each ring decides
+    whether a full ring blocks, drops (and counts) or raises
+    RingBufferFullException.
+
+    Frames are stored with the time they were queued. When a metrics
+    registry is given the time spent in each queue is recorded, together
+    with queue depth and drop gauges.
+
+    TX may be split into named channels with add_tx_channel(), each with its
+    own ring; frame_tx_queue is channel 0, named tx_channel.
+    """
+    def __init__(self, rx_size, tx_size,
+                 rx_policy=ring_buffer.POLICY_BLOCK,
+                 tx_policy=ring_buffer.POLICY_BLOCK,
+                 rx_timeout=None, tx_timeout=None,
+                 metrics=None, labels=None, tx_channel='default', tx_weight=1):
+        self.frame_rx_queue = ring_buffer_class(rx_size, rx_policy, rx_timeout)
+        # any application thread may send(), the GLib thread alone writes RX
+        self.frame_tx_queue = ring_buffer_class(tx_size, tx_policy, tx_timeout, multi_producer=True)
+        self.default_channel = tx_channel
+        self.tx_channels = {tx_channel: tx_channel_class(tx_channel, 0, tx_weight, self.frame_tx_queue)}
+        # highest weight first
+        self.tx_channel_list = list(self.tx_channels.values())
+        self.metrics = None
+        self.labels = labels
+        self.send_callback = None
+        self.recv_callback = None
+        self.write_to_enqueue = None
+        self.rx_wait = None
+        self.tx_wait = None
+        self.recv_to_send = None
+        self.last_recv = None
+        if metrics is not None:
+            self.add_metrics(metrics, labels)
+
+    def add_metrics(self, metrics, labels=None):
+        self.metrics = metrics
+        self.labels = labels
+        self.write_to_enqueue = metrics.histogram('ble_rx_write_to_enqueue_seconds',
+                'WriteValue receipt to RX queue', labels)
+        self.rx_wait = metrics.histogram('ble_rx_queue_wait_seconds',
+                'RX queue to application recv()', labels)
+        self.recv_to_send = metrics.histogram('ble_app_recv_to_send_seconds',
+                'application recv() to the following send()', labels)
+        self.tx_wait = metrics.histogram('ble_tx_queue_wait_seconds',
+                'send() to notify path dequeue', labels)
+        queues = [('rx', self.frame_rx_queue), ('tx', self.frame_tx_queue)]
+        for channel in self.tx_channel_list:
+            if channel.queue is not self.frame_tx_queue:
+                queues.append(('tx_' + channel.name, channel.queue))
+        for name, ring in queues:
+            self.add_queue_metrics(name, ring)
+
+    def add_queue_metrics(self, name, ring):
+        queue_labels = dict(self.labels or {}, queue=name)
+        self.metrics.gauge('ble_queue_depth', 'frames waiting in queue',
+                           lambda: len(ring), queue_labels)
+        self.metrics.gauge('ble_queue_high_water_mark', 'highest queue depth seen',
+                           lambda: ring.high_water_mark, queue_labels)
+        self.metrics.gauge('ble_queue_dropped_total', 'frames dropped or refused',
+                           lambda: ring.drop_count, queue_labels)
+
+    def add_tx_channel(self, name, channel, weight, size,
+                       policy=ring_buffer.POLICY_BLOCK, timeout=None):
+        """
+        Add a TX channel with its own ring of size frames. channel is the id
+        carried on the wire, weight the number of fragments it may send per
+        scheduling round.
+        """
+        if name in self.tx_channels:
+            raise ValueError('tx channel %s exists' % name)
+        ring = ring_buffer_class(size, policy, timeout, multi_producer=True)
+        self.tx_channels[name] = tx_channel_class(name, channel, weight, ring)
+        self.tx_channel_list = sorted(self.tx_channels.values(),
+                                      key=lambda c: (-c.weight, c.channel))
+        if self.metrics is not None:
+            self.add_queue_metrics('tx_' + name, ring)
+        return self.tx_channels[name]
+
+    def get_tx_channel(self, name=None):
+        if name is None:
+            name = self.default_channel
+        channel = self.tx_channels.get(name)
+        if channel is None:
+            raise ValueError('unknown tx channel %s' % name)
+        return channel
+
+    def set_send_callback(self, callback):
+        """
+        callback() is invoked after every send() so the consumer of the TX
+        queue can be woken up instead of polling it.
+        """
+        self.send_callback = callback
+
+    def set_recv_callback(self, callback):
+        """
+        callback(count) is invoked after recv()/recv_many() took count items
+        off the RX queue, on the application thread.
+        """
+        self.recv_callback = callback
+
+    def enqueue(self, item, received=None):
+        """
+        received is the time.monotonic() the carrying write arrived at.
+        """
+        now = time.monotonic()
+        if received is not None and self.write_to_enqueue is not None:
+            self.write_to_enqueue.observe(now - received, now)
+        self.frame_rx_queue.put((now, item))
+
+    def dequeue(self, channel=None):
+        entry = self.dequeue_stamped(channel)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def dequeue_stamped(self, channel=None):
+        """
+        Return (send time, item) from the given TX channel or None.
+        """
+        entry = self.get_tx_channel(channel).queue.get()
+        if entry is not None and self.tx_wait is not None:
+            self.tx_wait.observe(time.monotonic() - entry[0])
+        return entry
+
+    def tx_full(self, channel=None):
+        return self.get_tx_channel(channel).queue.full()
+
+    def tx_pending(self):
+        for channel in self.tx_channel_list:
+            if not channel.queue.empty():
+                return True
+        return False
+
+    def send(self, item, block=True, channel=None):
+        item = to_bytes(item)
+        ring = self.get_tx_channel(channel).queue
+        callback = self.send_callback
+        if callback is not None and ring.full():
+            # make sure the consumer is draining before we wait for room
+            callback()
+        now = time.monotonic()
+        if self.recv_to_send is not None and self.last_recv is not None:
+            self.recv_to_send.observe(now - self.last_recv, now)
+            self.last_recv = None
+        ring.put((now, item), block)
+        if callback is not None:
+            callback()
+
+    def recv(self, block=False, timeout=None):
+        """
+        Return the next received item. With block=True wait until an item
+        arrives or timeout seconds pass; None is returned when nothing is
+        available.
+        """
+        entry = self.frame_rx_queue.get(block, timeout)
+        if entry is None:
+            return None
+        self.received(entry[0])
+        if self.recv_callback is not None:
+            self.recv_callback(1)
+        return entry[1]
+
+    def received(self, stamp):
+        if self.rx_wait is not None:
+            now = time.monotonic()
+            self.rx_wait.observe(now - stamp, now)
+            self.last_recv = now
+
+    def recv_many(self, max_items, block=True, timeout=None):
+        """
+        Wait like recv() for the first item, then drain up to max_items that
+        are already pending without waiting again. Returns a list.
+        """
+        entries = self.frame_rx_queue.get_many(max_items, block, timeout)
+        for entry in entries:
+            self.received(entry[0])
+        if entries and self.recv_callback is not None:
+            self.recv_callback(len(entries))
+        return [entry[1] for entry in entries]
+
+    def stats(self):
+        stats = {
+                'rx': self.frame_rx_queue.stats(),
+                'tx': self.frame_tx_queue.stats(),
+        }
+        for channel in self.tx_channel_list:
+            if channel.queue is not self.frame_tx_queue:
+                stats['tx_' + channel.name] = channel.queue.stats()
+        return stats
@@ -0,0 +1,227 @@
+"""
+Low overhead counters and latency histograms for the BLE data path, exposed
+in the Prometheus text format.
+
+Recording is a few integer updates under the GIL, cheap enough to leave on in
+production. registry.serve() publishes the current values either on a Unix
+socket (connect and read, e.g. 'socat - UNIX:/tmp/geekproject.metrics') or
+as an HTTP endpoint for Prometheus when given a (host, port) tuple.
+"""
+import bisect
+import os
+import socket
+import threading
+import time
+from utils import log
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+ROLLING_WINDOW = 60.0
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, labels[k]) for k in sorted(labels)) + '}'
+
+class counter_class():
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = format_labels(labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def families(self):
+        return [(self.name, 'counter', self.help_text,
+                 ['%s%s %d' % (self.name, self.labels, self.value)])]
+
+class gauge_class():
+    """
+    A gauge whose value is read from function() when rendered, so nothing is
+    recorded on the hot path.
+    """
+    def __init__(self, name, help_text, function, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = format_labels(labels)
+        self.function = function
+
+    def families(self):
+        return [(self.name, 'gauge', self.help_text,
+                 ['%s%s %s' % (self.name, self.labels, self.function())])]
+
+class histogram_class():
+    """
+    Cumulative Prometheus histogram plus a rolling view over the last one or
+    two windows, used for the p50/p95/p99 gauges.
+    """
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS,
+                 window=ROLLING_WINDOW, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_dict = labels or {}
+        self.labels = format_labels(labels)
+        self.buckets = buckets
+        self.window = window
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.window_counts = [0] * (len(buckets) + 1)
+        self.previous_counts = [0] * (len(buckets) + 1)
+        self.window_start = time.monotonic()
+
+    def observe(self, value, now=None):
+        if now is None:
+            now = time.monotonic()
+        if now - self.window_start >= self.window:
+            self.rotate(now)
+        index = bisect.bisect_left(self.buckets, value)
+        self.counts[index] += 1
+        self.window_counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def rotate(self, now):
+        if now - self.window_start >= 2 * self.window:
+            self.previous_counts = [0] * len(self.counts)
+        else:
+            self.previous_counts = self.window_counts
+        self.window_counts = [0] * len(self.counts)
+        self.window_start = now
+
+    def quantile(self, fraction):
+        """
+        Upper bound of the bucket holding the given quantile over the rolling
+        window, None without samples.
+        """
+        if time.monotonic() - self.window_start >= self.window:
+            self.rotate(time.monotonic())
+        counts = [a + b for a, b in zip(self.window_counts, self.previous_counts)]
+        total = sum(counts)
+        if total == 0:
+            return None
+        rank = fraction * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+                return float('inf')
+        return None
+
+    def families(self):
+        lines = []
+        cumulative = 0
+        for index, bound in enumerate(self.buckets):
+            cumulative += self.counts[index]
+            labels = dict(self.label_dict, le=repr(bound))
+            lines.append('%s_bucket%s %d' % (self.name, format_labels(labels), cumulative))
+        labels = dict(self.label_dict, le='+Inf')
+        lines.append('%s_bucket%s %d' % (self.name, format_labels(labels), self.count))
+        lines.append('%s_sum%s %f' % (self.name, self.labels, self.sum))
+        lines.append('%s_count%s %d' % (self.name, self.labels, self.count))
+        rolling = []
+        for fraction in (0.5, 0.95, 0.99):
+            value = self.quantile(fraction)
+            if value is None:
+                continue
+            labels = dict(self.label_dict, quantile=repr(fraction))
+            rolling.append('%s_rolling%s %s' % (self.name, format_labels(labels), value))
+        return [(self.name, 'histogram', self.help_text, lines),
+                (self.name + '_rolling', 'gauge',
+                 self.help_text + ', bucket bound of the quantile over the last %d s' % self.window,
+                 rolling)]
+
+class metrics_registry_class():
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+        self.server_thread = None
+
+    def add(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def remove(self, metric):
+        with self.lock:
+            if metric in self.metrics:
+                self.metrics.remove(metric)
+
+    def counter(self, name, help_text, labels=None):
+        return self.add(counter_class(name, help_text, labels))
+
+    def gauge(self, name, help_text, function, labels=None):
+        return self.add(gauge_class(name, help_text, function, labels))
+
+    def histogram(self, name, help_text, labels=None):
+        return self.add(histogram_class(name, help_text, labels=labels))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        # samples of one name must be contiguous in the text format
+        families = {}
+        order = []
+        for metric in metrics:
+            for name, kind, help_text, samples in metric.families():
+                if name not in families:
+                    families[name] = (kind, help_text, [])
+                    order.append(name)
+                families[name][2].extend(samples)
+        lines = []
+        for name in order:
+            kind, help_text, samples = families[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, address):
+        """
+        Publish render() from a daemon thread. address is a Unix socket path
+        (the text is written to every client that connects) or a (host, port)
+        tuple for a minimal HTTP endpoint.
+        """
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.unlink(address)
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            http = False
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            http = True
+        server.bind(address)
+        server.listen(4)
+        self.server_thread = threading.Thread(target=self.serve_forever, args=(server, http))
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        return server
+
+    def serve_forever(self, server, http):
+        while True:
+            try:
+                client, _ = server.accept()
+            except OSError:
+                return
+            try:
+                body = self.render().encode('utf-8')
+                if http:
+                    client.settimeout(1.0)
+                    client.recv(4096)
+                    client.sendall(b'HTTP/1.0 200 OK\r\n'
+                                   b'Content-Type: text/plain; version=0.0.4\r\n'
+                                   b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n')
+                client.sendall(body)
+            except OSError as e:
+                log.warn_print('metrics client error: %s', e)
+            finally:
+                client.close()
+
+registry = metrics_registry_class()
@@ -0,0 +1,155 @@
+"""
+Packs the fragments of small messages into shared notifications.
+
+Every notification costs a PropertiesChanged round trip through bluetoothd
+and a slot in a connection event, whatever its size, so a burst of 20 byte
+replies is cheaper as one value of MTU - 3 bytes. frame_codec already lets
+several fragments sit back to back in one value; a fragment is added to
+the current value while it fits and the value is notified when it is full.
+
+When the TX queues run dry with a partly filled value, the value may be
+held back for more messages, for at most
+
+    scale * min(max_hold, hold_fraction * connection interval)
+
+A value notified within one connection interval leaves in the same
+connection event anyway, so holding longer than a fraction of it would
+only add latency. scale adapts to the traffic: it starts at 0, grows when
+values carry several messages (the queues had a backlog) or when holding
+did bring in more messages, and halves down to 0 when a hold caught
+nothing, as for a reply the central waits on before it writes again.
+
+The connection interval is not exposed by BlueZ over D-Bus, it is
+estimated from the spacing of the central's writes, which arrive one
+connection event apart when it writes continuously.
+"""
+from communication import frame_codec
+
+# ATT value bytes a fragment with at least one body byte needs
+MIN_FRAGMENT_SIZE = 7
+
+DEFAULT_MAX_HOLD = 0.015
+DEFAULT_HOLD_FRACTION = 0.5
+DEFAULT_MAX_FRAGMENTS = 32
+# below this scale holding is switched off
+MIN_HOLD_SCALE = 0.125
+# 30 ms is what most centrals pick once connected
+DEFAULT_INTERVAL = 0.030
+# connection interval range of the Bluetooth spec
+MIN_INTERVAL = 0.0075
+MAX_INTERVAL = 4.0
+# writes closer than this came in the same connection event
+EVENT_GAP = 0.002
+
+class notify_batcher_class():
+    """
+    The notify path adds fragments with add() and notifies what take()
+    returns whenever full() says so or hold() has run out.
+    """
+    def __init__(self, max_hold=DEFAULT_MAX_HOLD, hold_fraction=DEFAULT_HOLD_FRACTION,
+                 max_fragments=DEFAULT_MAX_FRAGMENTS, interval=DEFAULT_INTERVAL):
+        self.max_hold = max_hold
+        self.hold_fraction = hold_fraction
+        self.max_fragments = max_fragments
+        self.initial_interval = interval
+        self.batched = 0
+        self.reset()
+
+    def reset(self):
+        self.value = bytearray()
+        self.fragments = 0
+        self.messages = 0
+        # send stamps of the messages completed in value
+        self.sent = []
+        self.started = None
+        # messages in value when it was first held back
+        self.held = None
+        self.scale = 0.0
+        self.interval = self.initial_interval
+        self.last_write = None
+
+    def observe_write(self, now):
+        """
+        A write from the central arrived at now, refine the connection
+        interval estimate.
+        """
+        if self.last_write is not None:
+            gap = now - self.last_write
+            # longer gaps span several idle connection events
+            if EVENT_GAP <= gap <= 4 * self.interval:
+                self.interval += (gap - self.interval) / 8
+                self.interval = min(max(self.interval, MIN_INTERVAL), MAX_INTERVAL)
+        self.last_write = now
+
+    def empty(self):
+        return self.fragments == 0
+
+    def fits(self, fragment, fragment_size):
+        return self.fragments == 0 or len(self.value) + len(fragment) <= fragment_size
+
+    def full(self, fragment_size):
+        return (self.fragments >= self.max_fragments or
+                len(self.value) + MIN_FRAGMENT_SIZE > fragment_size)
+
+    def add(self, fragment, sent, now):
+        """
+        Append fragment, sent is the send stamp of the message it completes
+        or None.
+        """
+        # an empty message is an empty value when framing is off
+        if fragment and fragment[0] & frame_codec.FLAG_START:
+            self.messages += 1
+        if self.fragments == 0:
+            self.started = now
+        self.value += fragment
+        self.fragments += 1
+        if sent is not None:
+            self.sent.append(sent)
+
+    def take(self, more=False):
+        """
+        Return (value, send stamps) and start an empty value; more tells
+        that another fragment is already waiting.
+        """
+        if self.held is not None:
+            self.adapt(more or self.messages > self.held)
+        elif self.messages > 1:
+            self.adapt(True)
+        value = bytes(self.value)
+        sent = self.sent
+        self.batched += self.fragments
+        self.value = bytearray()
+        self.fragments = 0
+        self.messages = 0
+        self.sent = []
+        self.started = None
+        self.held = None
+        return value, sent
+
+    def adapt(self, paid_off):
+        if paid_off:
+            self.scale = min(1.0, max(self.scale * 2, MIN_HOLD_SCALE))
+        elif self.scale > MIN_HOLD_SCALE:
+            self.scale /= 2
+        else:
+            self.scale = 0.0
+
+    def hold_limit(self):
+        """
+        How long a partly filled value may currently wait.
+        """
+        return self.scale * min(self.max_hold, self.hold_fraction * self.interval)
+
+    def hold(self, now):
+        """
+        Called when the TX queues ran dry: seconds the current value may
+        still be held back, 0 to notify it now.
+        """
+        if self.started is None:
+            return 0.0
+        remaining = self.started + self.hold_limit() - now
+        if remaining <= 0:
+            return 0.0
+        if self.held is None:
+            self.held = self.messages
+        return remaining
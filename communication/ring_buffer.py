@@ -0,0 +1,179 @@
+import threading
+import time
+
+POLICY_BLOCK = 0
+POLICY_DROP_OLDEST = 1
+POLICY_DROP_NEWEST = 2
+POLICY_REJECT = 3
+
+class RingBufferFullException(Exception):
+    pass
+
+class ring_buffer_class():
+    """
+    Preallocated ring of frames for one consumer thread. head and tail only
+    grow, the producer only moves tail and the consumer only moves head, so
+    with a single producer thread the common path needs no lock. Waiters are
+    woken through an event that is only set when somebody is waiting.
+    POLICY_DROP_OLDEST lets the producer move head as well and therefore
+    takes a lock on both sides. With multi_producer=True put() serialises
+    the producers on a lock of their own, a producer waiting for room does
+    not hold it.
+    """
+    def __init__(self, size, policy=POLICY_BLOCK, timeout=None, multi_producer=False):
+        if size <= 0:
+            raise ValueError('ring size must be positive')
+        self.size = size
+        self.policy = policy
+        self.timeout = timeout
+        self.slots = [None] * size
+        self.head = 0
+        self.tail = 0
+        self.lock = threading.Lock() if policy == POLICY_DROP_OLDEST else None
+        self.put_lock = threading.Lock() if multi_producer else None
+        self.not_empty = threading.Event()
+        self.not_full = threading.Event()
+        self.consumer_waiting = False
+        self.producer_waiting = False
+        self.put_count = 0
+        self.get_count = 0
+        self.drop_count = 0
+        self.high_water_mark = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def empty(self):
+        return self.tail == self.head
+
+    def full(self):
+        return self.tail - self.head >= self.size
+
+    def wait(self, event, ready, timeout, producer):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if producer:
+                self.producer_waiting = True
+            else:
+                self.consumer_waiting = True
+            event.clear()
+            if ready():
+                return True
+            if deadline is None:
+                event.wait()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return ready()
+                event.wait(remaining)
+
+    def wake(self, event, producer):
+        if producer:
+            if self.producer_waiting:
+                self.producer_waiting = False
+                event.set()
+        elif self.consumer_waiting:
+            self.consumer_waiting = False
+            event.set()
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Append item. When the ring is full the policy decides: block until
+        there is room (block=False or a timeout turns this into a reject),
+        drop the oldest frame, drop this frame, or raise
+        RingBufferFullException. Returns False if item was dropped.
+        """
+        wait = self.policy == POLICY_BLOCK and block
+        if wait:
+            if timeout is None:
+                timeout = self.timeout
+            deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.put_lock is None:
+                stored = self.try_put(item, wait)
+            else:
+                with self.put_lock:
+                    stored = self.try_put(item, wait)
+            if stored is not None:
+                return stored
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not self.wait(self.not_full, lambda: not self.full(), remaining, True):
+                wait = False
+
+    def try_put(self, item, wait):
+        """
+        One attempt of put(): True when item was stored, False when it was
+        dropped, None when the ring is full and the caller waits for room.
+        """
+        if self.full():
+            if self.policy == POLICY_DROP_NEWEST:
+                self.drop_count += 1
+                return False
+            elif self.policy == POLICY_DROP_OLDEST:
+                with self.lock:
+                    if self.full():
+                        self.slots[self.head % self.size] = None
+                        self.head += 1
+                        self.drop_count += 1
+            elif wait:
+                return None
+            else:
+                self.drop_count += 1
+                raise RingBufferFullException('ring buffer full')
+
+        self.slots[self.tail % self.size] = item
+        self.tail += 1
+        self.put_count += 1
+        depth = self.tail - self.head
+        if depth > self.high_water_mark:
+            self.high_water_mark = depth
+        self.wake(self.not_empty, False)
+        return True
+
+    def pop(self):
+        if self.lock is not None:
+            with self.lock:
+                if self.tail == self.head:
+                    return None
+                return self.pop_unlocked()
+        return self.pop_unlocked()
+
+    def pop_unlocked(self):
+        index = self.head % self.size
+        item = self.slots[index]
+        self.slots[index] = None
+        self.head += 1
+        self.get_count += 1
+        self.wake(self.not_full, True)
+        return item
+
+    def get(self, block=False, timeout=None):
+        """
+        Remove and return the oldest frame, or None if the ring stays empty.
+        """
+        if self.tail == self.head:
+            if not block:
+                return None
+            if not self.wait(self.not_empty, lambda: self.tail != self.head, timeout, False):
+                return None
+        return self.pop()
+
+    def get_many(self, max_items, block=False, timeout=None):
+        items = []
+        item = self.get(block, timeout)
+        while item is not None:
+            items.append(item)
+            if len(items) >= max_items:
+                break
+            item = self.get()
+        return items
+
+    def stats(self):
+        return {
+                'size': self.size,
+                'depth': self.tail - self.head,
+                'high_water_mark': self.high_water_mark,
+                'put': self.put_count,
+                'get': self.get_count,
+                'dropped': self.drop_count,
+        }
@@ -0,0 +1,182 @@
+"""
+Per connection state of the GATT server.
+
+Every connected central is served by its own session_class: RX and TX
+queues (frame_data_class), framing, flow control, compression, notification
+batching and metrics labelled session="<slot>". Sessions live in fixed
+slots that are reused; a slot is reset when its central disconnects.
+
+BlueZ sends the notifications of a characteristic to every central that
+subscribed to it, so each slot notifies on a characteristic of its own:
+slot 0 on FFE2 as before, slot n on tx_uuid(n). A central learns its slot
+from the credit characteristic FFE4 (see bluetooth.py). With
+max_connections=1, the default, there is only slot 0 and a central needs
+no change. With more, a central keeps the slot it got on connecting: if A
+takes slot 0 and B slot 1, B stays on slot 1 after A leaves, so clients
+of such a setup must read FFE4.
+"""
+from communication import compression
+from communication import frame_codec
+from communication import metrics
+from communication import ring_buffer
+from communication.flow_control import flow_control_class
+from communication.frame_data import frame_data_class
+from communication.notify_batcher import notify_batcher_class
+from communication.tx_scheduler import tx_scheduler_class
+
+RX_QUEUE_SIZE = 16
+TX_QUEUE_SIZE = 16
+# name, id on the wire, fragments per scheduling round, queue size;
+# 'control' is the frame_tx_queue and the default of send()
+TX_CHANNELS = (
+        ('link', frame_codec.CHANNEL_LINK, 16, 8),
+        ('telemetry', frame_codec.CHANNEL_TELEMETRY, 4, 16),
+        ('bulk', frame_codec.CHANNEL_BULK, 1, 16),
+)
+
+TX_UUID = '0000ffe2-0000-1000-8000-00805f9b34fb'
+# slot n > 0 notifies on 0000ffe5-... for n = 1, 0000ffe6-... for n = 2, ...
+SLOT_UUID_BASE = 0xffe4
+
+def tx_uuid(slot):
+    if slot == 0:
+        return TX_UUID
+    return '0000%04x-0000-1000-8000-00805f9b34fb' % (SLOT_UUID_BASE + slot)
+
+class session_class():
+    def __init__(self, slot, registry=metrics.registry):
+        self.slot = slot
+        self.device_path = None
+        # framing configured by setup(), and whether the central frames its
+        # writes, None until its first write tells
+        self.framing = True
+        self.peer_framing = None
+        # messages on_message() handlers are still working on, they keep
+        # their RX slot; epoch tells a finished one whether the central it
+        # came from is still attached
+        self.rx_pending = 0
+        self.epoch = 0
+        self.mtu = frame_codec.ATT_DEFAULT_MTU
+        # the notify characteristic of this slot, set by bluetooth.py
+        self.tx_characteristic = None
+        labels = {'session': str(slot)}
+        # RX never waits, bluetooth.py refuses a write it has no room for
+        # before decoding it; TX makes send() wait up to 5 s for the notify
+        # path.
+        self.frame_data = frame_data_class(RX_QUEUE_SIZE, TX_QUEUE_SIZE,
+                                           rx_policy=ring_buffer.POLICY_REJECT,
+                                           tx_timeout=5.0, metrics=registry, labels=labels,
+                                           tx_channel='control', tx_weight=8)
+        for name, channel, weight, size in TX_CHANNELS:
+            self.frame_data.add_tx_channel(name, channel, weight, size, timeout=5.0)
+        # negotiated per connection, see compression.py
+        self.compression = compression.compression_class()
+        self.decoder = frame_codec.frame_decoder_class(self.compression.decompress)
+        self.encoder = frame_codec.frame_encoder_class()
+        # credits for the RX slots, see flow_control.py
+        self.flow_control = flow_control_class(self.frame_data.frame_rx_queue.size,
+                                               self.send_link, self.rx_free)
+        self.frame_data.set_recv_callback(self.flow_control.rx_consumed)
+        self.tx_scheduler = tx_scheduler_class(self.frame_data, self.encoder,
+                                               flow=self.flow_control, compression=self.compression)
+        # small messages share notifications, see notify_batcher.py
+        self.notify_batcher = notify_batcher_class()
+        if registry is not None:
+            self.add_metrics(registry, labels)
+
+    def add_metrics(self, registry, labels):
+        self.writes = registry.counter('ble_rx_writes_total', 'ATT writes received on FFE3', labels)
+        self.refused_writes = registry.counter('ble_rx_refused_writes_total',
+                'ATT writes refused for lack of RX room', labels)
+        self.rx_bytes = registry.counter('ble_rx_bytes_total', 'bytes received on FFE3', labels)
+        self.rx_messages = registry.counter('ble_rx_messages_total', 'messages received', labels)
+        self.tx_messages = registry.counter('ble_tx_messages_total', 'messages notified', labels)
+        self.notifications = registry.counter('ble_notifications_total', 'notifications sent', labels)
+        self.tx_bytes = registry.counter('ble_tx_bytes_total', 'bytes notified', labels)
+        self.send_to_notify = registry.histogram('ble_send_to_notify_seconds',
+                'send() to the last notification of the message', labels)
+        registry.gauge('ble_session_connected', 'a central is attached to the session',
+                lambda: int(self.device_path is not None), labels)
+        registry.gauge('ble_flow_tx_credit', 'messages the central has granted us',
+                lambda: self.flow_control.tx_credit, labels)
+        registry.gauge('ble_flow_rx_credit', 'messages we have granted the central',
+                lambda: self.flow_control.rx_credit, labels)
+        registry.gauge('ble_flow_overruns_total', 'messages received without credit',
+                lambda: self.flow_control.overruns, labels)
+        registry.gauge('ble_tx_compressed_input_bytes_total', 'bytes of the messages sent compressed',
+                lambda: self.compression.uncompressed_bytes, labels)
+        registry.gauge('ble_tx_compressed_output_bytes_total', 'the same messages after compression',
+                lambda: self.compression.compressed_bytes, labels)
+        registry.gauge('ble_notify_fragments_total', 'fragments notified, several may share a notification',
+                lambda: self.notify_batcher.batched, labels)
+        registry.gauge('ble_connection_interval_seconds', 'connection interval estimated from central writes',
+                lambda: self.notify_batcher.interval, labels)
+        registry.gauge('ble_notify_hold_seconds', 'current limit for holding a partly filled notification',
+                lambda: self.notify_batcher.hold_limit(), labels)
+        registry.gauge('ble_frame_errors_total', 'frames rejected by the decoder',
+                lambda: self.decoder.crc_errors + self.decoder.seq_errors + self.decoder.format_errors,
+                labels)
+
+    def send_link(self, message):
+        self.frame_data.send(message, False, 'link')
+
+    def rx_free(self):
+        ring = self.frame_data.frame_rx_queue
+        return max(0, ring.size - len(ring) - self.rx_pending)
+
+    def tx_uuid(self):
+        return tx_uuid(self.slot)
+
+    def set_framing(self, framing):
+        self.framing = framing
+        self.tx_scheduler.framing = framing and self.peer_framing is not False
+
+    def detect_framing(self, value):
+        """
+        Tell from the first write of the central whether it frames its
+        messages: the first fragment of a message always has FLAG_START,
+        a legacy client writes plain text, which does not. Such a central is
+        then served unframed, one message per write and per notification,
+        until it disconnects. Returns whether value is to be decoded.
+        """
+        if not self.framing:
+            return False
+        if self.peer_framing is None and value:
+            self.peer_framing = bool(value[0] & frame_codec.FLAG_START)
+            self.set_framing(self.framing)
+        return self.peer_framing is not False
+
+    def attach(self, device_path):
+        self.device_path = device_path
+
+    def detach(self):
+        """
+        The central disconnected: forget its framing and link state and
+        drop the messages still queued for it, the slot may be handed to
+        another central next.
+        """
+        self.device_path = None
+        self.peer_framing = None
+        self.rx_pending = 0
+        self.epoch += 1
+        self.set_framing(self.framing)
+        self.decoder.reset()
+        self.encoder.reset()
+        self.tx_scheduler.reset()
+        self.flow_control.reset()
+        self.compression.reset()
+        self.notify_batcher.reset()
+        for channel in self.frame_data.tx_channel_list:
+            while channel.queue.get() is not None:
+                pass
+        self.mtu = frame_codec.ATT_DEFAULT_MTU
+
+    def notify_payload_size(self):
+        """
+        Longest message that fits in a single notification at the current
+        MTU, the size to coalesce small outputs to.
+        """
+        fragment_size = frame_codec.mtu_to_fragment_size(self.mtu)
+        if not self.tx_scheduler.framing:
+            return fragment_size
+        return frame_codec.single_fragment_capacity(fragment_size)
@@ -0,0 +1,88 @@
+"""
+Startup timeline: named marks taken while the service comes up, reported
+relative to process start and to kernel boot.
+
+    timeline.mark('bus')
+    ...
+    log.info_print(timeline.report())
+
+Marks use CLOCK_BOOTTIME, the clock the kernel counts process start times
+in, so the boot-to-connectable time of a release can be read straight off
+the last mark. Each mark is also published as ble_startup_seconds{stage=...}.
+"""
+import os
+import time
+from communication import metrics
+
+def now():
+    try:
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+    except (AttributeError, OSError):
+        return time.monotonic()
+
+def process_start_time():
+    """
+    Process start in CLOCK_BOOTTIME seconds, None where /proc is missing.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        # the command name may contain spaces, fields restart after ')'
+        fields = stat[stat.rindex(')') + 2:].split()
+        return int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class startup_timeline_class():
+    def __init__(self, registry=metrics.registry):
+        self.registry = registry
+        self.process_start = process_start_time()
+        self.created = now()
+        self.marks = []
+
+    def origin(self):
+        if self.process_start is not None:
+            return self.process_start
+        return self.created
+
+    def mark(self, name):
+        """
+        Record that stage name was reached; only the first mark of a name
+        counts.
+        """
+        if self.elapsed(name) is not None:
+            return
+        stamp = now()
+        self.marks.append((name, stamp))
+        if self.registry is not None:
+            seconds = stamp - self.origin()
+            self.registry.gauge('ble_startup_seconds', 'seconds from process start to the startup stage',
+                                lambda: seconds, labels={'stage': name})
+
+    def elapsed(self, name):
+        """
+        Seconds from process start to mark name, None if not reached.
+        """
+        for mark, stamp in self.marks:
+            if mark == name:
+                return stamp - self.origin()
+        return None
+
+    def as_dict(self):
+        return {
+                'process_start_since_boot': self.process_start,
+                'stages': [(name, stamp - self.origin()) for name, stamp in self.marks],
+        }
+
+    def report(self):
+        lines = ['startup timeline (ms since process start, +ms since previous stage):']
+        previous = self.origin()
+        for name, stamp in self.marks:
+            lines.append('  %9.1f  +%8.1f  %s' % ((stamp - self.origin()) * 1000,
+                                                   (stamp - previous) * 1000, name))
+            previous = stamp
+        if self.process_start is not None and self.marks:
+            lines.append('  boot to %s: %.3f s' % (self.marks[-1][0], self.marks[-1][1]))
+        return '\n'.join(lines)
+
+timeline = startup_timeline_class()
@@ -0,0 +1,91 @@
+"""
+Fragment level scheduling of the TX channels of a frame_data_class.
+
+Weighted round robin: channels are visited highest weight first and each
+may send up to weight fragments per round before the next one gets a turn,
+idle channels are skipped. A message on a heavier channel therefore waits
+for at most the weight of the channel being served, not for the rest of a
+long bulk message, and every channel still makes progress.
+
+Fragments are cut (and numbered) only when they are sent, so fragments of
+messages on different channels interleave with a continuous seq.
+
+With a flow_control_class a message is only started when the peer has
+credit for it; link messages (flow control itself) are always sent. With a
+compression_class messages are compressed as they are started.
+"""
+from communication import frame_codec
+
+class tx_scheduler_class():
+    def __init__(self, frame_data, encoder, framing=True, flow=None, compression=None):
+        self.frame_data = frame_data
+        self.encoder = encoder
+        self.framing = framing
+        self.flow = flow
+        self.compression = compression
+        self.reset()
+
+    def reset(self):
+        """
+        Forget partially sent messages, e.g. after a disconnect.
+        """
+        # channel name -> (send time, fragment generator)
+        self.current = {}
+        self.position = 0
+        self.credit = None
+
+    def pending(self):
+        return bool(self.current) or self.frame_data.tx_pending()
+
+    def take(self, channel, fragment_size):
+        entry = self.current.get(channel.name)
+        if entry is None:
+            if self.flow is not None and channel.channel != frame_codec.CHANNEL_LINK:
+                if channel.queue.empty() or not self.flow.tx_consume():
+                    return None
+            stamped = self.frame_data.dequeue_stamped(channel.name)
+            if stamped is None:
+                return None
+            sent, payload = stamped
+            if not self.framing:
+                # the whole message is one value
+                return payload, sent
+            flags = channel.channel
+            if self.compression is not None and channel.channel != frame_codec.CHANNEL_LINK:
+                compressed, payload = self.compression.compress(payload)
+                if compressed:
+                    flags |= frame_codec.FLAG_COMPRESSED
+            entry = (sent, self.encoder.fragments(payload, fragment_size, flags))
+            self.current[channel.name] = entry
+        sent, fragments = entry
+        fragment = next(fragments)
+        if fragment[0] & frame_codec.FLAG_END:
+            del self.current[channel.name]
+            return fragment, sent
+        return fragment, None
+
+    def next_fragment(self, fragment_size):
+        """
+        Return (value, send time) for the next value to notify, where send
+        time is None unless value completes a message, or None when every
+        channel is idle.
+        """
+        channels = self.frame_data.tx_channel_list
+        if self.position >= len(channels):
+            self.position = 0
+            self.credit = None
+        if self.credit is None:
+            self.credit = channels[self.position].weight
+        for i in range(len(channels) + 1):
+            channel = channels[self.position]
+            if self.credit > 0:
+                result = self.take(channel, fragment_size)
+                if result is not None:
+                    self.credit -= 1
+                    return result
+            self.position = (self.position + 1) % len(channels)
+            self.credit = channels[self.position].weight
+        # all idle, the next burst starts with the heaviest channel
+        self.position = 0
+        self.credit = None
+        return None
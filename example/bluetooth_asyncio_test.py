@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+import sys
+import asyncio
+sys.path.append(r"../")
+
+from communication.bluetooth.bluetooth_asyncio import async_bluetooth_class
+
+async def main():
+    ble = async_bluetooth_class()
+    await ble.start()
+    while True:
+        await ble.wait_connected()
+        print("connected")
+        async for data in ble:
+            print(data)
+            await ble.send(data)
+try:
+    asyncio.run(main())
+except KeyboardInterrupt as e:
+    print(e)
+    pass
@@ -9,11 +9,11 @@ from communication.bluetooth import bluetooth
 def main():
     bluetooth.setup()
     while True:
-        array_data = bluetooth.recv()
+        array_data = bluetooth.recv(block=True)
         if array_data is not None:
             item_type = type(array_data)
             print(item_type)
-            data_str = ''.join([chr(byte) for byte in array_data])
+            data_str = array_data.decode('utf-8', 'replace')
             print(data_str)
             res = os.system(data_str)
             bluetooth.send("ok")
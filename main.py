@@ -1,26 +1,88 @@
 #!/usr/bin/env python3
 import sys
 import time
-import os
 sys.path.append(r"../")
 
 from communication.bluetooth import bluetooth
+from utils import log
+from communication import command_protocol
+from communication import file_transfer
+from utils.command_executor import command_executor_class
+
+COMMAND_WORKERS = 2
+COMMAND_TIMEOUT = 30.0
+# controllers served at once; more than one needs clients that read their
+# session slot, see communication/session.py
+MAX_CONNECTIONS = 1
+METRICS_SOCKET = '/tmp/geekproject.metrics'
+# uploads may write anywhere, like the shell commands
+FILE_ROOT = None
+
+executor = None
+# device path -> (request server, file server, send) of each central
+client_servers = {}
+
+def get_client_servers(session):
+    servers = client_servers.get(session.device_path)
+    if servers is None:
+        send = bluetooth.get_sender(session)
+        servers = (command_protocol.request_server_class(
+                           executor, send, stream_size=session.notify_payload_size),
+                   file_transfer.file_transfer_server_class(send, FILE_ROOT),
+                   send)
+        client_servers[session.device_path] = servers
+    return servers
+
+def command_done(result, send, done):
+    if result.timed_out:
+        reply = b'timeout'
+    else:
+        reply = result.stdout + result.stderr
+        if not reply:
+            reply = b'ok' if result.exit_code == 0 else ('exit %s' % result.exit_code).encode()
+    try:
+        send(reply)
+    except Exception as e:
+        log.error_print('send result failed: %s', e)
+    finally:
+        done()
+
+def handle_message(array_data):
+    # runs on the bluetooth main loop, commands execute on the pool and file
+    # messages on the file server's worker; the central gets the credit for
+    # a message back when it has been handled
+    request_server, file_server, send = get_client_servers(bluetooth.get_current_session())
+    if file_transfer.is_file_message(array_data):
+        file_server.submit(array_data, bluetooth.defer_message())
+    elif command_protocol.is_protocol_message(array_data):
+        request_server.handle(array_data, bluetooth.defer_message())
+    else:
+        data_str = array_data.decode('utf-8', 'replace')
+        log.debug_print('%s', data_str)
+        done = bluetooth.defer_message()
+        executor.submit(data_str, lambda result: command_done(result, send, done))
+
+def connect_status_changed(device_path, connected):
+    if not connected:
+        servers = client_servers.pop(device_path, None)
+        if servers is not None:
+            # partial uploads stay on disk and resume on the next connection
+            servers[1].close()
 
 def main():
-    bluetooth.setup()
-    while True:
-        array_data = bluetooth.recv()
-        if array_data is not None:
-            item_type = type(array_data)
-            print(item_type)
-            data_str = ''.join([chr(byte) for byte in array_data])
-            print(data_str)
-            res = os.system(data_str)
-            bluetooth.send("ok")
-try:  
+    global executor
+    executor = command_executor_class(COMMAND_WORKERS, COMMAND_TIMEOUT)
+    bluetooth.on_message(handle_message)
+    bluetooth.add_connect_status_callback(connect_status_changed)
+    bluetooth.setup(integrated=True, max_connections=MAX_CONNECTIONS)
+    bluetooth.serve_metrics(METRICS_SOCKET)
+    bluetooth.run()
+try:
     main()
 except KeyboardInterrupt as e:
     print("bluetooth_exit")
     bluetooth.bluetooth_exit()
+    if executor is not None:
+        executor.shutdown()
     print(e)
-    pass
\ No newline at end of file
+    pass
@@ -0,0 +1,34 @@
+"""
+The GATT server on the fake BlueZ backend, set up once per process and
+shared by the test modules that need it.
+"""
+import time
+
+from utils import log
+
+try:
+    import dbus
+    from communication.bluetooth import bluetooth
+    from communication.bluetooth.fake_bluez import fake_bluez_class
+except ImportError:
+    dbus = None
+
+fake = None
+
+def start():
+    """
+    Return the fake_bluez_class the server runs on, None without
+    dbus-python and PyGObject.
+    """
+    global fake
+    if dbus is None:
+        return None
+    if fake is None:
+        log.print_level = log.PRINT_LEVEL_ERROR
+        fake = fake_bluez_class()
+        bluetooth.setup(backend=fake, max_connections=2)
+        deadline = time.monotonic() + 5.0
+        while fake.app_path is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        fake.start_notify()
+    return fake
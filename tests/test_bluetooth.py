@@ -0,0 +1,176 @@
+"""
+The GATT server end to end on the fake BlueZ backend. Needs dbus-python
+and PyGObject, skipped without them.
+"""
+import queue
+import threading
+import time
+import unittest
+
+from communication import flow_control
+from communication import frame_codec
+from tests import fake_server
+
+try:
+    import dbus
+    from communication.bluetooth import bluetooth
+except ImportError:
+    dbus = None
+
+fake = None
+
+
+def setUpModule():
+    global fake
+    fake = fake_server.start()
+    if fake is None:
+        raise unittest.SkipTest('dbus-python and PyGObject needed')
+
+
+class bluetooth_test_class(unittest.TestCase):
+    def setUp(self):
+        self.devices = []
+        self.encoder = frame_codec.frame_encoder_class()
+
+    def tearDown(self):
+        for device in self.devices:
+            fake.disconnect(device)
+        while True:
+            try:
+                fake.notifications.get_nowait()
+            except queue.Empty:
+                break
+
+    def connect(self, address):
+        device = fake.connect(address)
+        self.devices.append(device)
+        return device, bluetooth.get_session(device)
+
+    def write_message(self, device, payload, channel=frame_codec.CHANNEL_CONTROL):
+        for fragment in self.encoder.fragments(payload, 20, channel):
+            fake.write(fragment, device=device)
+
+    def test_legacy_client(self):
+        device, session = self.connect('11:22:33:44:55:01')
+        fake.write(b'ls -la', device=device)
+        fake.write(b'pwd', device=device)
+        self.assertEqual(bluetooth.recv(True, 1.0, session), b'ls -la')
+        self.assertEqual(bluetooth.recv(True, 1.0, session), b'pwd')
+        # answered unframed, one message per notification
+        bluetooth.send(b'x' * 15, session=session)
+        self.assertEqual(fake.notifications.get(timeout=1.0), b'x' * 15)
+
+    def test_legacy_empty_message(self):
+        device, session = self.connect('11:22:33:44:55:01')
+        fake.write(b'pwd', device=device)
+        self.assertEqual(bluetooth.recv(True, 1.0, session), b'pwd')
+
+        def send_both():
+            # both queued before the notify path runs
+            bluetooth.send(b'', session=session)
+            bluetooth.send(b'after', session=session)
+        fake.run_in_loop(send_both)
+        self.assertEqual(fake.notifications.get(timeout=1.0), b'')
+        self.assertEqual(fake.notifications.get(timeout=1.0), b'after')
+
+    def test_framed_client(self):
+        device, session = self.connect('11:22:33:44:55:01')
+        self.write_message(device, b'y' * 100)
+        self.assertEqual(bluetooth.recv(True, 1.0, session), b'y' * 100)
+        bluetooth.send(b'z' * 100, session=session)
+        decoder = frame_codec.frame_decoder_class()
+        messages = []
+        while not messages:
+            messages += decoder.feed(fake.notifications.get(timeout=1.0))
+        self.assertEqual(messages, [b'z' * 100])
+
+    def test_refused_write_retry(self):
+        device, session = self.connect('11:22:33:44:55:01')
+        fragments = []
+        for i in range(20):
+            fragments += self.encoder.fragments(b'message %02d' % i, 20)
+        received = []
+        refused = 0
+        for fragment in fragments:
+            while True:
+                start = time.monotonic()
+                try:
+                    fake.write(fragment, device=device)
+                    break
+                except dbus.exceptions.DBusException:
+                    # refused at once, without waiting for room
+                    self.assertLess(time.monotonic() - start, 0.5)
+                    refused += 1
+                    received.append(bluetooth.recv(session=session))
+        received += bluetooth.recv_many(32, block=False, session=session)
+        self.assertGreater(refused, 0)
+        self.assertEqual(received, [b'message %02d' % i for i in range(20)])
+        self.assertEqual(session.decoder.seq_errors + session.decoder.format_errors, 0)
+
+    def test_advertising_connect_flap(self):
+        limit = bluetooth.ble_max_connections
+        bluetooth.ble_max_connections = 1
+        try:
+            device, session = self.connect('11:22:33:44:55:01')
+            self.assertFalse(fake.is_advertising())
+
+            def flap():
+                # the central is back before RegisterAdvertisement is answered
+                for connected in (False, True):
+                    fake.bus.emit_signal(device, 'org.freedesktop.DBus.Properties',
+                                         'PropertiesChanged', 'org.bluez.Device1',
+                                         {'Connected': dbus.Boolean(connected)}, [])
+            fake.run_in_loop(flap)
+            # queued behind the reply of the flap
+            fake.run_in_loop(lambda: None)
+            self.assertFalse(fake.is_advertising())
+        finally:
+            bluetooth.ble_max_connections = limit
+
+    def test_session_slots(self):
+        first, first_session = self.connect('11:22:33:44:55:01')
+        second, second_session = self.connect('11:22:33:44:55:02')
+        self.assertEqual(fake.read(device=first)[-1], 0)
+        self.assertEqual(fake.read(device=second)[-1], 1)
+        self.write_message(first, b'from first')
+        self.write_message(second, b'from second')
+        self.assertEqual(bluetooth.recv(True, 1.0, first_session), b'from first')
+        self.assertEqual(bluetooth.recv(True, 1.0, second_session), b'from second')
+        # with two centrals a request must say which one it comes from
+        with self.assertRaises(dbus.exceptions.DBusException):
+            fake.write(b'\x80\x00\x01\x00x\x00\x00')
+        fake.disconnect(first)
+        self.devices.remove(first)
+        self.assertIsNone(first_session.device_path)
+        third, third_session = self.connect('11:22:33:44:55:03')
+        self.assertIs(third_session, first_session)
+
+    def test_deferred_credit(self):
+        device, session = self.connect('11:22:33:44:55:01')
+        dones = []
+        handler = lambda message: dones.append(bluetooth.defer_message())
+        bluetooth.on_message(handler)
+        try:
+            self.write_message(device, flow_control.encode_credit(16), frame_codec.CHANNEL_LINK)
+            window = session.rx_free()
+            for i in range(window):
+                self.write_message(device, b'job %d' % i)
+            self.assertEqual(session.rx_free(), 0)
+            self.assertEqual(session.flow_control.rx_credit, 0)
+            with self.assertRaises(dbus.exceptions.DBusException):
+                self.write_message(device, b'one too many')
+            # work finishing on another thread returns slots and credit
+            worker = threading.Thread(target=lambda: [done() for done in dones[:8]])
+            worker.start()
+            worker.join()
+            deadline = time.monotonic() + 1.0
+            while session.rx_free() < 8 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(session.rx_free(), 8)
+            self.assertEqual(session.flow_control.rx_credit, 8)
+        finally:
+            bluetooth.remove_message_handler(handler)
+
+
+if __name__ == '__main__':
+    unittest.main()
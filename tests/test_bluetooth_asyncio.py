@@ -0,0 +1,90 @@
+"""
+The asyncio front-end on the fake BlueZ backend. Needs dbus-python and
+PyGObject, skipped without them.
+"""
+import asyncio
+import unittest
+from unittest import mock
+
+from tests import fake_server
+
+try:
+    import dbus
+    from communication.bluetooth import bluetooth
+    from communication.bluetooth.bluetooth_asyncio import async_bluetooth_class
+except ImportError:
+    dbus = None
+
+fake = None
+
+
+def setUpModule():
+    global fake
+    fake = fake_server.start()
+    if fake is None:
+        raise unittest.SkipTest('dbus-python and PyGObject needed')
+
+
+class bluetooth_asyncio_test_class(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.ble = async_bluetooth_class()
+        # the server already runs, see fake_server.py
+        with mock.patch.object(bluetooth, 'setup'):
+            await self.ble.start()
+        self.devices = []
+
+    async def asyncTearDown(self):
+        self.ble.close()
+        for device in self.devices:
+            await asyncio.to_thread(fake.disconnect, device)
+
+    async def connect(self, address):
+        device = await asyncio.to_thread(fake.connect, address)
+        self.devices.append(device)
+        return device
+
+    async def test_connection_state(self):
+        events = self.ble.connection_events()
+        # events are seen from the first wait on
+        event = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0)
+        self.assertFalse(self.ble.connected.is_set())
+        device = await self.connect('11:22:33:44:55:01')
+        await asyncio.wait_for(self.ble.wait_connected(), 1.0)
+        self.assertEqual(await asyncio.wait_for(event, 1.0), (device, True))
+        await asyncio.to_thread(fake.disconnect, device)
+        self.devices.remove(device)
+        await asyncio.wait_for(self.ble.wait_disconnected(), 1.0)
+        self.assertEqual(await asyncio.wait_for(events.__anext__(), 1.0), (device, False))
+        await events.aclose()
+
+    async def test_echo(self):
+        device = await self.connect('11:22:33:44:55:01')
+        session = bluetooth.get_session(device)
+        await asyncio.to_thread(fake.write, b'ping', device=device)
+        message = await asyncio.wait_for(self.ble.recv(), 1.0)
+        self.assertEqual(message, b'ping')
+        await self.ble.send(b'pong')
+        self.assertEqual(await asyncio.to_thread(fake.notifications.get, timeout=1.0), b'pong')
+        # taking the message handed its RX slot back
+        self.assertEqual(session.rx_free(), session.frame_data.frame_rx_queue.size)
+
+    async def test_slot_held_until_taken(self):
+        device = await self.connect('11:22:33:44:55:01')
+        session = bluetooth.get_session(device)
+        for command in (b'one', b'two'):
+            await asyncio.to_thread(fake.write, command, device=device)
+        size = session.frame_data.frame_rx_queue.size
+        self.assertEqual(session.rx_free(), size - 2)
+        messages = []
+        async for message in self.ble:
+            messages.append(message)
+            if len(messages) == 2:
+                break
+        self.assertEqual(messages, [b'one', b'two'])
+        self.assertEqual(self.ble.recv_nowait(), None)
+        self.assertEqual(session.rx_free(), size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from utils.command_executor import command_executor_class
+
+
+class command_executor_test_class(unittest.TestCase):
+    def setUp(self):
+        self.executor = command_executor_class(max_workers=2, timeout=5.0)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_output_and_exit_code(self):
+        result = self.executor.run('echo out; echo err >&2; exit 3')
+        self.assertEqual(result.stdout, b'out\n')
+        self.assertEqual(result.stderr, b'err\n')
+        self.assertEqual(result.exit_code, 3)
+        self.assertFalse(result.timed_out)
+
+    def test_status_not_in_output(self):
+        # the exit status travels on fd 3, output ending without a newline
+        # or looking like a status line stays intact
+        result = self.executor.run('printf 0; printf "\\n7\\n"')
+        self.assertEqual(result.stdout, b'0\n7\n')
+        self.assertEqual(result.exit_code, 0)
+
+    def test_state_does_not_leak(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.executor.run('cd %s; FOO=bar; exit 1' % directory)
+            result = self.executor.run('pwd; echo "[$FOO]"')
+            self.assertNotEqual(result.stdout.splitlines()[0], directory.encode())
+            self.assertEqual(result.stdout.splitlines()[1], b'[]')
+        finally:
+            os.rmdir(directory)
+
+    def test_timeout_restarts_worker(self):
+        result = self.executor.run('sleep 10', timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertIsNone(result.exit_code)
+        self.assertEqual(self.executor.run('echo again').stdout, b'again\n')
+
+    def test_slow_command_does_not_block_others(self):
+        slow = self.executor.submit('sleep 1')
+        start = time.monotonic()
+        done = threading.Event()
+        results = []
+
+        def callback(result):
+            results.append(result)
+            done.set()
+        self.executor.submit('echo fast', callback)
+        self.assertTrue(done.wait(0.8))
+        self.assertLess(time.monotonic() - start, 0.8)
+        self.assertEqual(results[0].stdout, b'fast\n')
+        self.assertEqual(slow.result(5.0).exit_code, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import struct
+import threading
+import time
+import unittest
+
+from communication import command_protocol
+from communication.command_protocol import request_client_class, request_server_class
+from utils.command_executor import command_executor_class
+
+
+class command_protocol_test_class(unittest.TestCase):
+    def setUp(self):
+        self.executor = command_executor_class(max_workers=2, timeout=5.0)
+        self.client = request_client_class(None)
+        self.server = request_server_class(self.executor, self.client.handle, chunk_size=64)
+        self.client.send = self.server.handle
+        self.sent = []
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_request(self):
+        response = self.client.request('echo out; echo err >&2; exit 2').result(5.0)
+        self.assertEqual(response.stdout, b'out\n')
+        self.assertEqual(response.stderr, b'err\n')
+        self.assertEqual((response.status, response.exit_code), (command_protocol.STATUS_OK, 2))
+
+    def test_responses_out_of_order(self):
+        slow = self.client.request('sleep 0.5; echo slow')
+        fast = self.client.request('echo fast')
+        self.assertEqual(fast.result(5.0).stdout, b'fast\n')
+        self.assertFalse(slow.done())
+        self.assertEqual(slow.result(5.0).stdout, b'slow\n')
+        self.assertNotEqual(slow.result().request_id, fast.result().request_id)
+
+    def test_long_output_is_chunked(self):
+        self.server.send = lambda data: (self.sent.append(data), self.client.handle(data))
+        response = self.client.request('head -c 200 /dev/zero').result(5.0)
+        self.assertEqual(response.stdout, bytes(200))
+        stdout = [data for data in self.sent if data[0] == command_protocol.MSG_STDOUT]
+        self.assertEqual([len(data) - command_protocol.HEADER.size for data in stdout], [64, 64, 64, 8])
+
+    def test_timeout(self):
+        self.executor.timeout = 0.2
+        response = self.client.request('sleep 5').result(5.0)
+        self.assertEqual(response.status, command_protocol.STATUS_TIMEOUT)
+
+    def test_done_after_reply(self):
+        finished = threading.Event()
+        self.server.send = self.sent.append
+
+        def done():
+            # the RX slot goes back only once the request has been answered
+            self.assertEqual(self.sent[-1][0], command_protocol.MSG_EXIT)
+            finished.set()
+        self.server.handle(command_protocol.encode(command_protocol.MSG_REQUEST, 7, b'echo x'), done)
+        self.assertTrue(finished.wait(5.0))
+        self.assertEqual([command_protocol.decode(data)[1] for data in self.sent], [7, 7])
+
+    def test_legacy_strings_are_not_protocol(self):
+        self.assertFalse(command_protocol.is_protocol_message(b'ls -la'))
+        self.assertFalse(command_protocol.is_protocol_message(b'\x01'))
+        self.assertTrue(command_protocol.is_protocol_message(
+                command_protocol.encode(command_protocol.MSG_REQUEST, 1, b'ls')))
+
+
+class opcode_registry_test_class(unittest.TestCase):
+    def setUp(self):
+        self.executor = command_executor_class(max_workers=1, timeout=5.0)
+        self.registry = command_protocol.opcode_registry_class()
+        self.client = request_client_class(None)
+        self.server = request_server_class(self.executor, self.client.handle, registry=self.registry)
+        self.client.send = self.server.handle
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def call(self, opcode, arguments=b''):
+        return self.client.call(opcode, arguments).result(5.0)
+
+    def test_dispatch(self):
+        @self.registry.handler(0x10, '<HH', '<I')
+        def add(a, b):
+            return a + b
+        response = self.call(0x10, struct.pack('<HH', 2, 3))
+        self.assertEqual(response.status, command_protocol.STATUS_OK)
+        self.assertEqual(struct.unpack('<I', response.result), (5,))
+
+    def test_tail(self):
+        self.registry.register(0x11, lambda flag, rest: bytes(reversed(rest)), '<B', tail=True)
+        self.assertEqual(self.call(0x11, b'\x01abc').result, b'cba')
+
+    def test_errors(self):
+        self.registry.register(0x12, lambda: 1 / 0, '<', '<I')
+        self.assertEqual(self.call(0x99).status, command_protocol.STATUS_UNKNOWN_OPCODE)
+        self.assertEqual(self.call(0x12, b'extra').status, command_protocol.STATUS_BAD_ARGS)
+        response = self.call(0x12)
+        self.assertEqual(response.status, command_protocol.STATUS_ERROR)
+        self.assertIn(b'division', response.result)
+
+    def test_deferred(self):
+        replies = []
+        self.registry.register(0x13, lambda reply, value: replies.append((reply, value)),
+                               '<I', deferred=True)
+        future = self.client.call(0x13, struct.pack('<I', 9))
+        self.assertFalse(future.done())
+        reply, value = replies[0]
+        reply(command_protocol.STATUS_OK, struct.pack('<I', value * 2))
+        self.assertEqual(future.result(5.0).result, struct.pack('<I', 18))
+
+    def test_deferred_raises(self):
+        def broken(reply):
+            raise RuntimeError('no backend')
+        self.registry.register(0x14, broken, deferred=True)
+        response = self.call(0x14)
+        self.assertEqual(response.status, command_protocol.STATUS_ERROR)
+        self.assertEqual(response.result, b'no backend')
+        # the RX slot of a failed deferred call is handed back too
+        done = []
+        self.server.send = lambda data: None
+        self.server.handle(command_protocol.encode_call(1, 0x14), lambda: done.append(1))
+        self.assertEqual(done, [1])
+
+    def test_shell_fallback(self):
+        response = self.call(command_protocol.OP_SHELL, b'echo via call')
+        self.assertEqual(response.stdout, b'via call\n')
+        self.assertEqual(response.exit_code, 0)
+
+
+class output_stream_test_class(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+
+    def test_coalesced_to_size(self):
+        stream = command_protocol.output_stream_class(self.sent.append, 5, 20, delay=10.0)
+        for i in range(10):
+            stream.write('stdout', b'abcd')
+        # full messages go out at once, the rest waits
+        limit = 20 - command_protocol.HEADER.size
+        self.assertEqual(len(self.sent), 40 // limit)
+        stream.close()
+        body = b''.join(bytes(command_protocol.decode(data)[2]) for data in self.sent)
+        self.assertEqual(body, b'abcd' * 10)
+        self.assertTrue(all(len(data) <= 20 for data in self.sent))
+
+    def test_partial_after_delay(self):
+        stream = command_protocol.output_stream_class(self.sent.append, 5, 100, delay=0.05)
+        try:
+            stream.write('stderr', b'late')
+            self.assertEqual(self.sent, [])
+            deadline = time.monotonic() + 1.0
+            while not self.sent and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(self.sent, [command_protocol.encode(command_protocol.MSG_STDERR, 5, b'late')])
+        finally:
+            stream.close()
+
+    def test_stream_request(self):
+        executor = command_executor_class(max_workers=1, timeout=5.0)
+        try:
+            client = request_client_class(None)
+            server = request_server_class(executor, client.handle, stream_size=64)
+            client.send = server.handle
+            first = threading.Event()
+            chunks = []
+
+            def on_output(msg_type, data):
+                chunks.append((msg_type, data))
+                first.set()
+            future = client.stream('echo first; sleep 0.5; echo second', on_output)
+            # output arrives while the command still runs
+            self.assertTrue(first.wait(0.4))
+            self.assertFalse(future.done())
+            response = future.result(5.0)
+            self.assertEqual(response.exit_code, 0)
+            self.assertEqual(response.stdout, b'')
+            self.assertEqual(b''.join(data for msg_type, data in chunks), b'first\nsecond\n')
+        finally:
+            executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
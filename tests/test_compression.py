@@ -0,0 +1,104 @@
+import unittest
+
+from communication import compression
+from communication import frame_codec
+from communication.frame_data import frame_data_class
+from communication.tx_scheduler import tx_scheduler_class
+
+STATUS = b'{"status": "ok", "result": "/home/pi/GeekProject/ No such file or directory"}'
+
+
+class compression_test_class(unittest.TestCase):
+    def negotiate(self, client, server):
+        reply = server.handle(client.offer())
+        self.assertIsNone(client.handle(reply))
+        return reply
+
+    def test_negotiate(self):
+        client = compression.compression_class()
+        server = compression.compression_class()
+        reply = self.negotiate(client, server)
+        self.assertEqual(reply, bytes([compression.LINK_COMPRESSION_SELECT, compression.CODEC_ZLIB]))
+        self.assertEqual(client.codec, compression.CODEC_ZLIB)
+        self.assertEqual(server.codec, compression.CODEC_ZLIB)
+
+    def test_negotiate_preference(self):
+        client = compression.compression_class()
+        server = compression.compression_class(preference=(compression.CODEC_LZ4, compression.CODEC_ZLIB))
+        self.negotiate(client, server)
+        expected = compression.CODEC_LZ4 if compression.lz4 is not None else compression.CODEC_ZLIB
+        self.assertEqual(server.codec, expected)
+        self.assertEqual(client.codec, expected)
+
+    def test_negotiate_nothing_shared(self):
+        server = compression.compression_class()
+        offer = bytes([compression.LINK_COMPRESSION_OFFER, 0x80])
+        self.assertEqual(server.handle(offer), bytes([compression.LINK_COMPRESSION_SELECT, 0]))
+        self.assertIsNone(server.codec)
+        self.assertEqual(server.compress(STATUS * 4), (False, STATUS * 4))
+
+    def test_short_message_ignored(self):
+        server = compression.compression_class()
+        self.assertIsNone(server.handle(bytes([compression.LINK_COMPRESSION_OFFER])))
+        self.assertIsNone(server.codec)
+
+    def test_reset(self):
+        client = compression.compression_class()
+        server = compression.compression_class()
+        self.negotiate(client, server)
+        server.reset()
+        self.assertEqual(server.compress(STATUS * 4), (False, STATUS * 4))
+
+    def test_round_trip(self):
+        client = compression.compression_class()
+        server = compression.compression_class()
+        self.negotiate(client, server)
+        compressed, data = server.compress(STATUS * 4)
+        self.assertTrue(compressed)
+        self.assertEqual(data[0], compression.CODEC_ZLIB)
+        self.assertLess(len(data), len(STATUS))
+        self.assertEqual(client.decompress(data), STATUS * 4)
+        self.assertEqual(server.uncompressed_bytes, len(STATUS) * 4)
+        self.assertEqual(server.compressed_bytes, len(data))
+
+    def test_not_worth_it(self):
+        server = compression.compression_class()
+        server.codec = compression.CODEC_ZLIB
+        self.assertEqual(server.compress(b'short'), (False, b'short'))
+        noise = bytes((i * 151 + 7) % 256 for i in range(64))
+        self.assertEqual(server.compress(noise), (False, noise))
+        self.assertEqual(server.compressed_bytes, 0)
+
+    def test_decompress_errors(self):
+        client = compression.compression_class()
+        with self.assertRaises(ValueError):
+            client.decompress(b'')
+        with self.assertRaises(ValueError):
+            client.decompress(b'\x7fdata')
+        with self.assertRaises(ValueError):
+            client.decompress(bytes([compression.CODEC_ZLIB]) + b'\xff\xff\xff')
+
+    def test_framed(self):
+        client = compression.compression_class()
+        server = compression.compression_class()
+        self.negotiate(client, server)
+        frame_data = frame_data_class(16, 16)
+        scheduler = tx_scheduler_class(frame_data, frame_codec.frame_encoder_class(), compression=server)
+        decoder = frame_codec.frame_decoder_class(client.decompress)
+        frame_data.send(STATUS * 4)
+        frame_data.send(b'ok')
+        values = []
+        entry = scheduler.next_fragment(20)
+        while entry is not None:
+            values.append(entry[0])
+            entry = scheduler.next_fragment(20)
+        self.assertTrue(values[0][0] & frame_codec.FLAG_COMPRESSED)
+        self.assertFalse(values[-1][0] & frame_codec.FLAG_COMPRESSED)
+        messages = []
+        for value in values:
+            messages += decoder.feed(value)
+        self.assertEqual(messages, [STATUS * 4, b'ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from communication import command_protocol
+from communication import file_transfer
+from communication.file_transfer import file_transfer_client_class, file_transfer_server_class
+
+
+class file_transfer_test_class(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.local = os.path.join(self.directory, 'local.bin')
+        self.data = os.urandom(10 * 256 + 100)
+        with open(self.local, 'wb') as f:
+            f.write(self.data)
+        self.chunks = []
+        self.handled = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def connect(self, limit=None, submit=False):
+        """
+        A client and a server sending straight to each other; after limit
+        chunks the connection drops everything the client sends. With
+        submit=True the server handles messages on its worker thread.
+        """
+        server = file_transfer_server_class(None, self.directory)
+        client = file_transfer_client_class(None, chunk_size=256, timeout=0.05, retries=2)
+        server.send = client.handle
+
+        def send(data):
+            if limit is not None and len(self.chunks) >= limit:
+                return
+            if command_protocol.decode(data)[0] == file_transfer.MSG_FILE_CHUNK:
+                self.chunks.append(file_transfer.CHUNK.unpack_from(data, command_protocol.HEADER.size)[0])
+            if submit:
+                server.submit(data, lambda: self.handled.append(threading.get_ident()))
+            else:
+                server.handle(data)
+        client.send = send
+        return client, server
+
+    def test_upload(self):
+        client, server = self.connect()
+        self.assertEqual(client.upload(self.local, 'remote.bin'), command_protocol.STATUS_OK)
+        with open(os.path.join(self.directory, 'remote.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_resume(self):
+        client, server = self.connect(limit=4)
+        with self.assertRaises(TimeoutError):
+            client.upload(self.local, 'remote.bin')
+        server.close()
+        self.assertEqual(self.chunks, [0, 1, 2, 3])
+        del self.chunks[:]
+
+        # a new connection only sends what is missing
+        client, server = self.connect()
+        self.assertEqual(client.upload(self.local, 'remote.bin'), command_protocol.STATUS_OK)
+        self.assertEqual(sorted(self.chunks), list(range(4, 11)))
+        with open(os.path.join(self.directory, 'remote.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'remote.bin.part')))
+
+    def test_submit(self):
+        client, server = self.connect(submit=True)
+        self.assertEqual(client.upload(self.local, 'remote.bin'), command_protocol.STATUS_OK)
+        server.close()
+        with open(os.path.join(self.directory, 'remote.bin'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        # done() of the last message follows its reply
+        deadline = time.monotonic() + 1.0
+        while len(self.handled) <= len(self.chunks) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # every message was handled, none of them on the sending thread
+        self.assertEqual(len(self.handled), len(self.chunks) + 1)
+        self.assertNotIn(threading.get_ident(), self.handled)
+
+    def test_limits(self):
+        replies = []
+        server = file_transfer_server_class(replies.append, self.directory)
+        digest = bytes(32)
+        server.handle(file_transfer.encode_open(1, 'big.bin', file_transfer.MAX_FILE_SIZE + 1, 1024, digest))
+        server.handle(file_transfer.encode_open(2, 'many.bin', file_transfer.MAX_CHUNKS + 1, 1, digest))
+        self.assertEqual(replies, [file_transfer.encode_done(1, file_transfer.STATUS_IO_ERROR),
+                                   file_transfer.encode_done(2, file_transfer.STATUS_IO_ERROR)])
+        self.assertEqual(os.listdir(self.directory), ['local.bin'])
+
+    def test_outside_root(self):
+        client, server = self.connect()
+        self.assertEqual(client.upload(self.local, '../escape.bin'), file_transfer.STATUS_IO_ERROR)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+from communication import flow_control
+from communication.flow_control import flow_control_class
+
+
+class flow_control_test_class(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.free = 16
+        self.flow = flow_control_class(16, self.sent.append, lambda: self.free)
+
+    def grants(self):
+        return [flow_control.CREDIT.unpack(message)[1] for message in self.sent]
+
+    def test_off_until_peer_opts_in(self):
+        self.assertTrue(self.flow.tx_consume())
+        self.flow.rx_received()
+        self.flow.rx_consumed(16)
+        self.assertEqual(self.sent, [])
+        self.assertEqual(flow_control.STATE.unpack(self.flow.state())[2], flow_control.UNLIMITED)
+
+    def test_handshake_grants_free_slots(self):
+        self.free = 10
+        self.assertTrue(self.flow.handle(flow_control.encode_credit(2)))
+        self.assertEqual(self.grants(), [10])
+        self.assertTrue(self.flow.tx_consume())
+        self.assertTrue(self.flow.tx_consume())
+        self.assertFalse(self.flow.tx_consume())
+        self.assertFalse(self.flow.tx_acquire(0.01))
+        self.assertEqual(self.flow.tx_stalls, 1)
+
+    def test_credit_returned_in_batches(self):
+        self.flow.handle(flow_control.encode_credit(0))
+        del self.sent[:]
+        for i in range(16):
+            self.flow.rx_received()
+        self.assertEqual(self.flow.rx_credit, 0)
+        self.flow.rx_received()
+        self.assertEqual(self.flow.overruns, 1)
+        # a quarter window at a time
+        for i in range(3):
+            self.flow.rx_consumed(1)
+        self.assertEqual(self.sent, [])
+        self.flow.rx_consumed(1)
+        self.assertEqual(self.grants(), [4])
+        self.assertEqual(self.flow.rx_credit, 4)
+
+    def test_reset(self):
+        self.flow.handle(flow_control.encode_credit(5))
+        self.flow.reset()
+        self.assertFalse(self.flow.enabled)
+        self.assertTrue(self.flow.tx_consume())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import unittest
+
+from communication import frame_codec
+
+
+def fragments(payload, fragment_size=20, flags=0, encoder=None):
+    if encoder is None:
+        encoder = frame_codec.frame_encoder_class()
+    return list(encoder.fragments(payload, fragment_size, flags))
+
+
+class frame_codec_test_class(unittest.TestCase):
+    def test_round_trip(self):
+        for size in (0, 1, 13, 14, 15, 100, 1000, 5000):
+            payload = os.urandom(size)
+            decoder = frame_codec.frame_decoder_class()
+            messages = []
+            for fragment in fragments(payload):
+                self.assertLessEqual(len(fragment), 20)
+                messages += decoder.feed(fragment)
+            self.assertEqual(messages, [payload])
+
+    def test_single_fragment_capacity(self):
+        capacity = frame_codec.single_fragment_capacity(20)
+        self.assertEqual(len(fragments(b'x' * capacity)), 1)
+        self.assertEqual(len(fragments(b'x' * (capacity + 1))), 2)
+
+    def test_packed_fragments(self):
+        # several small messages back to back in one ATT value
+        encoder = frame_codec.frame_encoder_class()
+        value = b''.join(fragments(b'msg%d' % i, encoder=encoder)[0] for i in range(3))
+        decoder = frame_codec.frame_decoder_class()
+        self.assertEqual(decoder.feed(value), [b'msg0', b'msg1', b'msg2'])
+
+    def test_interleaved_channels(self):
+        encoder = frame_codec.frame_encoder_class()
+        bulk = encoder.fragments(b'b' * 200, 20, frame_codec.CHANNEL_BULK)
+        values = [next(bulk), next(bulk)]
+        values += fragments(b'control', encoder=encoder)
+        values += list(bulk)
+        decoder = frame_codec.frame_decoder_class()
+        messages = []
+        for value in values:
+            messages += decoder.feed_channels(value)
+        self.assertEqual(messages, [(frame_codec.CHANNEL_CONTROL, b'control'),
+                                    (frame_codec.CHANNEL_BULK, b'b' * 200)])
+
+    def test_crc_error(self):
+        value = bytearray(fragments(b'hello')[0])
+        value[5] ^= 0xFF
+        decoder = frame_codec.frame_decoder_class()
+        self.assertEqual(decoder.feed(bytes(value)), [])
+        self.assertEqual(decoder.crc_errors, 1)
+
+    def test_lost_fragment(self):
+        values = fragments(b'x' * 100)
+        decoder = frame_codec.frame_decoder_class()
+        for value in values[:1] + values[2:]:
+            self.assertEqual(decoder.feed(value), [])
+        self.assertEqual(decoder.seq_errors, 1)
+        # the next message decodes again
+        self.assertEqual(decoder.feed(fragments(b'next')[0]), [b'next'])
+
+    def test_count_messages(self):
+        encoder = frame_codec.frame_encoder_class()
+        link = fragments(b'\x01\x10\x00', encoder=encoder, flags=frame_codec.CHANNEL_LINK)
+        values = fragments(b'x' * 50, encoder=encoder)
+        packed = fragments(b'a', encoder=encoder)[0] + fragments(b'b', encoder=encoder)[0]
+        decoder = frame_codec.frame_decoder_class()
+        counts = []
+        for value in link + values + [packed]:
+            count = decoder.count_messages(value)
+            # counting consumes nothing
+            self.assertEqual(decoder.count_messages(value), count)
+            completed = [channel for channel, message in decoder.feed_channels(value)
+                         if channel != frame_codec.CHANNEL_LINK]
+            self.assertEqual(count, len(completed))
+            counts.append(count)
+        self.assertEqual(counts, [0] * len(values) + [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
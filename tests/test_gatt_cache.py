@@ -0,0 +1,84 @@
+"""
+Caching of the GATT property dicts. Needs dbus-python, skipped without it.
+"""
+import unittest
+
+from tests import fake_server
+
+try:
+    import dbus
+    from communication.bluetooth import bluetooth
+    from communication.bluetooth.fake_bluez import fake_bluez_class
+except ImportError:
+    dbus = None
+
+UUID = '0000ff00-0000-1000-8000-00805f9b34fb'
+
+
+class application_class():
+    def __init__(self):
+        self.invalidations = 0
+
+    def invalidate(self):
+        self.invalidations += 1
+
+
+class gatt_cache_test_class(unittest.TestCase):
+    def setUp(self):
+        if dbus is None:
+            raise unittest.SkipTest('dbus-python needed')
+        # a bus of its own, the objects never reach the running server
+        self.bus = fake_bluez_class().bus
+        self.application = application_class()
+        self.service = bluetooth.Service(self.bus, 9, UUID, True)
+        self.service.application = self.application
+
+    def test_properties_shared(self):
+        chrc = bluetooth.Characteristic(self.bus, 0, UUID, ['read'], self.service)
+        self.assertIs(chrc.get_properties(), chrc.get_properties())
+        self.assertIs(self.service.get_properties(), self.service.get_properties())
+
+    def test_structural_changes_invalidate(self):
+        before = self.service.get_properties()
+        chrc = bluetooth.Characteristic(self.bus, 0, UUID, ['read'], self.service)
+        self.service.add_characteristic(chrc)
+        after = self.service.get_properties()
+        self.assertIsNot(after, before)
+        self.assertEqual(list(after[bluetooth.GATT_SERVICE_IFACE]['Characteristics']), [chrc.get_path()])
+        self.assertEqual(self.application.invalidations, 1)
+
+        chrc_before = chrc.get_properties()
+        descriptor = bluetooth.Descriptor(self.bus, 0, UUID, ['read'], chrc)
+        chrc.add_descriptor(descriptor)
+        self.assertEqual(list(chrc.get_properties()[bluetooth.GATT_CHRC_IFACE]['Descriptors']),
+                         [descriptor.get_path()])
+        self.assertIsNot(chrc.get_properties(), chrc_before)
+        # up the tree to the application
+        self.assertIsNot(self.service.get_properties(), after)
+        self.assertEqual(self.application.invalidations, 2)
+
+    def test_advertisement(self):
+        advertisement = bluetooth.Advertisement(self.bus, 9, 'peripheral')
+        advertisement.add_local_name('first')
+        first = advertisement.get_properties()
+        self.assertIs(advertisement.get_properties(), first)
+        advertisement.add_local_name('second')
+        self.assertEqual(advertisement.get_properties()[bluetooth.LE_ADVERTISEMENT_IFACE]['LocalName'], 'second')
+        # direct changes need invalidate()
+        advertisement.include_tx_power = True
+        self.assertNotIn('IncludesTxpower', advertisement.get_properties()[bluetooth.LE_ADVERTISEMENT_IFACE])
+        advertisement.invalidate()
+        self.assertIn('IncludesTxpower', advertisement.get_properties()[bluetooth.LE_ADVERTISEMENT_IFACE])
+
+    def test_managed_objects_cached(self):
+        fake = fake_server.start()
+        application = fake.bus.objects[fake.app_path]
+        first = fake.bus.call_method(fake.app_path, bluetooth.DBUS_OM_IFACE, 'GetManagedObjects')
+        cached = application.managed_objects
+        second = fake.bus.call_method(fake.app_path, bluetooth.DBUS_OM_IFACE, 'GetManagedObjects')
+        self.assertIs(application.managed_objects, cached)
+        self.assertEqual(first, second)
+
+
+if __name__ == '__main__':
+    unittest.main()
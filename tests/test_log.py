@@ -0,0 +1,53 @@
+import io
+import unittest
+
+from utils import log
+
+
+class log_test_class(unittest.TestCase):
+    def setUp(self):
+        log.flush()
+        self.saved = log.output, log.print_level
+        log.output = io.StringIO()
+        log.print_level = log.PRINT_LEVEL_DEBUG
+
+    def tearDown(self):
+        log.flush()
+        log.output, log.print_level = self.saved
+
+    def lines(self):
+        log.flush()
+        return log.output.getvalue().splitlines()
+
+    def test_lazy_formatting(self):
+        log.info_print('%s connected: %s', '/dev_1', True)
+        log.verbose_print('%s', 'not enabled')
+        self.assertEqual(self.lines(), ['/dev_1 connected: True'])
+
+    def test_burst(self):
+        for i in range(log.RATE_LIMIT_BURST + 5):
+            log.warn_print('rx queue full')
+        lines = self.lines()
+        self.assertEqual(lines[:log.RATE_LIMIT_BURST], ['rx queue full'] * log.RATE_LIMIT_BURST)
+        self.assertEqual(lines[log.RATE_LIMIT_BURST:], ['(suppressed 5 repeats of: rx queue full)'])
+
+    def test_limited_per_arguments(self):
+        # a pass-through format shares no bucket between different data
+        for i in range(log.RATE_LIMIT_BURST + 1):
+            log.debug_print('%s', 'command %d' % i)
+        for i in range(log.RATE_LIMIT_BURST + 2):
+            log.debug_print('%s', 'ls')
+        lines = self.lines()
+        self.assertEqual(lines[:log.RATE_LIMIT_BURST + 1],
+                         ['command %d' % i for i in range(log.RATE_LIMIT_BURST + 1)])
+        self.assertEqual(lines[-1], '(suppressed 2 repeats of: ls)')
+
+    def test_unhashable_arguments(self):
+        for i in range(log.RATE_LIMIT_BURST + 1):
+            log.info_print('changed %s', {'Connected': True})
+        self.assertEqual(self.lines()[-1],
+                         "(suppressed 1 repeats of: changed {'Connected': True})")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from communication import metrics
+
+
+class metrics_test_class(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.metrics_registry_class()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter('writes_total', 'writes', {'session': '0'})
+        counter.inc()
+        counter.inc(4)
+        self.registry.gauge('queue_depth', 'depth', lambda: 3)
+        self.assertEqual(self.registry.render().splitlines(), [
+                '# HELP writes_total writes',
+                '# TYPE writes_total counter',
+                'writes_total{session="0"} 5',
+                '# HELP queue_depth depth',
+                '# TYPE queue_depth gauge',
+                'queue_depth 3',
+        ])
+
+    def test_families_stay_contiguous(self):
+        first = self.registry.counter('writes_total', 'writes', {'session': '0'})
+        self.registry.counter('other_total', 'other')
+        second = self.registry.counter('writes_total', 'writes', {'session': '1'})
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines.count('# TYPE writes_total counter'), 1)
+        index = lines.index('writes_total{session="0"} 0')
+        self.assertEqual(lines[index + 1], 'writes_total{session="1"} 0')
+        self.registry.remove(second)
+        self.assertNotIn('writes_total{session="1"} 0', self.registry.render())
+
+    def test_histogram(self):
+        histogram = metrics.histogram_class('latency_seconds', 'latency', buckets=(0.001, 0.01, 0.1))
+        for value in (0.0005, 0.005, 0.005, 0.05, 5.0):
+            histogram.observe(value)
+        lines = histogram.families()[0][3]
+        self.assertEqual(lines[:4], [
+                'latency_seconds_bucket{le="0.001"} 1',
+                'latency_seconds_bucket{le="0.01"} 3',
+                'latency_seconds_bucket{le="0.1"} 4',
+                'latency_seconds_bucket{le="+Inf"} 5',
+        ])
+        self.assertEqual(lines[-1], 'latency_seconds_count 5')
+        self.assertEqual(histogram.quantile(0.5), 0.01)
+        self.assertEqual(histogram.quantile(0.99), float('inf'))
+
+    def test_rolling_window(self):
+        histogram = metrics.histogram_class('latency_seconds', 'latency', buckets=(0.001, 0.01), window=10.0)
+        start = histogram.window_start
+        histogram.observe(0.0005, start)
+        # the previous window still counts
+        histogram.observe(0.005, start + 10.0)
+        self.assertEqual(histogram.counts, [1, 1, 0])
+        self.assertEqual(sum(histogram.window_counts) + sum(histogram.previous_counts), 2)
+        # two windows later the old samples are gone from the rolling view
+        histogram.observe(0.005, start + 30.0)
+        self.assertEqual(histogram.previous_counts, [0, 0, 0])
+        self.assertEqual(histogram.window_counts, [0, 1, 0])
+        self.assertEqual(histogram.count, 3)
+
+    def test_serve_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'metrics')
+            self.registry.counter('writes_total', 'writes').inc(2)
+            server = self.registry.serve(path)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            data = b''
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            client.close()
+            server.close()
+            self.assertIn(b'writes_total 2\n', data)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+
+from communication import frame_codec
+from communication import notify_batcher
+from communication.notify_batcher import notify_batcher_class
+
+FRAGMENT_SIZE = 100
+
+
+class notify_batcher_test_class(unittest.TestCase):
+    def setUp(self):
+        self.batcher = notify_batcher_class()
+        self.encoder = frame_codec.frame_encoder_class()
+
+    def add_message(self, payload, now=0.0, sent=None):
+        fragments = list(self.encoder.fragments(payload, FRAGMENT_SIZE))
+        self.assertEqual(len(fragments), 1)
+        self.assertTrue(self.batcher.fits(fragments[0], FRAGMENT_SIZE))
+        self.batcher.add(fragments[0], sent, now)
+
+    def test_pack_until_full(self):
+        added = 0
+        while not self.batcher.full(FRAGMENT_SIZE):
+            self.add_message(b'reply %02d' % added, sent=added)
+            added += 1
+        self.assertGreater(added, 1)
+        value, sent = self.batcher.take()
+        self.assertLessEqual(len(value), FRAGMENT_SIZE)
+        self.assertEqual(sent, list(range(added)))
+        decoder = frame_codec.frame_decoder_class()
+        self.assertEqual(decoder.feed(value), [b'reply %02d' % i for i in range(added)])
+        self.assertTrue(self.batcher.empty())
+        self.assertEqual(self.batcher.batched, added)
+
+    def test_fits(self):
+        self.add_message(b'x' * 80)
+        fragment = next(self.encoder.fragments(b'y' * 40, FRAGMENT_SIZE))
+        self.assertFalse(self.batcher.fits(fragment, FRAGMENT_SIZE))
+        # an empty value takes any fragment
+        self.batcher.take()
+        self.assertTrue(self.batcher.fits(fragment, FRAGMENT_SIZE))
+
+    def test_max_fragments(self):
+        self.batcher = notify_batcher_class(max_fragments=2)
+        self.add_message(b'a')
+        self.assertFalse(self.batcher.full(FRAGMENT_SIZE))
+        self.add_message(b'b')
+        self.assertTrue(self.batcher.full(FRAGMENT_SIZE))
+
+    def test_no_hold_at_start(self):
+        # a lone reply goes out at once
+        self.add_message(b'reply')
+        self.assertEqual(self.batcher.hold(0.0), 0.0)
+
+    def test_backlog_enables_hold(self):
+        self.add_message(b'one')
+        self.add_message(b'two')
+        self.batcher.take()
+        self.assertEqual(self.batcher.scale, notify_batcher.MIN_HOLD_SCALE)
+        self.add_message(b'three', now=1.0)
+        limit = self.batcher.hold_limit()
+        self.assertGreater(limit, 0)
+        self.assertAlmostEqual(self.batcher.hold(1.0), limit)
+        self.assertEqual(self.batcher.hold(1.0 + limit), 0.0)
+
+    def test_hold_adapts(self):
+        self.batcher.scale = 0.5
+        # the hold brought in another message
+        self.add_message(b'one', now=0.0)
+        self.assertGreater(self.batcher.hold(0.0), 0)
+        self.add_message(b'two', now=0.001)
+        self.batcher.take()
+        self.assertEqual(self.batcher.scale, 1.0)
+        # holds that catch nothing switch holding off
+        now = 1.0
+        while self.batcher.scale:
+            self.add_message(b'alone', now=now)
+            self.assertGreater(self.batcher.hold(now), 0)
+            self.batcher.take()
+            now += 1.0
+        self.add_message(b'alone', now=now)
+        self.assertEqual(self.batcher.hold(now), 0.0)
+
+    def test_hold_limit(self):
+        self.batcher.scale = 1.0
+        self.assertAlmostEqual(self.batcher.hold_limit(), 0.015)
+        self.batcher.interval = 0.0075
+        self.assertAlmostEqual(self.batcher.hold_limit(), 0.00375)
+
+    def test_observe_write(self):
+        now = 0.0
+        for i in range(64):
+            self.batcher.observe_write(now)
+            now += 0.0075
+        self.assertAlmostEqual(self.batcher.interval, 0.0075, places=4)
+        # idle gaps and writes of the same event are ignored
+        interval = self.batcher.interval
+        self.batcher.observe_write(now + 10.0)
+        self.batcher.observe_write(now + 10.001)
+        self.assertEqual(self.batcher.interval, interval)
+
+    def test_reset(self):
+        self.batcher.scale = 1.0
+        self.batcher.observe_write(0.0)
+        self.batcher.observe_write(0.05)
+        self.add_message(b'lost')
+        self.batcher.reset()
+        self.assertTrue(self.batcher.empty())
+        self.assertEqual(self.batcher.scale, 0.0)
+        self.assertEqual(self.batcher.interval, notify_batcher.DEFAULT_INTERVAL)
+
+    def test_unframed_empty_message(self):
+        self.batcher.add(b'', None, 0.0)
+        self.assertFalse(self.batcher.empty())
+        self.assertEqual(self.batcher.take(), (b'', []))
+
+
+if __name__ == '__main__':
+    unittest.main()
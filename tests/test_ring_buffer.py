@@ -0,0 +1,88 @@
+import threading
+import time
+import unittest
+
+from communication import ring_buffer
+from communication.ring_buffer import ring_buffer_class, RingBufferFullException
+
+
+class ring_buffer_test_class(unittest.TestCase):
+    def test_order(self):
+        ring = ring_buffer_class(4)
+        for round in range(3):
+            for i in range(4):
+                ring.put(i)
+            self.assertTrue(ring.full())
+            self.assertEqual(ring.get_many(8), [0, 1, 2, 3])
+        self.assertIsNone(ring.get())
+
+    def test_block_times_out(self):
+        ring = ring_buffer_class(1, ring_buffer.POLICY_BLOCK, timeout=0.05)
+        ring.put(1)
+        start = time.monotonic()
+        with self.assertRaises(RingBufferFullException):
+            ring.put(2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        with self.assertRaises(RingBufferFullException):
+            ring.put(2, block=False)
+        self.assertEqual(ring.drop_count, 2)
+
+    def test_block_waits_for_room(self):
+        ring = ring_buffer_class(1, ring_buffer.POLICY_BLOCK, timeout=2.0)
+        ring.put(1)
+        threading.Timer(0.05, ring.get).start()
+        self.assertTrue(ring.put(2))
+        self.assertEqual(ring.get(), 2)
+
+    def test_reject(self):
+        ring = ring_buffer_class(1, ring_buffer.POLICY_REJECT, timeout=2.0)
+        ring.put(1)
+        start = time.monotonic()
+        with self.assertRaises(RingBufferFullException):
+            ring.put(2)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_drop_oldest(self):
+        ring = ring_buffer_class(2, ring_buffer.POLICY_DROP_OLDEST)
+        for i in range(4):
+            self.assertTrue(ring.put(i))
+        self.assertEqual(ring.get_many(4), [2, 3])
+        self.assertEqual(ring.drop_count, 2)
+
+    def test_drop_newest(self):
+        ring = ring_buffer_class(2, ring_buffer.POLICY_DROP_NEWEST)
+        self.assertEqual([ring.put(i) for i in range(4)], [True, True, False, False])
+        self.assertEqual(ring.get_many(4), [0, 1])
+
+    def test_multi_producer(self):
+        ring = ring_buffer_class(8, ring_buffer.POLICY_BLOCK, timeout=5.0, multi_producer=True)
+        producers = 4
+        count = 2000
+        received = []
+
+        def produce(producer):
+            for i in range(count):
+                ring.put((producer, i))
+
+        def consume():
+            while len(received) < producers * count:
+                item = ring.get(True, 5.0)
+                if item is None:
+                    return
+                received.append(item)
+        threads = [threading.Thread(target=produce, args=(n,)) for n in range(producers)]
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        consumer.join()
+        self.assertEqual(len(set(received)), producers * count)
+        for producer in range(producers):
+            own = [i for n, i in received if n == producer]
+            self.assertEqual(own, list(range(count)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+from communication import frame_codec
+from communication.frame_data import frame_data_class
+from communication.tx_scheduler import tx_scheduler_class
+
+FRAGMENT_SIZE = 20
+
+
+class tx_scheduler_test_class(unittest.TestCase):
+    def setUp(self):
+        self.frame_data = frame_data_class(16, 16, tx_channel='control', tx_weight=8)
+        self.frame_data.add_tx_channel('telemetry', frame_codec.CHANNEL_TELEMETRY, 4, 16)
+        self.frame_data.add_tx_channel('bulk', frame_codec.CHANNEL_BULK, 1, 16)
+        self.scheduler = tx_scheduler_class(self.frame_data, frame_codec.frame_encoder_class())
+        self.decoder = frame_codec.frame_decoder_class()
+
+    def drain(self, limit=None):
+        """
+        Notify up to limit values, return the (channel, message) pairs they
+        completed in order and the number of values.
+        """
+        messages = []
+        count = 0
+        while limit is None or count < limit:
+            entry = self.scheduler.next_fragment(FRAGMENT_SIZE)
+            if entry is None:
+                break
+            count += 1
+            messages += self.decoder.feed_channels(entry[0])
+        return messages, count
+
+    def test_control_overtakes_bulk(self):
+        bulk = bytes(range(256)) * 4
+        self.frame_data.send(bulk, channel='bulk')
+        # the bulk message is under way when the reply is queued
+        self.assertEqual(self.drain(3)[0], [])
+        self.frame_data.send(b'reply', channel='control')
+        messages, count = self.drain(2)
+        self.assertEqual(messages, [(frame_codec.CHANNEL_CONTROL, b'reply')])
+        messages, count = self.drain()
+        self.assertEqual(messages, [(frame_codec.CHANNEL_BULK, bulk)])
+        self.assertEqual(self.decoder.seq_errors + self.decoder.format_errors, 0)
+
+    def test_weighted_rounds(self):
+        for i in range(4):
+            self.frame_data.send(b'c%d' % i, channel='control')
+            self.frame_data.send(b't%d' % i, channel='telemetry')
+            self.frame_data.send(b'b%d' % i, channel='bulk')
+        messages, count = self.drain()
+        names = [message[:1] for channel, message in messages]
+        # one fragment each: all control, then telemetry, then bulk
+        self.assertEqual(names, [b'c'] * 4 + [b't'] * 4 + [b'b'] * 4)
+
+    def test_every_channel_progresses(self):
+        for i in range(16):
+            self.frame_data.send(b'c%02d' % i, channel='control')
+        self.frame_data.send(b'bulk', channel='bulk')
+        messages, count = self.drain()
+        order = [message for channel, message in messages]
+        # bulk gets its turn after one round of 8 control fragments
+        self.assertEqual(order.index(b'bulk'), 8)
+
+    def test_order_within_channel(self):
+        for i in range(10):
+            self.frame_data.send(b'%d' % i * 30, channel='telemetry')
+        messages, count = self.drain()
+        self.assertEqual([message for channel, message in messages], [b'%d' % i * 30 for i in range(10)])
+
+    def test_unframed(self):
+        self.scheduler.framing = False
+        self.frame_data.send(b'whole message', channel='bulk')
+        self.assertEqual(self.scheduler.next_fragment(FRAGMENT_SIZE)[0], b'whole message')
+        self.assertIsNone(self.scheduler.next_fragment(FRAGMENT_SIZE))
+
+
+if __name__ == '__main__':
+    unittest.main()
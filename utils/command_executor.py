@@ -0,0 +1,195 @@
+import os
+import queue
+import selectors
+import signal
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import log
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_OUTPUT = 16 * 1024
+
+class command_result_class():
+    def __init__(self, command, exit_code, stdout, stderr, timed_out=False):
+        self.command = command
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+    def __repr__(self):
+        return 'command_result_class(%r, exit_code=%r, timed_out=%r)' % (
+                self.command, self.exit_code, self.timed_out)
+
+def shell_quote(text):
+    return "'" + text.replace("'", "'\\''") + "'"
+
+class shell_worker_class():
+    """
+    A long-lived /bin/sh that runs one command at a time. Each command is
+    eval'ed in a subshell, so 'cd' or 'exit' do not leak into the worker,
+    and its exit status is then written to fd 3 of the shell, a pipe of
+    its own, so stdout and stderr carry nothing but the command's output.
+    Commands that outlive their timeout take the whole process group down,
+    a new shell is started for the next command.
+
+    With on_output(stream, data) output is handed over as it is read,
+    stream being 'stdout' or 'stderr', and not kept in the result.
+    """
+    def __init__(self, shell='/bin/sh', max_output=DEFAULT_MAX_OUTPUT):
+        self.shell = shell
+        self.max_output = max_output
+        self.proc = None
+        self.status = None
+
+    def start(self):
+        self.status, status_write = os.pipe()
+        try:
+            self.proc = subprocess.Popen([self.shell],
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         pass_fds=(status_write,),
+                                         start_new_session=True)
+        finally:
+            os.close(status_write)
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        os.set_blocking(self.proc.stderr.fileno(), False)
+        os.set_blocking(self.status, False)
+        # dash takes single digit fds only, reopen the pipe as fd 3
+        self.proc.stdin.write(b'exec 3>/proc/self/fd/%d\n' % status_write)
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        os.close(self.status)
+        self.proc = None
+        self.status = None
+
+    def collect(self, name, data, buffer, on_output):
+        if on_output is not None:
+            on_output(name, data)
+        elif len(buffer) < self.max_output:
+            buffer += data[:self.max_output - len(buffer)]
+
+    def drain(self, fd):
+        # output the command wrote before it exited, without waiting for
+        # processes it left behind
+        chunks = []
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            chunks.append(data)
+        return b''.join(chunks)
+
+    def run(self, command, timeout=DEFAULT_TIMEOUT, on_output=None):
+        if self.proc is None or self.proc.poll() is not None:
+            if self.proc is not None:
+                self.stop()
+            self.start()
+        script = '( eval %s ) </dev/null 3>&-\necho $? >&3\n' % shell_quote(command)
+        try:
+            self.proc.stdin.write(script.encode('utf-8'))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.stop()
+            return command_result_class(command, None, b'', b'worker shell died', False)
+
+        output = {'stdout': bytearray(), 'stderr': bytearray()}
+        status = bytearray()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.proc.stdout, selectors.EVENT_READ, 'stdout')
+        selector.register(self.proc.stderr, selectors.EVENT_READ, 'stderr')
+        selector.register(self.status, selectors.EVENT_READ, 'status')
+        try:
+            while not status.endswith(b'\n'):
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        log.warn_print('command timed out: %s', command)
+                        self.stop()
+                        return command_result_class(command, None,
+                                                    bytes(output['stdout']),
+                                                    bytes(output['stderr']),
+                                                    True)
+                for key, _ in selector.select(wait):
+                    fd = key.fd
+                    data = os.read(fd, 65536)
+                    if not data:
+                        self.stop()
+                        return command_result_class(command, None, bytes(output['stdout']),
+                                                    b'worker shell died', False)
+                    if key.data == 'status':
+                        status += data
+                    else:
+                        self.collect(key.data, data, output[key.data], on_output)
+        finally:
+            selector.close()
+        for name, pipe in (('stdout', self.proc.stdout), ('stderr', self.proc.stderr)):
+            data = self.drain(pipe.fileno())
+            if data:
+                self.collect(name, data, output[name], on_output)
+        return command_result_class(command, int(status),
+                                    bytes(output['stdout']),
+                                    bytes(output['stderr']))
+
+class command_executor_class():
+    """
+    Runs shell commands on a fixed pool of worker shells, at most
+    max_workers at a time, so a slow command does not hold up the ones
+    queued behind it.
+    """
+    def __init__(self, max_workers=2, timeout=DEFAULT_TIMEOUT,
+                 shell='/bin/sh', max_output=DEFAULT_MAX_OUTPUT):
+        self.timeout = timeout
+        self.workers = queue.Queue()
+        for i in range(max_workers):
+            self.workers.put(shell_worker_class(shell, max_output))
+        self.pool = ThreadPoolExecutor(max_workers)
+
+    def run(self, command, timeout=None, on_output=None):
+        if timeout is None:
+            timeout = self.timeout
+        worker = self.workers.get()
+        try:
+            return worker.run(command, timeout, on_output)
+        finally:
+            self.workers.put(worker)
+
+    def submit(self, command, callback=None, timeout=None, on_output=None):
+        """
+        Run command in the background. callback(result) is called from a
+        pool thread when it finishes, on_output(stream, data) from the same
+        thread while it runs (see shell_worker_class). Returns a
+        concurrent.futures.Future.
+        """
+        def task():
+            result = self.run(command, timeout, on_output)
+            if callback is not None:
+                try:
+                    callback(result)
+                except Exception as e:
+                    log.error_print('command callback failed: %s', e)
+            return result
+        return self.pool.submit(task)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+        while not self.workers.empty():
+            self.workers.get_nowait().stop()
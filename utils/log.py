@@ -1,5 +1,23 @@
-import time 
+"""
+Non-blocking logger.
+
+    log.info_print('%s connected: %s', path, connected)
+
+Arguments are only formatted when the level is enabled, and formatting and
+writing both happen on a background thread fed by a bounded queue, so a slow
+console or journald never stalls the caller (typically the GLib main loop).
+When the queue is full the message is dropped and counted. Bursts of the
+same message are rate limited, the writer thread reports how many copies
+were suppressed once the burst is over. The last lines can be kept in
+memory with enable_ring_buffer() and read back with dump_ring_buffer().
+"""
+import atexit
+import collections
 import os
+import queue
+import sys
+import threading
+import time
 
 PRINT_LEVEL_NONE = 5
 PRINT_LEVEL_VERBOSE = 4
@@ -8,24 +26,192 @@ PRINT_LEVEL_INFO = 2
 PRINT_LEVEL_WARN = 1
 PRINT_LEVEL_ERROR = 0
 
+LEVEL_NAMES = {
+        PRINT_LEVEL_VERBOSE: 'VERBOSE',
+        PRINT_LEVEL_DEBUG: 'DEBUG',
+        PRINT_LEVEL_INFO: 'INFO',
+        PRINT_LEVEL_WARN: 'WARN',
+        PRINT_LEVEL_ERROR: 'ERROR',
+}
+
 print_level = PRINT_LEVEL_DEBUG
 
-def verbose_print(args):
+QUEUE_SIZE = 1024
+# at most RATE_LIMIT_BURST copies of one message per RATE_LIMIT_INTERVAL
+RATE_LIMIT_INTERVAL = 1.0
+RATE_LIMIT_BURST = 10
+# distinct messages tracked at once, the oldest is forgotten first
+RATE_LIMIT_KEYS = 256
+
+output = sys.stdout
+dropped = 0
+# (level, message, args) -> [window start, count, suppressed, args], oldest
+# window first; keyed on the arguments too, so debug_print('%s', data) is
+# limited per distinct data rather than as one message
+rate_limits = collections.OrderedDict()
+rate_lock = threading.Lock()
+ring_buffer = None
+log_queue = queue.Queue(QUEUE_SIZE)
+writer_thread = None
+writer_lock = threading.Lock()
+
+def format_record(record):
+    created, level, message, args = record
+    if args:
+        try:
+            message = message % args
+        except (TypeError, ValueError):
+            message = '%s %r' % (message, args)
+    return str(message)
+
+def writer():
+    expired = time.time()
+    while True:
+        try:
+            record = log_queue.get(timeout=RATE_LIMIT_INTERVAL)
+        except queue.Empty:
+            record = None
+        now = time.time()
+        if now - expired >= RATE_LIMIT_INTERVAL:
+            expire_rate_limits(now - RATE_LIMIT_INTERVAL)
+            expired = now
+        if record is None:
+            continue
+        try:
+            line = format_record(record)
+            if ring_buffer is not None:
+                ring_buffer.append('%.6f %s %s' % (record[0], LEVEL_NAMES[record[1]], line))
+            output.write(line + '\n')
+            output.flush()
+        except Exception:
+            pass
+        finally:
+            log_queue.task_done()
+
+def start_writer():
+    global writer_thread
+    with writer_lock:
+        if writer_thread is None:
+            writer_thread = threading.Thread(target=writer, args=())
+            writer_thread.daemon = True
+            writer_thread.start()
+
+def report_suppressed(now, key, state):
+    if state[2]:
+        level, message = key[:2]
+        enqueue(now, level, '(suppressed %d repeats of: %s)',
+                (state[2], format_record((now, level, message, state[3]))))
+
+def rate_limit_key(level, message, args):
+    key = (level, message, args)
+    try:
+        hash(key)
+    except TypeError:
+        # e.g. a dict argument
+        key = (level, message, repr(args))
+    return key
+
+def rate_limited(level, message, args, now):
+    key = rate_limit_key(level, message, args)
+    evicted = None
+    with rate_lock:
+        state = rate_limits.get(key)
+        if state is not None and now - state[0] < RATE_LIMIT_INTERVAL:
+            state[1] += 1
+            if state[1] <= RATE_LIMIT_BURST:
+                return False
+            state[2] += 1
+            return True
+        # a new window
+        rate_limits[key] = [now, 1, 0, args]
+        rate_limits.move_to_end(key)
+        if len(rate_limits) > RATE_LIMIT_KEYS:
+            evicted = rate_limits.popitem(last=False)
+    if state is not None:
+        report_suppressed(now, key, state)
+    if evicted is not None:
+        report_suppressed(now, *evicted)
+    return False
+
+def expire_rate_limits(before=None):
+    """
+    Forget the messages whose window started before before (all of them
+    when None) and report what was suppressed of them. Called by the
+    writer thread, so the end of a burst shows up without the message
+    having to recur.
+    """
+    expired = []
+    with rate_lock:
+        while rate_limits:
+            key, state = next(iter(rate_limits.items()))
+            if before is not None and state[0] >= before:
+                break
+            del rate_limits[key]
+            expired.append((key, state))
+    now = time.time()
+    for key, state in expired:
+        report_suppressed(now, key, state)
+
+def enqueue(created, level, message, args):
+    global dropped
+    if writer_thread is None:
+        start_writer()
+    try:
+        log_queue.put_nowait((created, level, message, args))
+    except queue.Full:
+        dropped += 1
+
+def emit(level, message, args):
+    now = time.time()
+    if rate_limited(level, message, args, now):
+        return
+    enqueue(now, level, message, args)
+
+def verbose_print(message, *args):
     if print_level >= PRINT_LEVEL_VERBOSE:
-        print(args)
+        emit(PRINT_LEVEL_VERBOSE, message, args)
 
-def debug_print(args):
+def debug_print(message, *args):
     if print_level >= PRINT_LEVEL_DEBUG:
-        print(args)
+        emit(PRINT_LEVEL_DEBUG, message, args)
 
-def warn_print(args):
+def warn_print(message, *args):
     if print_level >= PRINT_LEVEL_WARN:
-        print(args)
+        emit(PRINT_LEVEL_WARN, message, args)
 
-def info_print(args):
+def info_print(message, *args):
     if print_level >= PRINT_LEVEL_INFO:
-        print(args)
+        emit(PRINT_LEVEL_INFO, message, args)
 
-def error_print(args):
+def error_print(message, *args):
     if print_level >= PRINT_LEVEL_ERROR:
-        print(args)
\ No newline at end of file
+        emit(PRINT_LEVEL_ERROR, message, args)
+
+def enable_ring_buffer(size=1000):
+    """
+    Keep the last size log lines, with timestamp and level, in memory.
+    """
+    global ring_buffer
+    ring_buffer = collections.deque(maxlen=size)
+
+def dump_ring_buffer(path=None):
+    """
+    Return the buffered lines, or write them to path when given.
+    """
+    flush()
+    lines = list(ring_buffer) if ring_buffer is not None else []
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    return lines
+
+def flush():
+    """
+    Wait until everything logged so far, including pending suppression
+    reports, has been written.
+    """
+    expire_rate_limits()
+    if writer_thread is not None:
+        log_queue.join()
+
+atexit.register(flush)